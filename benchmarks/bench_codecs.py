@@ -0,0 +1,69 @@
+"""
+bench_codecs.py
+Written by: Joshua Kitchen - 2024
+
+Compares the encode and decode speed and encoded size of the codecs in serialization.py. Run from the repository root
+with:
+    python -m benchmarks.bench_codecs
+"""
+import collections
+import pickle
+import timeit
+
+from src.TCPLib.serialization import JSONCodec, PickleCodec, StructCodec
+
+Tick = collections.namedtuple("Tick", ["ts", "price", "volume", "flags"])
+
+RECORD_FMT = "<dQdI"  # ts: float64, price: uint64 (ticks), volume: float64, flags: uint32
+NUM_RECORDS = 10000
+
+
+def make_payloads():
+    records = [(i * 0.001, 1000 + i % 97, i * 1.5, i % 8) for i in range(NUM_RECORDS)]
+    blob = {"name": "frame", "pixels": pickle.PickleBuffer(bytearray(8 * 1024 * 1024))}
+    return [
+        ("small dict", {"id": 42, "op": "update", "tags": ["a", "b"], "value": 3.14},
+         [("json", JSONCodec()), ("pickle", PickleCodec())]),
+        (f"{NUM_RECORDS} records", records,
+         [("json", JSONCodec()), ("pickle", PickleCodec()), ("struct batch", StructCodec(RECORD_FMT, batch=True)),
+          ("struct batch (namedtuple)", StructCodec(RECORD_FMT, batch=True, record_type=Tick))]),
+        ("8 MiB buffer", blob,
+         [("pickle in-band", PickleCodec(out_of_band=False)), ("pickle out-of-band", PickleCodec())]),
+    ]
+
+
+def encoded_size(data) -> int:
+    if isinstance(data, list):
+        return sum(memoryview(part).nbytes for part in data)
+    return len(data)
+
+
+def joined(data):
+    # What the receiver gets: one contiguous message
+    if isinstance(data, list):
+        out = bytearray()
+        for part in data:
+            out.extend(part)
+        return out
+    return data
+
+
+def bench(obj, codec, number):
+    encoded = codec.encode(obj)
+    received = joined(encoded)
+    enc = min(timeit.repeat(lambda: codec.encode(obj), number=number, repeat=3)) / number
+    dec = min(timeit.repeat(lambda: codec.decode(received), number=number, repeat=3)) / number
+    return enc, dec, encoded_size(encoded)
+
+
+def main():
+    print(f"{'payload':<18} {'codec':<28} {'encode us':>12} {'decode us':>12} {'size':>12}")
+    for payload_name, obj, codecs in make_payloads():
+        for codec_name, codec in codecs:
+            number = 10000 if payload_name == "small dict" else 20
+            enc, dec, size = bench(obj, codec, number)
+            print(f"{payload_name:<18} {codec_name:<28} {enc * 1e6:>12.1f} {dec * 1e6:>12.1f} {size:>12}")
+
+
+if __name__ == "__main__":
+    main()
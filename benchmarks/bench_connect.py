@@ -0,0 +1,90 @@
+"""
+bench_connect.py
+Written by: Joshua Kitchen - 2024
+
+Measures time to first response for short-lived connections: the time from starting connect() until the reply to
+the first message sent on the new connection arrives. Compares the default connect, which waits a round trip for the
+server to accept, with optimistic connects, with and without TCP Fast Open, directly over loopback and through an
+ImpairmentProxy adding latency (the proxy opens its own connections, so Fast Open does not apply through it). Run
+from the repository root with:
+    python -m benchmarks.bench_connect
+"""
+import statistics
+import threading
+import time
+
+from src.TCPLib.impair import ImpairmentProxy
+from src.TCPLib.tcp_client import TCPClient
+from src.TCPLib.tcp_server import TCPServer
+
+HOST = "127.0.0.1"
+PORT = 5098
+MODES = {
+    "default": dict(),
+    "optimistic": dict(optimistic=True),
+    "optimistic+tfo": dict(optimistic=True, fast_open=True),
+}
+CONDITIONS = {
+    "loopback": (None, 300),
+    "5ms proxy": (0.005, 20),
+}
+
+
+def echo_loop(server: TCPServer, stop: threading.Event):
+    while not stop.is_set():
+        msg = server.pop_msg(block=True, timeout=0.1)
+        if msg is None:
+            continue
+        if msg.data is None:
+            server.disconnect_client(msg.client_id)
+        else:
+            server.send(msg.client_id, msg.data)
+
+
+def run(addr: tuple[str, int], mode: dict, count: int) -> list[float]:
+    times = []
+    for _ in range(count):
+        client = TCPClient(*addr, timeout=10, profile="low_latency", **mode)
+        start = time.perf_counter()
+        if not client.connect():
+            raise ConnectionError("Could not connect to the benchmark server")
+        client.send(b'ping')
+        client.receive_all()
+        times.append(time.perf_counter() - start)
+        client.disconnect()
+    return times
+
+
+def main():
+    server = TCPServer(HOST, PORT, profile="low_latency", fast_open=True)
+    stop = threading.Event()
+    server.start()
+    echo = threading.Thread(target=echo_loop, args=(server, stop), daemon=True)
+    echo.start()
+    time.sleep(0.1)
+    print(f"{'condition':<12} {'mode':<16} {'median ms':>10} {'p90 ms':>10}")
+    try:
+        for condition, (latency, count) in CONDITIONS.items():
+            proxy = None
+            addr = (HOST, PORT)
+            if latency is not None:
+                proxy = ImpairmentProxy((HOST, PORT), latency=latency)
+                proxy.start()
+                addr = proxy.addr()
+            try:
+                for name, mode in MODES.items():
+                    run(addr, mode, 3)  # Warms up, and gets a Fast Open cookie from the server
+                    times = sorted(run(addr, mode, count))
+                    p90 = times[int(len(times) * 0.9) - 1]
+                    print(f"{condition:<12} {name:<16} {statistics.median(times) * 1e3:>10.3f} {p90 * 1e3:>10.3f}")
+            finally:
+                if proxy is not None:
+                    proxy.stop()
+    finally:
+        stop.set()
+        echo.join()
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
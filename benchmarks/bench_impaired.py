@@ -0,0 +1,84 @@
+"""
+bench_impaired.py
+Written by: Joshua Kitchen - 2024
+
+Measures round trip latency and echo throughput through an ImpairmentProxy under a few simulated network conditions,
+for each socket profile, so the effect of settings such as TCP_NODELAY shows up the way it would off loopback. Each
+round trip sends two small messages before waiting for the replies, the write-write-read pattern which Nagle's
+algorithm stalls. Run from the repository root with:
+    python -m benchmarks.bench_impaired
+"""
+import threading
+import time
+
+from src.TCPLib.impair import ImpairmentProxy
+from src.TCPLib.tcp_client import TCPClient
+from src.TCPLib.tcp_server import TCPServer
+
+HOST = "127.0.0.1"
+PORT = 5098
+PING_COUNT = 50
+BULK_SIZE = 256 * 1024
+BULK_COUNT = 8
+
+CONDITIONS = {
+    "lan": dict(latency=0.0005),
+    "wan": dict(latency=0.02, jitter=0.005, bandwidth=10 * 1024 * 1024),
+    "fragmented": dict(latency=0.001, max_write=512),
+}
+PROFILES = ["default", "low_latency"]
+
+
+def echo_loop(server: TCPServer, stop: threading.Event):
+    while not stop.is_set():
+        msg = server.pop_msg(block=True, timeout=0.1)
+        if msg is not None and msg.data is not None:
+            server.send(msg.client_id, msg.data)
+
+
+def run(condition: str, profile: str):
+    server = TCPServer(HOST, PORT, profile=profile)
+    proxy = ImpairmentProxy((HOST, PORT), **CONDITIONS[condition])
+    stop = threading.Event()
+    server.start()
+    proxy.start()
+    time.sleep(0.1)
+    echo = threading.Thread(target=echo_loop, args=(server, stop), daemon=True)
+    echo.start()
+    client = TCPClient(*proxy.addr(), timeout=30, profile=profile)
+    try:
+        if not client.connect():
+            raise ConnectionError("Could not connect to the benchmark server")
+        start = time.perf_counter()
+        for _ in range(PING_COUNT):
+            client.send(b'ping')
+            client.send(b'ping')
+            client.receive_all()
+            client.receive_all()
+        latency = (time.perf_counter() - start) / PING_COUNT
+
+        payload = bytes(BULK_SIZE)
+        start = time.perf_counter()
+        for _ in range(BULK_COUNT):
+            client.send(payload)
+            client.receive_all()
+        elapsed = time.perf_counter() - start
+        throughput = 2 * BULK_SIZE * BULK_COUNT / elapsed / (1024 * 1024)
+        print(f"{condition:<12} {profile:<12} {latency * 1e3:>14.2f} {throughput:>12.1f}")
+    finally:
+        stop.set()
+        client.disconnect()
+        echo.join()
+        proxy.stop()
+        server.stop()
+
+
+def main():
+    print(f"{'condition':<12} {'profile':<12} {'round trip ms':>14} {'echo MiB/s':>12}")
+    for condition in CONDITIONS:
+        for profile in PROFILES:
+            run(condition, profile)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+bench_transports.py
+Written by: Joshua Kitchen - 2024
+
+Compares round trip latency and bulk throughput of loopback TCP, Unix domain sockets and the in-process socketpair
+transport from TCPServer.connect_local(), and the shared memory fast path for large messages. Run from the repository
+root with:
+    python -m benchmarks.bench_transports
+"""
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from src.TCPLib.tcp_client import TCPClient
+from src.TCPLib.tcp_server import TCPServer
+
+HOST = "127.0.0.1"
+PORT = 5099
+PING_COUNT = 5000
+BULK_SIZE = 1024 * 1024
+BULK_COUNT = 200
+
+
+def echo_loop(server: TCPServer, stop: threading.Event):
+    while not stop.is_set():
+        msg = server.pop_msg(block=True, timeout=0.1)
+        if msg is not None:
+            server.send(msg.client_id, msg.data)
+
+
+def run(name: str, server: TCPServer, make_client):
+    stop = threading.Event()
+    server.start()
+    time.sleep(0.1)
+    echo = threading.Thread(target=echo_loop, args=(server, stop), daemon=True)
+    echo.start()
+    client = make_client()
+    try:
+        start = time.perf_counter()
+        for _ in range(PING_COUNT):
+            client.send(b'ping')
+            client.receive_all()
+        latency = (time.perf_counter() - start) / PING_COUNT
+
+        payload = bytes(BULK_SIZE)
+        start = time.perf_counter()
+        for _ in range(BULK_COUNT):
+            client.send(payload)
+            client.receive_all()
+        elapsed = time.perf_counter() - start
+        throughput = 2 * BULK_SIZE * BULK_COUNT / elapsed / (1024 * 1024)
+        print(f"{name:<14} {latency * 1e6:>14.1f} {throughput:>16.1f}")
+    finally:
+        stop.set()
+        client.disconnect()
+        echo.join()
+        server.stop()
+
+
+def main():
+    print(f"{'transport':<14} {'round trip us':>14} {'echo MiB/s':>16}")
+    run("tcp loopback", TCPServer(HOST, PORT),
+        lambda: connected(TCPClient(HOST, PORT, timeout=10)))
+    if hasattr(socket, "AF_UNIX"):
+        path = os.path.join(tempfile.mkdtemp(), "bench.sock")
+        run("unix socket", TCPServer(unix_path=path),
+            lambda: connected(TCPClient(unix_path=path, timeout=10)))
+        shm_threshold = 64 * 1024
+        run("unix + shm", TCPServer(unix_path=path, shm_threshold=shm_threshold),
+            lambda: connected(TCPClient(unix_path=path, timeout=10, shm_threshold=shm_threshold)))
+    server = TCPServer(HOST, PORT)
+    run("socketpair", server, lambda: server.connect_local(timeout=10))
+
+
+def connected(client: TCPClient) -> TCPClient:
+    if not client.connect():
+        raise ConnectionError("Could not connect to the benchmark server")
+    return client
+
+
+if __name__ == "__main__":
+    main()
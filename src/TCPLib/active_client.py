@@ -0,0 +1,198 @@
+"""
+active_client.py
+Written by: Joshua Kitchen - 2024
+"""
+import logging
+import queue
+import socket
+import threading
+import time
+from typing import Callable, Generator
+
+from .message import Message
+from .message_queue import drain_queue
+from .tcp_client import TCPClient, MessageTooLarge
+from .shm import InvalidShmDescriptor
+from .utils import format_addr
+
+logger = logging.getLogger(__name__)
+
+
+class ActiveTCPClient(TCPClient):
+    """
+    A TCPClient which, once connected, is always listening for messages from the server. A background thread receives
+    every message as it arrives, the way ClientProcessor does on the server side, so messages pushed by the server do
+    not wait in the kernel's buffers until the application asks for them.
+
+    If on_message is given, it is called on the receive thread with each Message as it arrives. Otherwise messages
+    are put in msg_q (a new queue.Queue if None), which is read with pop_msg(), pop_msgs() and get_all_msg(). When
+    the connection is closed by the server or fails, a Message with size 0 and data None is delivered the same way;
+    disconnect() does not deliver one. Like a ClientProcessor, the client is disconnected if nothing arrives from the
+    server for timeout seconds.
+
+    send() and the other send methods can be called from any number of threads at once; each message is written
+    whole before the next one starts. The receive methods of TCPClient must not be used, since the receive thread
+    takes every message. Takes the same arguments as TCPClient otherwise.
+    """
+
+    # How often (in seconds) wait_acked() checks whether the receive thread has seen the acknowledgement
+    _ACK_POLL_INTERVAL = 0.01
+
+    def __init__(self, host: str = None, port: int = None, timeout: int = None,
+                 on_message: Callable[[Message], None] = None, msg_q: queue.Queue = None, **kwargs):
+        super().__init__(host, port, timeout, **kwargs)
+        self._on_message = on_message
+        if msg_q is not None:
+            self._messages = msg_q
+        else:
+            self._messages = queue.Queue()
+        self._send_lock = threading.Lock()
+        self._recv_thread = None
+        self._is_listening = False
+
+    def connect(self) -> bool:
+        """
+        Connects to the server like TCPClient.connect() and starts receiving in the background. Raises TimeoutError,
+        ConnectionError, and socket.gaierror. Returns False if server object refused the connection and True if the
+        connection was accepted.
+        """
+        if not super().connect():
+            return False
+        self._start_listening()
+        return True
+
+    def connect_socket(self, soc: socket.socket) -> bool:
+        """
+        Completes the connection handshake over a socket which is already connected to a server, like
+        TCPClient.connect_socket(), and starts receiving in the background. Returns False if server object refused the
+        connection and True if the connection was accepted. Raises TimeoutError, ConnectionError, and OSError.
+        """
+        if not super().connect_socket(soc):
+            return False
+        self._start_listening()
+        return True
+
+    def _start_listening(self):
+        self._is_listening = True
+        self._recv_thread = threading.Thread(target=self._receive_loop,
+                                             name=f"ActiveTCPClient-{format_addr(self._addr)}",
+                                             daemon=True)
+        self._recv_thread.start()
+
+    def _receive_loop(self):
+        while self._is_listening:
+            try:
+                msg = self.receive_all()
+            except (OSError, MessageTooLarge, InvalidShmDescriptor) as e:
+                if self._is_listening:
+                    logger.debug("Exception while receiving from %s", format_addr(self._addr), exc_info=e)
+                msg = Message(None, None)
+            if msg.data is None:  # Connection was closed
+                if self._is_listening:
+                    self._is_listening = False
+                    self._clean_up()
+                    self._deliver(Message(0, None))
+                return
+            self._deliver(msg)
+
+    def _deliver(self, msg: Message):
+        if self._on_message is None:
+            self._messages.put(msg)
+            return
+        try:
+            self._on_message(msg)
+        except Exception:
+            logger.exception("Exception in on_message callback for a message from %s", format_addr(self._addr))
+
+    def is_listening(self) -> bool:
+        """
+        Returns a boolean flag indicating whether the receive thread is running
+        """
+        return self._is_listening
+
+    def disconnect(self):
+        """
+        Stops the receive thread and disconnects from the server. If no connection is opened, this method does
+        nothing. Can be called from on_message.
+        """
+        self._is_listening = False
+        super().disconnect()
+        th = self._recv_thread
+        if th is not None and th is not threading.current_thread():
+            th.join()
+        self._recv_thread = None
+
+    def send_bytes(self, data: bytes):
+        """
+        Send all bytes of the data argument WITHOUT a header attached, whole, even while other threads are sending.
+        Returns True on successful transmission, False on failed transmission. Raises TimeoutError, ConnectionError,
+        socket.gaierror, and OSError.
+        """
+        self._send_lock.acquire()
+        try:
+            return super().send_bytes(data)
+        finally:
+            self._send_lock.release()
+
+    def send_buffers(self, buffers: list) -> bool:
+        """
+        Send all bytes of a list of bytes-like objects back to back WITHOUT a header attached, whole, even while other
+        threads are sending. Returns True on successful transmission, False on failed transmission. Raises
+        TimeoutError, ConnectionError, socket.gaierror, and OSError.
+        """
+        self._send_lock.acquire()
+        try:
+            return super().send_buffers(buffers)
+        finally:
+            self._send_lock.release()
+
+    def wait_acked(self, timeout: float = None) -> bool:
+        """
+        Waits until the server has acknowledged every spooled message, which the receive thread reads. Returns True if
+        every message was acknowledged, False if the timeout expired or the connection was closed first.
+        """
+        if self._spool is None:
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._spool.pending():
+            if not self._is_connected:
+                return False
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(self._ACK_POLL_INTERVAL)
+        return True
+
+    def pop_msg(self, block: bool = False, timeout: int = None) -> Message | None:
+        """
+        Get the next message in the queue. If block is True, this method will block until it can pop something from
+        the queue, else it will try to get a value and return None if queue is empty. If block is True and a timeout
+        is given, block until timeout expires and then return None if no item was received.
+        """
+        try:
+            return self._messages.get(block=block, timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def pop_msgs(self, max_count: int = 0, max_wait: float = 0) -> list[Message]:
+        """
+        Gets a batch of up to max_count messages (every queued message if max_count is zero) with a single lock
+        acquisition. If the queue is empty, waits up to max_wait seconds for a message to arrive, or forever if
+        max_wait is None. Returns a list of messages, which is empty if no message arrived in time.
+        """
+        return drain_queue(self._messages, max_count, max_wait)
+
+    def get_all_msg(self) -> Generator[Message, None, None]:
+        """
+        Generator for iterating over the queue until it is empty, taking messages from it in batches
+        """
+        while True:
+            batch = self.pop_msgs()
+            if not batch:
+                return
+            yield from batch
+
+    def has_messages(self) -> bool:
+        """
+        Returns a boolean flag indicating whether there are messages waiting in the queue
+        """
+        return not self._messages.empty()
@@ -0,0 +1,100 @@
+"""
+budget.py
+Written by: Joshua Kitchen - 2024
+"""
+import threading
+import time
+
+
+class MemoryBudget:
+    """
+    Thread-safe count of bytes held by received messages, shared by every client of a TCPServer. A receive takes the
+    size of its message from the budget before reading the message and the server gives it back when the message is
+    popped from the queue. When the budget is used up, receives wait for bytes to be given back instead of allocating
+    more, which pushes back on the clients through TCP. A limit of zero (or less) disables the budget but usage is
+    still counted.
+    """
+
+    def __init__(self, limit: int):
+        self._limit = limit
+        self._used = 0
+        self._peak = 0
+        self._waiting = 0
+        self._cond = threading.Condition()
+
+    def limit(self) -> int:
+        """
+        Returns the number of bytes the budget allows
+        """
+        return self._limit
+
+    def is_limited(self) -> bool:
+        """
+        Returns a boolean flag indicating whether the budget limits anything
+        """
+        return self._limit > 0
+
+    def used(self) -> int:
+        """
+        Returns the number of bytes currently taken from the budget
+        """
+        return self._used
+
+    def peak(self) -> int:
+        """
+        Returns the largest number of bytes which have been taken from the budget at once
+        """
+        return self._peak
+
+    def waiting(self) -> int:
+        """
+        Returns the number of receives currently waiting for budget
+        """
+        return self._waiting
+
+    def stats(self) -> dict:
+        """
+        Returns a dictionary with keys 'limit', 'used', 'peak' and 'waiting'
+        """
+        self._cond.acquire()
+        stats = {
+            "limit": self._limit,
+            "used": self._used,
+            "peak": self._peak,
+            "waiting": self._waiting,
+        }
+        self._cond.release()
+        return stats
+
+    def acquire(self, size: int, timeout: float = None) -> bool:
+        """
+        Takes size bytes from the budget, waiting until they are available. A request larger than the whole limit
+        waits until nothing else is in use. If timeout is given and the bytes are not available in time, returns
+        False without taking anything.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._cond.acquire()
+        if self._limit > 0:
+            self._waiting += 1
+            while self._used > 0 and self._used + size > self._limit:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self._waiting -= 1
+                    self._cond.release()
+                    return False
+                self._cond.wait(remaining)
+            self._waiting -= 1
+        self._used += size
+        if self._used > self._peak:
+            self._peak = self._used
+        self._cond.release()
+        return True
+
+    def release(self, size: int):
+        """
+        Gives size bytes back to the budget
+        """
+        self._cond.acquire()
+        self._used -= size
+        self._cond.notify_all()
+        self._cond.release()
@@ -0,0 +1,187 @@
+"""
+capture.py
+Written by: Joshua Kitchen - 2024
+
+Capture of the traffic a TCPServer receives, for replaying it later with replay.py. A capture file starts with MAGIC
+and holds one record per event, each a fixed size header followed by that many bytes of data:
+    kind (1 byte), wall clock time in seconds (8 byte float), client number (4 bytes), flags (1 byte), size (4 bytes)
+Client ids are only written once, in the CONNECT record which gives each client its number. FRAME records carry the
+message, SIZE_ONLY records only its size, and DISCONNECT records have no data. Records are appended through a
+buffered file, so recording a message costs a small copy rather than a system call.
+
+A capture file can be appended to by several server runs. Each CaptureWriter starts with a RUN_START record, which
+begins a new timeline and a new numbering of clients; replay.py replays the runs one after another, without the time
+that passed between them.
+"""
+import struct
+import threading
+import time
+from typing import Generator
+
+from .utils import MSG_FLAG_PRIORITY, MSG_FLAG_CONTROL
+
+MAGIC = b'TCPLCAP1'
+
+CONNECT = 1
+FRAME = 2
+SIZE_ONLY = 3
+DISCONNECT = 4
+RUN_START = 5
+
+_RECORD = struct.Struct('>BdIBI')
+# Flags worth keeping for a replay: priority, and control frames such as subscriptions
+_KEPT_FLAGS = MSG_FLAG_PRIORITY | MSG_FLAG_CONTROL
+
+
+class InvalidCapture(Exception):
+    pass
+
+
+class CaptureRecord:
+    """
+    Container class for one event read from a capture file. data is None for CONNECT, SIZE_ONLY, DISCONNECT and
+    RUN_START records, and client_id is None for RUN_START records.
+    """
+
+    def __init__(self, kind: int, timestamp: float, client_id: str, flags: int = 0, size: int = 0, data=None):
+        self.kind = kind
+        self.timestamp = timestamp
+        self.client_id = client_id
+        self.flags = flags
+        self.size = size
+        self.data = data
+
+
+class CaptureWriter:
+    """
+    Appends the events of a server to the capture file at path, creating it if needed. If keep_data is False, only the
+    size of each message is recorded, which keeps captures of bulky traffic small (a replay then sends zeros). Every
+    method is thread-safe. Records reach the disk when the buffer fills, on flush() and on close().
+    """
+
+    def __init__(self, path: str, keep_data: bool = True, buffer_size: int = 1024 * 1024):
+        self._path = path
+        self._keep_data = keep_data
+        self._lock = threading.Lock()
+        self._file = open(path, 'ab', buffering=buffer_size)
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self._file.write(_RECORD.pack(RUN_START, time.time(), 0, 0, 0))
+        self._clients = {}
+        self._next_number = 0
+        self._records = 1
+
+    def path(self) -> str:
+        return self._path
+
+    def records(self) -> int:
+        """
+        Returns the number of records written by this writer
+        """
+        return self._records
+
+    def _write(self, kind: int, client_id, flags: int, size: int, data=None):
+        # Called with the lock held
+        if self._file is None:
+            return
+        number = self._clients.get(client_id)
+        if number is None:
+            number = self._next_number
+            self._next_number += 1
+            self._clients[client_id] = number
+            name = str(client_id).encode()
+            self._file.write(_RECORD.pack(CONNECT, time.time(), number, 0, len(name)))
+            self._file.write(name)
+            self._records += 1
+            if kind == CONNECT:
+                return
+        self._file.write(_RECORD.pack(kind, time.time(), number, flags & _KEPT_FLAGS, size))
+        if data is not None:
+            self._file.write(data)
+        self._records += 1
+
+    def record_connect(self, client_id):
+        self._lock.acquire()
+        try:
+            self._write(CONNECT, client_id, 0, 0)
+        finally:
+            self._lock.release()
+
+    def record_frame(self, client_id, flags: int, data):
+        """
+        Records a message received from client_id with the given frame flags (see utils.py)
+        """
+        size = memoryview(data).nbytes
+        self._lock.acquire()
+        try:
+            if self._keep_data:
+                self._write(FRAME, client_id, flags, size, data)
+            else:
+                self._write(SIZE_ONLY, client_id, flags, size)
+        finally:
+            self._lock.release()
+
+    def record_disconnect(self, client_id):
+        self._lock.acquire()
+        try:
+            if client_id in self._clients:
+                self._write(DISCONNECT, client_id, 0, 0)
+                del self._clients[client_id]
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            if self._file is not None:
+                self._file.flush()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """
+        Writes out buffered records and closes the file. Later events are ignored.
+        """
+        self._lock.acquire()
+        try:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        finally:
+            self._lock.release()
+
+
+def read_capture(path: str) -> Generator[CaptureRecord, None, None]:
+    """
+    Generator over the records of a capture file, in the order they were written. A record cut short at the end of
+    the file, as left by a server which did not shut down cleanly, ends the capture. Raises InvalidCapture if the file
+    is not a capture file. In a file appended to by several server runs, each run starts with a RUN_START record and
+    clients still connected at the end of a run are not seen again.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise InvalidCapture(f"{path} is not a capture file")
+        names = {}
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+            kind, timestamp, number, flags, size = _RECORD.unpack(header)
+            if kind == RUN_START:
+                names = {}
+                yield CaptureRecord(RUN_START, timestamp, None)
+                continue
+            data = None
+            if kind in (CONNECT, FRAME):
+                data = f.read(size)
+                if len(data) < size:
+                    return
+            if kind == CONNECT:
+                names[number] = data.decode()
+                yield CaptureRecord(CONNECT, timestamp, names[number])
+                continue
+            if kind not in (FRAME, SIZE_ONLY, DISCONNECT) or number not in names:
+                raise InvalidCapture(f"Unexpected record in {path} at offset {f.tell() - _RECORD.size}")
+            yield CaptureRecord(kind, timestamp, names[number], flags, size, data)
+            if kind == DISCONNECT:
+                del names[number]
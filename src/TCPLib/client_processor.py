@@ -8,53 +8,173 @@ import socket
 import threading
 import queue
 
+from . import events
+from .budget import MemoryBudget
+from .capture import CaptureWriter
 from .message import Message
-from .tcp_client import TCPClient
+from .rate_limit import TokenBucket
+from .serialization import Codec
+from .shm import InvalidShmDescriptor
+from .socket_profiles import SocketProfile
+from .tcp_client import TCPClient, MessageTooLarge
+from .spool import encode_seq
+from .utils import encode_msg, format_addr, MSG_FLAG_CONTROL, MSG_FLAG_ACK
 
 logger = logging.getLogger(__name__)
 
 
+class _AckSender:
+    """
+    Sends acknowledgements for spooled messages on its own thread, so the receive loop never blocks writing them to a
+    client which is not reading. Acknowledgements are cumulative, so only the latest sequence number waiting is sent
+    and every one which arrives while a send is in progress is folded into the next.
+    """
+
+    def __init__(self, client_proc):
+        self._client_proc = client_proc
+        self._cond = threading.Condition()
+        self._seq = None
+        self._is_running = True
+        threading.Thread(target=self._send_loop, name=f"AckSender-{client_proc.id()}", daemon=True).start()
+
+    def ack(self, seq: int):
+        self._cond.acquire()
+        self._seq = seq
+        self._cond.notify()
+        self._cond.release()
+
+    def _send_loop(self):
+        while True:
+            self._cond.acquire()
+            while self._is_running and self._seq is None:
+                self._cond.wait()
+            if not self._is_running:
+                self._cond.release()
+                return
+            seq = self._seq
+            self._seq = None
+            self._cond.release()
+            try:
+                sent = self._client_proc.send_frame(encode_msg(encode_seq(seq), MSG_FLAG_ACK))
+            except OSError as e:
+                logger.debug("Could not acknowledge message %d from %s", seq,
+                             format_addr(self._client_proc.addr()), exc_info=e)
+                sent = False
+            if not sent:
+                return
+
+    def stop(self):
+        self._cond.acquire()
+        self._is_running = False
+        self._cond.notify()
+        self._cond.release()
+
+
 class ClientProcessor:
     """
-    Maintains a single client connection for the server.
+    Maintains a single client connection for the server. If buff_size is None, the receive chunk size comes from the
+    socket profile. If a rate_limiter is given, tokens equal to the size of each received message are taken from it
+    before the next message is read, which limits how many bytes per second the client can get into the queue.
+    shm_threshold and shm_dir enable shared memory messages (see TCPClient), with shm_token the token sent to the
+    client in the handshake (see shm.py). A client which sends a message larger than max_msg_size is disconnected. If
+    a budget is given, the size of each message is taken from it before the message is read and the server gives it
+    back when the message is popped from the queue. If capture is given, every message received, and the connect and
+    disconnect, are recorded to it (see capture.py).
+
+    Control frames from the client (such as pub/sub subscriptions) are handed to the server rather than queued.
+    Messages the client sent from a spool are acknowledged once they are in the queue, by a separate thread which
+    coalesces acknowledgements (see _AckSender). Sends
+    are serialized with a lock, since the server's pub/sub threads and the application may send to the same client at
+    once.
     """
 
     def __init__(self, client_id, client_soc: socket.socket, msg_q: queue.Queue, server_obj,
-                 buff_size=4096, timeout: int = None):
+                 buff_size: int = None, timeout: int = None, profile: str | SocketProfile = None,
+                 rate_limiter: TokenBucket = None, codec: str | Codec = None, shm_threshold: int = None,
+                 shm_dir: str = None, max_msg_size: int = None, budget: MemoryBudget = None,
+                 batch_window: float = None, batch_bytes: int = None, capture: CaptureWriter = None,
+                 shm_token: str = None):
         self._client_id = client_id
-        self._tcp_client = TCPClient.from_socket(client_soc)
+        self._tcp_client = TCPClient.from_socket(client_soc, profile, codec, shm_threshold, shm_dir, client_id,
+                                                 max_msg_size, budget, batch_window, batch_bytes, shm_token)
+        self._budget = budget
         self._tcp_client.set_timeout(timeout)
         self._msg_q = msg_q
         self._server_obj = server_obj
         self._buff_size = buff_size
+        self._send_lock = threading.Lock()
+        self._acker = None
+        self._rate_limiter = rate_limiter
+        self._capture = capture
+        self._is_running = False
+
+    def start(self):
+        """
+        Starts receiving messages from the client. The server registers the client processor before calling this so
+        that replies to the first message can always find it.
+        """
+        if self._is_running:
+            return
         self._is_running = True
+        events.RING.record(events.CONNECT, self._client_id)
+        if self._capture is not None:
+            self._capture.record_connect(self._client_id)
         th = threading.Thread(target=self._receive_loop)
         th.start()
-        logger.info(f"Processing %s @ %d as client #%s", self.addr()[0], self.addr()[1], self._client_id)
 
     def _receive_loop(self):
-        logger.debug("Client %s is listening for new messages from %s @ %d",
-                     self._client_id, self.addr()[0], self.addr()[1])
         while self._is_running:
             try:
                 msg = self._tcp_client.receive_all(self._buff_size)
             except ConnectionError as e:
-                logger.debug("Exception while receiving from %s @ %d", self._tcp_client.addr()[0],
-                             self._tcp_client.addr()[1], exc_info=e)
+                logger.debug("Exception while receiving from %s", format_addr(self._tcp_client.addr()),
+                             exc_info=e)
                 self.stop()
                 self._msg_q.put(Message(0, None, self._client_id))
                 return
             except OSError as e:
-                logger.debug("Exception while receiving from %s @ %d", self._tcp_client.addr()[0],
-                             self._tcp_client.addr()[1], exc_info=e)
+                logger.debug("Exception while receiving from %s", format_addr(self._tcp_client.addr()),
+                             exc_info=e)
+                events.RING.record_error(self._client_id)
+                self.stop()
+                self._msg_q.put(Message(0, None, self._client_id))
+                return
+            except MessageTooLarge as e:
+                logger.warning("Disconnecting %s: %s", format_addr(self._tcp_client.addr()), e)
+                events.RING.record_error(self._client_id)
+                self.stop()
+                self._msg_q.put(Message(0, None, self._client_id))
+                return
+            except InvalidShmDescriptor as e:
+                logger.error("Invalid shared memory message from %s", format_addr(self._tcp_client.addr()),
+                             exc_info=e)
+                events.RING.record_error(self._client_id)
                 self.stop()
                 self._msg_q.put(Message(0, None, self._client_id))
                 return
 
             msg.client_id = self._client_id
-            if msg.data is None:
+            if msg.data is None:  # Connection was closed
+                if self._is_running:
+                    self.stop()
+                    self._msg_q.put(Message(0, None, self._client_id))
+                return
+            if self._capture is not None:
+                self._capture.record_frame(self._client_id, self._tcp_client.recv_flags(), msg.data)
+            if self._tcp_client.recv_flags() & MSG_FLAG_CONTROL:
+                if self._budget is not None:
+                    self._budget.release(msg.size)
+                self._server_obj._on_control(self._client_id, msg.data)
                 continue
             self._msg_q.put(msg)
+            seq = self._tcp_client.recv_seq()
+            if seq is not None:
+                if self._acker is None:
+                    self._acker = _AckSender(self)
+                self._acker.ack(seq)
+            if self._rate_limiter is not None:
+                # Not reading from the socket while over the limit pushes back on the client through TCP
+                self._rate_limiter.consume(msg.size)
 
     def id(self) -> str:
         """
@@ -77,12 +197,60 @@ class ClientProcessor:
         """
         return self._tcp_client.set_timeout(timeout)
 
-    def send(self, data: bytes) -> bool:
+    def send(self, data: bytes, priority: bool = False) -> bool:
+        """
+        Send all bytes of the data argument with a header attached. If priority is True, the message is marked as
+        high priority. Returns True on successful transmission, False on failed transmission. Raises TimeoutError,
+        ConnectionError, socket.gaierror, and OSError.
+        """
+        self._send_lock.acquire()
+        try:
+            return self._tcp_client.send(data, priority)
+        finally:
+            self._send_lock.release()
+
+    def send_obj(self, obj, codec: str | Codec = None, priority: bool = False) -> bool:
+        """
+        Encodes obj with codec (the server's codec if None) and sends it to the client. Returns True on successful
+        transmission, False on failed transmission. Raises TimeoutError, ConnectionError, socket.gaierror, and
+        OSError.
+        """
+        self._send_lock.acquire()
+        try:
+            return self._tcp_client.send_obj(obj, codec, priority)
+        finally:
+            self._send_lock.release()
+
+    def send_frame(self, frame: bytes) -> bool:
+        """
+        Sends an already encoded frame (header included) to the client as it is. Returns True on successful
+        transmission, False on failed transmission. Raises TimeoutError, ConnectionError, socket.gaierror, and
+        OSError.
+        """
+        self._send_lock.acquire()
+        try:
+            return self._tcp_client.send_bytes(frame)
+        finally:
+            self._send_lock.release()
+
+    def flush(self) -> bool:
+        """
+        Writes the frames waiting to be coalesced immediately. Returns True on successful transmission, False on failed
+        transmission. Raises TimeoutError, ConnectionError, socket.gaierror, and OSError.
+        """
+        return self._tcp_client.flush()
+
+    def batch_stats(self) -> dict | None:
+        """
+        Returns the statistics of coalesced sends to the client, or None if sends are not coalesced
+        """
+        return self._tcp_client.batch_stats()
+
+    def shm_enabled(self) -> bool:
         """
-        Send all bytes of the data argument with a header attached. Returns True on successful transmission,
-        False on failed transmission. Raises TimeoutError, ConnectionError, socket.gaierror, and OSError.
+        Returns a boolean flag indicating whether large messages are sent to the client through shared memory
         """
-        return self._tcp_client.send(data)
+        return self._tcp_client.shm_enabled()
 
     def addr(self) -> tuple[str, int]:
         """
@@ -109,5 +277,9 @@ class ClientProcessor:
         """
         if self._is_running:
             self._is_running = False
+            if self._acker is not None:
+                self._acker.stop()
             self._tcp_client.disconnect()
-            logger.info(f"Client %s has been stopped.", self._client_id)
+            events.RING.record(events.DISCONNECT, self._client_id)
+            if self._capture is not None:
+                self._capture.record_disconnect(self._client_id)
@@ -0,0 +1,157 @@
+"""
+coalesce.py
+Written by: Joshua Kitchen - 2024
+
+Write coalescing for connections which send many small frames. Instead of every frame becoming its own system call
+and TCP segment, frames are held for at most a short window and written together with one vectored write.
+"""
+import threading
+import time
+
+# Defaults used when only one of the window and the byte threshold is given
+DEFAULT_BATCH_WINDOW = 0.0002
+DEFAULT_BATCH_BYTES = 64 * 1024
+
+
+class WriteCoalescer:
+    """
+    Collects frames and writes them in batches through write, a function which takes a list of bytes-like objects and
+    writes all of them or raises OSError. A batch is written once the oldest frame in it has waited window seconds,
+    or as soon as max_bytes bytes are waiting, whichever comes first. Frames of max_bytes or more are written straight
+    away, together with anything waiting ahead of them. Frames are always written in the order they were added.
+
+    Frames are copied when added, so callers may reuse their buffers as soon as add() returns. If a write made by the
+    background thread fails, on_error is called with the exception and the coalescer stops.
+    """
+
+    def __init__(self, write, window: float = None, max_bytes: int = None, on_error=None, name: str = None):
+        self._write = write
+        self._window = window if window is not None else DEFAULT_BATCH_WINDOW
+        self._max_bytes = max_bytes if max_bytes is not None else DEFAULT_BATCH_BYTES
+        if self._window < 0 or self._max_bytes <= 0:
+            raise ValueError("window cannot be negative and max_bytes must be positive")
+        self._on_error = on_error
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()  # Held while a batch is taken and written, which keeps batches in order
+        self._pending = []
+        self._pending_bytes = 0
+        self._pending_frames = 0
+        self._first_at = None  # When the oldest waiting frame was added
+        self._batches = 0
+        self._frames = 0
+        self._bytes = 0
+        self._max_frames = 0
+        self._is_running = True
+        threading.Thread(target=self._flush_loop, name=name or "WriteCoalescer", daemon=True).start()
+
+    def window(self) -> float:
+        return self._window
+
+    def max_bytes(self) -> int:
+        return self._max_bytes
+
+    def add(self, buffers: list):
+        """
+        Adds a frame made of a list of bytes-like objects. Raises OSError if a write made to make room fails.
+        """
+        size = sum(memoryview(buf).nbytes for buf in buffers)
+        if size >= self._max_bytes:
+            self._flush(buffers, 1)
+            return
+        self._cond.acquire()
+        self._pending.extend(bytes(buf) for buf in buffers)
+        self._pending_bytes += size
+        self._pending_frames += 1
+        if self._first_at is None:
+            self._first_at = time.monotonic()
+            self._cond.notify()
+        full = self._pending_bytes >= self._max_bytes
+        self._cond.release()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes every waiting frame now. Raises OSError if the write fails.
+        """
+        self._flush([], 0)
+
+    def _flush(self, extra: list, extra_frames: int):
+        self._write_lock.acquire()
+        try:
+            self._cond.acquire()
+            buffers = self._pending
+            frames = self._pending_frames
+            self._pending = []
+            self._pending_bytes = 0
+            self._pending_frames = 0
+            self._first_at = None
+            self._cond.release()
+            if extra:
+                buffers.extend(extra)
+                frames += extra_frames
+            if not buffers:
+                return
+            self._write(buffers)
+            self._cond.acquire()
+            self._batches += 1
+            self._frames += frames
+            self._bytes += sum(memoryview(buf).nbytes for buf in buffers)
+            if frames > self._max_frames:
+                self._max_frames = frames
+            self._cond.release()
+        finally:
+            self._write_lock.release()
+
+    def _flush_loop(self):
+        while True:
+            self._cond.acquire()
+            while self._is_running and self._first_at is None:
+                self._cond.wait()
+            if not self._is_running:
+                self._cond.release()
+                return
+            wait = self._first_at + self._window - time.monotonic()
+            self._cond.release()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                self.flush()
+            except OSError as e:
+                self._cond.acquire()
+                was_running = self._is_running
+                self._is_running = False
+                self._cond.release()
+                if was_running and self._on_error is not None:
+                    self._on_error(e)
+                return
+
+    def stats(self) -> dict:
+        """
+        Returns a dictionary with the number of batches written, the frames and bytes in them, the average and largest
+        number of frames per batch, and the number of frames currently waiting
+        """
+        self._cond.acquire()
+        stats = {
+            "batches": self._batches,
+            "frames": self._frames,
+            "bytes": self._bytes,
+            "avg_frames": self._frames / self._batches if self._batches else 0.0,
+            "max_frames": self._max_frames,
+            "pending": self._pending_frames,
+        }
+        self._cond.release()
+        return stats
+
+    def close(self):
+        """
+        Stops the background thread. Frames still waiting are dropped; call flush() first to write them.
+        """
+        self._cond.acquire()
+        self._is_running = False
+        self._pending = []
+        self._pending_bytes = 0
+        self._pending_frames = 0
+        self._first_at = None
+        self._cond.notify()
+        self._cond.release()
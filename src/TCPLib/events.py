@@ -0,0 +1,190 @@
+"""
+events.py
+Written by: Joshua Kitchen - 2024
+
+A fixed-size ring buffer of structured events (timestamp, client id, event type, size) which the library records on
+the hot path instead of logging every message. The buffer can be read with snapshot(), dumped with format_events(),
+drained by a background logging handler (see log_util.EventDrain) and is written to the log when an error is recorded
+if dump_on_error is set.
+
+Recording is off by default. Turn it on with RING.set_enabled(True) or RING.configure(), or by starting an
+EventDrain. While it is off, recording an event costs a single attribute check.
+"""
+import collections
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+ACCEPT = 1
+REJECT = 2
+CONNECT = 3
+DISCONNECT = 4
+SEND = 5
+RECV = 6
+ERROR = 7
+
+EVENT_NAMES = {
+    ACCEPT: "accept",
+    REJECT: "reject",
+    CONNECT: "connect",
+    DISCONNECT: "disconnect",
+    SEND: "send",
+    RECV: "recv",
+    ERROR: "error",
+}
+
+Event = collections.namedtuple("Event", ["timestamp", "client_id", "event", "size"])
+
+
+class EventRing:
+    """
+    Preallocated ring buffer holding the last capacity events. Once full, the oldest events are overwritten.
+
+    record() always records an event and is used for connection events. sample() is used for per-message events and
+    only records one in every sample_every calls. Recording an event reads the clock and takes a lock shared by every
+    thread in the process for a single store, so at high message rates raise sample_every to keep per-message events
+    cheap. A disabled ring returns before taking the lock.
+    """
+
+    def __init__(self, capacity: int = 4096, sample_every: int = 1, enabled: bool = True,
+                 dump_on_error: bool = False):
+        self._lock = threading.Lock()
+        self.configure(capacity, sample_every, enabled, dump_on_error)
+
+    def configure(self, capacity: int = 4096, sample_every: int = 1, enabled: bool = True,
+                  dump_on_error: bool = False):
+        """
+        Sets the size and sampling of the buffer and clears it. sample_every must be at least 1. If dump_on_error is
+        True, the whole buffer is logged when an error is recorded.
+        """
+        if capacity <= 0:
+            raise ValueError("capacity must be a positive integer")
+        if sample_every < 1:
+            raise ValueError("sample_every must be at least 1")
+        self._lock.acquire()
+        self._capacity = capacity
+        self._sample_every = sample_every
+        self._enabled = enabled
+        self.dump_on_error = dump_on_error
+        self._slots = [None] * capacity
+        self._sampled = itertools.count()
+        self._head = 0  # Number of events recorded so far
+        self._read = 0  # Number of events handed out by drain()
+        self._dropped = 0
+        self._lock.release()
+
+    def capacity(self) -> int:
+        """
+        Returns the number of events the buffer holds
+        """
+        return self._capacity
+
+    def sample_every(self) -> int:
+        """
+        Returns how many per-message events are seen for each one recorded
+        """
+        return self._sample_every
+
+    def is_enabled(self) -> bool:
+        """
+        Returns a boolean flag indicating whether events are being recorded
+        """
+        return self._enabled
+
+    def set_enabled(self, enabled: bool):
+        """
+        Starts or stops recording events. The buffer is not cleared.
+        """
+        self._enabled = enabled
+
+    def record(self, event: int, client_id=None, size: int = 0):
+        """
+        Records an event
+        """
+        if not self._enabled:
+            return
+        self._lock.acquire()
+        self._slots[self._head % self._capacity] = (time.time(), client_id, event, size)
+        self._head += 1
+        self._lock.release()
+
+    def sample(self, event: int, client_id=None, size: int = 0):
+        """
+        Records one in every sample_every events passed to it
+        """
+        if not self._enabled:
+            return
+        if self._sample_every > 1 and next(self._sampled) % self._sample_every:
+            return
+        self.record(event, client_id, size)
+
+    def record_error(self, client_id=None, size: int = 0):
+        """
+        Records an error event and, if dump_on_error is set, logs the contents of the buffer
+        """
+        self.record(ERROR, client_id, size)
+        if self.dump_on_error:
+            logger.error("Recent events before error on client %s:\n%s", client_id, format_events(self.snapshot()))
+
+    def _copy(self, start: int, end: int) -> list:
+        # Called with the lock held, so the slots are copied before any of them can be overwritten
+        return [self._slots[i % self._capacity] for i in range(start, end)]
+
+    def snapshot(self) -> list[Event]:
+        """
+        Returns the events in the buffer, oldest first, without removing them
+        """
+        self._lock.acquire()
+        slots = self._copy(max(0, self._head - self._capacity), self._head)
+        self._lock.release()
+        return [Event(*slot) for slot in slots]
+
+    def drain(self) -> list[Event]:
+        """
+        Returns the events recorded since the last call to drain(), oldest first. Events which were overwritten
+        before they could be drained are counted by dropped().
+        """
+        self._lock.acquire()
+        head = self._head
+        start = max(self._read, head - self._capacity)
+        self._dropped += start - self._read
+        self._read = head
+        slots = self._copy(start, head)
+        self._lock.release()
+        return [Event(*slot) for slot in slots]
+
+    def dropped(self) -> int:
+        """
+        Returns the number of events overwritten before drain() could return them
+        """
+        return self._dropped
+
+    def clear(self):
+        """
+        Removes all events from the buffer
+        """
+        self.configure(self._capacity, self._sample_every, self._enabled, self.dump_on_error)
+
+
+def format_event(event: Event) -> str:
+    """
+    Returns a single line describing an event
+    """
+    stamp = time.strftime("%H:%M:%S", time.localtime(event.timestamp))
+    millis = int((event.timestamp % 1) * 1000)
+    name = EVENT_NAMES.get(event.event, str(event.event))
+    return f"{stamp}.{millis:03d} {name:<10} client={event.client_id} size={event.size}"
+
+
+def format_events(events: list[Event]) -> str:
+    """
+    Returns events formatted one per line
+    """
+    return "\n".join(format_event(event) for event in events)
+
+
+# The ring the library records into. Use RING.configure() to turn it on and change its size or sampling.
+RING = EventRing(enabled=False)
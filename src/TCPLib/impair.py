@@ -0,0 +1,355 @@
+"""
+impair.py
+Written by: Joshua Kitchen - 2024
+
+TCP proxy which sits between a TCPClient and a TCPServer and impairs the traffic passing through it, so that latency,
+bandwidth and packet pacing effects which loopback hides (Nagle stalls, slow consumer backlogs, timeouts) show up in
+local tests and benchmarks. Every connection accepted by the proxy is forwarded to the target address, and each
+direction of it can be given:
+    - latency and jitter: every chunk read is delivered latency +/- jitter seconds later, without reordering
+    - bandwidth: bytes per second the direction is capped at
+    - max_write: the largest single write, so the receiver sees the stream in small fragments
+    - reset_after: number of bytes after which the connection is reset (RST) instead of closed
+
+Usage:
+    proxy = ImpairmentProxy((host, port), latency=0.02, bandwidth=1024 * 1024)
+    proxy.start()
+    client = TCPClient(*proxy.addr())
+"""
+import collections
+import logging
+import random
+import socket
+import struct
+import threading
+import time
+
+from .rate_limit import TokenBucket
+from .utils import format_addr
+
+logger = logging.getLogger(__name__)
+
+_CHUNK_SIZE = 64 * 1024
+_EOF = None
+
+
+class _Pipe:
+    """
+    Forwards one direction of a proxied connection. A reader thread stamps each chunk with the time it is due and a
+    writer thread delivers it then, paced by the bandwidth limit and split into writes of at most max_write bytes.
+    """
+
+    def __init__(self, conn, src: socket.socket, dst: socket.socket, name: str):
+        self._conn = conn
+        self._src = src
+        self._dst = dst
+        self._chunks = collections.deque()
+        self._cond = threading.Condition()
+        self._last_due = 0.0
+        self._bucket = None
+        threading.Thread(target=self._read_loop, name=f"{name}-reader", daemon=True).start()
+        threading.Thread(target=self._write_loop, name=f"{name}-writer", daemon=True).start()
+
+    def _put(self, chunk):
+        proxy = self._conn.proxy
+        delay = proxy.latency
+        if proxy.jitter > 0:
+            delay += proxy.rng.uniform(-proxy.jitter, proxy.jitter)
+        # Chunks are never delivered before the one ahead of them, so jitter cannot reorder the stream
+        due = max(self._last_due, time.monotonic() + max(delay, 0))
+        self._last_due = due
+        self._cond.acquire()
+        self._chunks.append((due, chunk))
+        self._cond.notify()
+        self._cond.release()
+
+    def _read_loop(self):
+        while True:
+            try:
+                chunk = self._src.recv(_CHUNK_SIZE)
+            except OSError:
+                self._conn.close()
+                return
+            if not chunk:
+                self._put(_EOF)
+                return
+            self._put(chunk)
+
+    def _write_loop(self):
+        while True:
+            self._cond.acquire()
+            while not self._chunks and not self._conn.is_closed():
+                self._cond.wait(0.25)
+            if self._conn.is_closed():
+                self._cond.release()
+                return
+            due, chunk = self._chunks.popleft()
+            self._cond.release()
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            if chunk is _EOF:
+                self._conn.shutdown(self._dst)
+                return
+            if not self._write(chunk):
+                self._conn.close()
+                return
+
+    def _write(self, chunk: bytes) -> bool:
+        view = memoryview(chunk)
+        proxy = self._conn.proxy
+        step = proxy.write_size()
+        if self._bucket is None or self._bucket.rate() != proxy.bandwidth:
+            self._bucket = TokenBucket(proxy.bandwidth, step)
+        while view.nbytes:
+            piece = view[:self._conn.allowance(step)]
+            if not piece.nbytes:
+                logger.debug("Resetting proxied connection after %d bytes", proxy.reset_after)
+                self._conn.reset()
+                return False
+            self._bucket.consume(piece.nbytes)
+            try:
+                self._dst.sendall(piece)
+            except OSError:
+                return False
+            self._conn.count(piece.nbytes)
+            view = view[piece.nbytes:]
+        return True
+
+    def wake(self):
+        self._cond.acquire()
+        self._cond.notify()
+        self._cond.release()
+
+
+class _ProxyConnection:
+    def __init__(self, proxy, client_soc: socket.socket, upstream_soc: socket.socket, conn_id: int):
+        self.proxy = proxy
+        self._client_soc = client_soc
+        self._upstream_soc = upstream_soc
+        self._lock = threading.Lock()
+        self._closed = False
+        self._shut = 0
+        self._forwarded = 0
+        self._pipes = []
+        self._pipes.append(_Pipe(self, client_soc, upstream_soc, f"ImpairmentProxy-{conn_id}-up"))
+        self._pipes.append(_Pipe(self, upstream_soc, client_soc, f"ImpairmentProxy-{conn_id}-down"))
+
+    def is_closed(self) -> bool:
+        return self._closed
+
+    def allowance(self, size: int) -> int:
+        """
+        Returns how many of the next size bytes may be forwarded before the connection has to be reset
+        """
+        if self.proxy.reset_after <= 0:
+            return size
+        return max(0, min(size, self.proxy.reset_after - self._forwarded))
+
+    def count(self, size: int):
+        self._lock.acquire()
+        self._forwarded += size
+        self._lock.release()
+
+    def shutdown(self, soc: socket.socket):
+        # Passes an orderly close on in one direction. The connection is closed once both directions are done.
+        try:
+            soc.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        self._lock.acquire()
+        self._shut += 1
+        done = self._shut == 2
+        self._lock.release()
+        if done:
+            self.close()
+
+    def reset(self):
+        """
+        Closes both sides with an RST instead of an orderly close
+        """
+        for soc in (self._client_soc, self._upstream_soc):
+            try:
+                soc.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            except OSError:
+                pass
+        self.close(socket.SHUT_RD)
+
+    def close(self, how: int = socket.SHUT_RDWR):
+        self._lock.acquire()
+        if self._closed:
+            self._lock.release()
+            return
+        self._closed = True
+        self._lock.release()
+        for soc in (self._client_soc, self._upstream_soc):
+            # close() alone neither wakes a reader blocked on the socket nor, while one is, tells the peer. With
+            # SHUT_RD nothing is sent, so a reset still goes out as an RST when the socket is closed.
+            try:
+                soc.shutdown(how)
+            except OSError:
+                pass
+            soc.close()
+        for pipe in self._pipes:
+            pipe.wake()
+        self.proxy._remove_connection(self)
+
+
+class ImpairmentProxy:
+    """
+    Forwards connections accepted on listen_host:listen_port (a free port if listen_port is 0) to target, a (host,
+    port) tuple, with the impairments described in the module docstring applied to both directions. latency and jitter
+    are in seconds, bandwidth in bytes per second (0 for no limit), max_write and reset_after in bytes (0 to disable).
+    seed makes the jitter reproducible. Impairments can be changed while the proxy is running with configure() and
+    apply to data read after the change.
+    """
+
+    # How often (in seconds) the accept thread wakes up to check whether the proxy has been stopped
+    _ACCEPT_POLL_INTERVAL = 0.25
+    # Largest write made when neither max_write nor bandwidth asks for smaller ones
+    _MAX_WRITE = 64 * 1024
+
+    def __init__(self, target: tuple[str, int], listen_host: str = "127.0.0.1", listen_port: int = 0,
+                 latency: float = 0.0, jitter: float = 0.0, bandwidth: float = 0, max_write: int = 0,
+                 reset_after: int = 0, seed: int = None):
+        self._target = target
+        self._listen_addr = (listen_host, listen_port)
+        self.rng = random.Random(seed)
+        self.latency = 0.0
+        self.jitter = 0.0
+        self.bandwidth = 0
+        self.max_write = 0
+        self.reset_after = 0
+        self.configure(latency, jitter, bandwidth, max_write, reset_after)
+        self._soc = None
+        self._is_running = False
+        self._connections = set()
+        self._connections_lock = threading.Lock()
+        self._next_id = 0
+
+    def configure(self, latency: float = 0.0, jitter: float = 0.0, bandwidth: float = 0, max_write: int = 0,
+                  reset_after: int = 0):
+        """
+        Sets the impairments. Raises ValueError if any of them is negative.
+        """
+        if min(latency, jitter, bandwidth, max_write, reset_after) < 0:
+            raise ValueError("Impairments cannot be negative")
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.max_write = max_write
+        self.reset_after = reset_after
+
+    def write_size(self) -> int:
+        """
+        Returns the largest number of bytes written to a socket at once
+        """
+        size = self._MAX_WRITE
+        if self.max_write > 0:
+            size = min(size, self.max_write)
+        if self.bandwidth > 0:
+            # Keeps writes small enough for the pacing to stay smooth
+            size = min(size, max(int(self.bandwidth / 100), 1))
+        return size
+
+    def addr(self) -> tuple[str, int]:
+        """
+        Returns the (host, port) the proxy is listening on, which clients connect to instead of the target
+        """
+        if self._soc is None:
+            return self._listen_addr
+        return self._soc.getsockname()[:2]
+
+    def target(self) -> tuple[str, int]:
+        return self._target
+
+    def is_running(self) -> bool:
+        return self._is_running
+
+    def connection_count(self) -> int:
+        """
+        Returns the number of connections currently being proxied
+        """
+        self._connections_lock.acquire()
+        count = len(self._connections)
+        self._connections_lock.release()
+        return count
+
+    def start(self) -> bool:
+        """
+        Starts listening. Returns True on success, False if the proxy is already running or could not bind.
+        """
+        if self._is_running:
+            return False
+        self._soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self._soc.bind(self._listen_addr)
+            self._soc.listen()
+        except OSError:
+            logger.exception("Could not listen on %s", format_addr(self._listen_addr))
+            self._soc.close()
+            self._soc = None
+            return False
+        self._soc.settimeout(self._ACCEPT_POLL_INTERVAL)
+        self._is_running = True
+        threading.Thread(target=self._accept_loop, args=(self._soc,), name="ImpairmentProxy-accept",
+                         daemon=True).start()
+        logger.info("Proxying %s to %s", format_addr(self.addr()), format_addr(self._target))
+        return True
+
+    def _accept_loop(self, listen_soc: socket.socket):
+        while self._is_running:
+            try:
+                client_soc, _ = listen_soc.accept()
+            except TimeoutError:
+                continue
+            except OSError:
+                return
+            try:
+                upstream_soc = socket.create_connection(self._target)
+            except OSError:
+                logger.warning("Could not connect to %s", format_addr(self._target), exc_info=True)
+                client_soc.close()
+                continue
+            client_soc.settimeout(None)
+            for soc in (client_soc, upstream_soc):
+                # The proxy itself should not batch small writes; only the configured impairments apply
+                soc.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._connections_lock.acquire()
+            self._next_id += 1
+            conn = _ProxyConnection(self, client_soc, upstream_soc, self._next_id)
+            self._connections.add(conn)
+            self._connections_lock.release()
+
+    def _remove_connection(self, conn: _ProxyConnection):
+        self._connections_lock.acquire()
+        self._connections.discard(conn)
+        self._connections_lock.release()
+
+    def reset_all(self):
+        """
+        Resets every connection currently being proxied
+        """
+        self._connections_lock.acquire()
+        conns = list(self._connections)
+        self._connections_lock.release()
+        for conn in conns:
+            conn.reset()
+
+    def stop(self):
+        """
+        Stops listening and closes every proxied connection. If the proxy is not running, this method will do
+        nothing.
+        """
+        if not self._is_running:
+            return
+        self._is_running = False
+        self._soc.close()
+        self._soc = None
+        self._connections_lock.acquire()
+        conns = list(self._connections)
+        self._connections_lock.release()
+        for conn in conns:
+            conn.close()
+        logger.info("Proxy to %s has been stopped", format_addr(self._target))
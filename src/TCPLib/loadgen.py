@@ -0,0 +1,323 @@
+"""
+loadgen.py
+Written by: Joshua Kitchen - 2024
+
+Load generator for stress-testing a TCPServer. Opens a number of concurrent TCPClients (one thread each), sends
+messages drawn from a size distribution either as fast as possible, at a fixed rate, or with open-loop (Poisson)
+arrivals, and reports connection success rate, throughput and latency percentiles at a regular interval.
+
+Usage:
+    python -m TCPLib.loadgen HOST PORT [-c CLIENTS] [-d DURATION] [-s SIZE] [-r RATE] [--open-loop] [--echo]
+
+Size distributions are given as 'fixed:N', 'uniform:MIN:MAX', 'exp:MEAN' or 'choice:N1,N2,...'.
+"""
+import argparse
+import logging
+import math
+import random
+import sys
+import threading
+import time
+
+from .tcp_client import TCPClient
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidSizeDistribution(Exception):
+    pass
+
+
+def parse_size_dist(spec: str):
+    """
+    Parses a size distribution spec and returns a function which takes a random.Random object and returns a message
+    size in bytes. Raises InvalidSizeDistribution if the spec cannot be parsed.
+    """
+    kind, _, args = spec.partition(':')
+    try:
+        if kind == 'fixed':
+            size = int(args)
+            if size < 0:
+                raise ValueError
+            return lambda rng: size
+        elif kind == 'uniform':
+            low, high = (int(x) for x in args.split(':'))
+            if low < 0 or high < low:
+                raise ValueError
+            return lambda rng: rng.randint(low, high)
+        elif kind == 'exp':
+            mean = float(args)
+            if mean <= 0:
+                raise ValueError
+            return lambda rng: int(rng.expovariate(1 / mean))
+        elif kind == 'choice':
+            sizes = [int(x) for x in args.split(',')]
+            if not sizes or min(sizes) < 0:
+                raise ValueError
+            return lambda rng: rng.choice(sizes)
+    except ValueError:
+        pass
+    raise InvalidSizeDistribution(f"Could not parse size distribution '{spec}'")
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    """
+    Returns the pct-th percentile (0-100) of an already sorted list using the nearest-rank method. Returns 0.0 for an
+    empty list.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(pct / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[rank]
+
+
+class LoadStats:
+    """
+    Thread-safe collector for load generator results. Counters are kept both for the current reporting interval and
+    for the whole run.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._interval_start = self._start
+        self._conn_attempts = 0
+        self._conn_successes = 0
+        self._total_msgs = 0
+        self._total_bytes = 0
+        self._total_errors = 0
+        self._total_latencies = []
+        self._msgs = 0
+        self._bytes = 0
+        self._errors = 0
+        self._latencies = []
+
+    def record_connect(self, success: bool):
+        self._lock.acquire()
+        self._conn_attempts += 1
+        if success:
+            self._conn_successes += 1
+        self._lock.release()
+
+    def record_msg(self, size: int, latency: float):
+        self._lock.acquire()
+        self._msgs += 1
+        self._bytes += size
+        self._latencies.append(latency)
+        self._lock.release()
+
+    def record_error(self):
+        self._lock.acquire()
+        self._errors += 1
+        self._lock.release()
+
+    @staticmethod
+    def _report(elapsed, attempts, successes, msgs, num_bytes, errors, latencies) -> dict:
+        latencies = sorted(latencies)
+        elapsed = max(elapsed, 1e-9)
+        return {
+            "elapsed": elapsed,
+            "conn_attempts": attempts,
+            "conn_successes": successes,
+            "conn_success_rate": successes / attempts if attempts else 0.0,
+            "msgs": msgs,
+            "bytes": num_bytes,
+            "errors": errors,
+            "msgs_per_sec": msgs / elapsed,
+            "bytes_per_sec": num_bytes / elapsed,
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1] if latencies else 0.0,
+        }
+
+    def interval_report(self) -> dict:
+        """
+        Returns a report for the interval since the last call and starts a new interval.
+        """
+        self._lock.acquire()
+        now = time.perf_counter()
+        report = self._report(now - self._interval_start, self._conn_attempts, self._conn_successes,
+                              self._msgs, self._bytes, self._errors, self._latencies)
+        report["time"] = now - self._start
+        self._total_msgs += self._msgs
+        self._total_bytes += self._bytes
+        self._total_errors += self._errors
+        self._total_latencies.extend(self._latencies)
+        self._msgs = 0
+        self._bytes = 0
+        self._errors = 0
+        self._latencies = []
+        self._interval_start = now
+        self._lock.release()
+        return report
+
+    def total_report(self) -> dict:
+        """
+        Returns a report covering the whole run, including the current interval.
+        """
+        self._lock.acquire()
+        report = self._report(time.perf_counter() - self._start, self._conn_attempts, self._conn_successes,
+                              self._total_msgs + self._msgs, self._total_bytes + self._bytes,
+                              self._total_errors + self._errors, self._total_latencies + self._latencies)
+        self._lock.release()
+        return report
+
+
+class LoadGenerator:
+    """
+    Drives a number of concurrent TCPClients against a server.
+
+    If rate is zero, each client sends in a closed loop as fast as possible. Otherwise each client sends rate messages
+    per second, either on a fixed schedule or, with open_loop=True, with exponentially distributed gaps (Poisson
+    arrivals). In open-loop mode latency is measured from the scheduled send time so a stalled server is not hidden by
+    the clients slowing down. If echo is True, each message waits for a reply from the server and the latency is the
+    full round trip, otherwise it is the time taken to hand the message to the socket.
+    """
+
+    def __init__(self, host: str, port: int, clients: int = 1, duration: float = 10, size_dist: str = 'fixed:1024',
+                 rate: float = 0, open_loop: bool = False, echo: bool = False, timeout: int = None,
+                 report_interval: float = 1, seed: int = None):
+        self._addr = (host, port)
+        self._num_clients = clients
+        self._duration = duration
+        self._size_func = parse_size_dist(size_dist)
+        self._rate = rate
+        self._open_loop = open_loop
+        self._echo = echo
+        self._timeout = timeout
+        self._report_interval = report_interval
+        self._seed = seed
+        self._stats = LoadStats()
+        self._stop_event = threading.Event()
+
+    def stats(self) -> LoadStats:
+        """
+        Returns the LoadStats object results are being collected in
+        """
+        return self._stats
+
+    def stop(self):
+        """
+        Stops a running load test before its duration has elapsed.
+        """
+        self._stop_event.set()
+
+    def _next_gap(self, rng: random.Random) -> float:
+        if self._rate <= 0:
+            return 0.0
+        if self._open_loop:
+            return rng.expovariate(self._rate)
+        return 1 / self._rate
+
+    def _client_loop(self, index: int, deadline: float):
+        rng = random.Random(None if self._seed is None else self._seed + index)
+        client = TCPClient(self._addr[0], self._addr[1], self._timeout)
+        try:
+            connected = client.connect()
+        except OSError:
+            connected = False
+        self._stats.record_connect(connected)
+        if not connected:
+            return
+        # One buffer per client, at least as large as the largest message so far; each message is a slice of it
+        payload = b''
+        next_send = time.perf_counter()
+        try:
+            while not self._stop_event.is_set():
+                if self._rate > 0:
+                    now = time.perf_counter()
+                    if next_send > now:
+                        if self._stop_event.wait(next_send - now):
+                            break
+                if time.perf_counter() >= deadline:
+                    break
+                size = self._size_func(rng)
+                if size > len(payload):
+                    payload = rng.randbytes(max(size, 2 * len(payload)))
+                start = next_send if (self._open_loop and self._rate > 0) else time.perf_counter()
+                if not client.send(memoryview(payload)[:size]):
+                    self._stats.record_error()
+                    break
+                if self._echo:
+                    reply = client.receive_all()
+                    if reply.data is None:
+                        self._stats.record_error()
+                        break
+                self._stats.record_msg(size, time.perf_counter() - start)
+                next_send += self._next_gap(rng)
+        except OSError as e:
+            logger.debug("Load generator client %d failed", index, exc_info=e)
+            self._stats.record_error()
+        finally:
+            client.disconnect()
+
+    def run(self, on_report=None) -> dict:
+        """
+        Runs the load test and blocks until it is finished. If on_report is given, it is called with an interval
+        report every report_interval seconds. Returns a report covering the whole run.
+        """
+        deadline = time.perf_counter() + self._duration
+        threads = []
+        for i in range(self._num_clients):
+            th = threading.Thread(target=self._client_loop, args=[i, deadline], daemon=True)
+            th.start()
+            threads.append(th)
+        while any(th.is_alive() for th in threads):
+            if self._stop_event.wait(self._report_interval):
+                break
+            if on_report is not None:
+                on_report(self._stats.interval_report())
+        self._stop_event.set()
+        for th in threads:
+            th.join()
+        return self._stats.total_report()
+
+
+def format_report(report: dict) -> str:
+    """
+    Formats a report from LoadStats as a single line of text.
+    """
+    prefix = f"t={report['time']:7.1f}s " if "time" in report else "total     "
+    return (f"{prefix}conns {report['conn_successes']}/{report['conn_attempts']} "
+            f"({report['conn_success_rate'] * 100:.1f}%)  "
+            f"msgs {report['msgs']} ({report['msgs_per_sec']:.1f}/s)  "
+            f"{report['bytes_per_sec'] / 1e6:.2f} MB/s  "
+            f"errors {report['errors']}  "
+            f"latency ms p50 {report['p50'] * 1e3:.3f} p90 {report['p90'] * 1e3:.3f} "
+            f"p99 {report['p99'] * 1e3:.3f} max {report['max'] * 1e3:.3f}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m TCPLib.loadgen", description="Stress-test a TCPServer")
+    parser.add_argument("host")
+    parser.add_argument("port", type=int)
+    parser.add_argument("-c", "--clients", type=int, default=10, help="number of concurrent clients")
+    parser.add_argument("-d", "--duration", type=float, default=10, help="length of the test in seconds")
+    parser.add_argument("-s", "--size", default="fixed:1024",
+                        help="message size distribution: fixed:N, uniform:MIN:MAX, exp:MEAN or choice:N1,N2,...")
+    parser.add_argument("-r", "--rate", type=float, default=0,
+                        help="messages per second per client, 0 sends as fast as possible")
+    parser.add_argument("--open-loop", action="store_true", help="use Poisson arrivals at the given rate")
+    parser.add_argument("--echo", action="store_true", help="wait for the server to echo each message")
+    parser.add_argument("-t", "--timeout", type=float, default=None, help="socket timeout in seconds")
+    parser.add_argument("-i", "--interval", type=float, default=1, help="reporting interval in seconds")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    try:
+        gen = LoadGenerator(args.host, args.port, args.clients, args.duration, args.size, args.rate,
+                            args.open_loop, args.echo, args.timeout, args.interval, args.seed)
+    except InvalidSizeDistribution as e:
+        parser.error(str(e))
+    try:
+        total = gen.run(on_report=lambda report: print(format_report(report), flush=True))
+    except KeyboardInterrupt:
+        gen.stop()
+        total = gen.stats().total_report()
+    print(format_report(total))
+    return 0 if total["conn_successes"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,9 +8,12 @@ class Message:
     """
     Container class for holding the size and data of a message
 
-    A message with size=0 and data=None indicates the connection has been closed
+    A message with size=0 and data=None indicates the connection has been closed. topic is set for messages received
+    through a pub/sub subscription.
     """
-    def __init__(self, size, data, client_id=None):
+    def __init__(self, size, data, client_id=None, priority=False, topic=None):
         self.size = size
         self.data = data
         self.client_id = client_id
+        self.priority = priority
+        self.topic = topic
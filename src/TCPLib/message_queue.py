@@ -0,0 +1,143 @@
+"""
+message_queue.py
+Written by: Joshua Kitchen - 2024
+
+Queue classes which can be passed to TCPServer as msg_q to change the order incoming messages are popped in.
+"""
+import queue
+from collections import deque
+
+
+class PriorityMessageQueue(queue.Queue):
+    """
+    Queue with two levels of priority. Messages sent with priority=True are popped before all other messages, so
+    control messages overtake bulk data. To stop a steady stream of priority messages from starving everything else,
+    a normal message is popped after every starvation_limit consecutive priority messages whenever one is waiting.
+    Within a priority level messages are popped in the order they arrived.
+    """
+
+    def __init__(self, maxsize: int = 0, starvation_limit: int = 16):
+        self._starvation_limit = starvation_limit
+        super().__init__(maxsize)
+
+    # The following methods override the storage hooks of queue.Queue and are always called with the queue's mutex
+    # held, so they need no locking of their own.
+
+    def _init(self, maxsize):
+        self._high = deque()
+        self._low = deque()
+        self._high_streak = 0
+
+    def _qsize(self):
+        return len(self._high) + len(self._low)
+
+    def _put(self, item):
+        if getattr(item, "priority", False):
+            self._high.append(item)
+        else:
+            self._low.append(item)
+
+    def _get(self):
+        if self._high and (not self._low or self._high_streak < self._starvation_limit):
+            self._high_streak += 1
+            return self._high.popleft()
+        self._high_streak = 0
+        return self._low.popleft()
+
+
+class FairMessageQueue(queue.Queue):
+    """
+    Queue which gives every client its own sub-queue and pops from the clients in turn, so a client sending many
+    messages cannot push everyone else's messages to the back.
+
+    If quantum is None, one message is popped from each client in turn (round-robin). Otherwise clients are served by
+    deficit round-robin on message size: each turn, a client may have up to quantum bytes of messages popped, so
+    clients sending large messages get the same share of bytes as clients sending small ones rather than the same
+    number of messages. Messages from one client are always popped in the order they arrived. Raises ValueError if
+    quantum is not positive.
+    """
+
+    def __init__(self, maxsize: int = 0, quantum: int = None):
+        if quantum is not None and quantum <= 0:
+            raise ValueError("quantum must be a positive integer or None")
+        self._quantum = quantum
+        super().__init__(maxsize)
+
+    # The following methods override the storage hooks of queue.Queue and are always called with the queue's mutex
+    # held, so they need no locking of their own.
+
+    def _init(self, maxsize):
+        self._sub_queues = {}
+        self._deficits = {}
+        self._active = deque()  # Client ids with waiting messages, in the order they will be served
+        self._size = 0
+
+    def _qsize(self):
+        return self._size
+
+    def _put(self, item):
+        client_id = getattr(item, "client_id", None)
+        sub_q = self._sub_queues.get(client_id)
+        if sub_q is None:
+            sub_q = self._sub_queues[client_id] = deque()
+            self._deficits[client_id] = 0
+            self._active.append(client_id)
+        sub_q.append(item)
+        self._size += 1
+
+    def _remove_if_empty(self, client_id, sub_q):
+        if not sub_q:
+            self._active.popleft()
+            del self._sub_queues[client_id]
+            del self._deficits[client_id]
+
+    def _get(self):
+        self._size -= 1
+        if self._quantum is None:
+            client_id = self._active[0]
+            sub_q = self._sub_queues[client_id]
+            item = sub_q.popleft()
+            if sub_q:
+                self._active.rotate(-1)
+            else:
+                self._remove_if_empty(client_id, sub_q)
+            return item
+        while True:
+            client_id = self._active[0]
+            sub_q = self._sub_queues[client_id]
+            cost = sub_q[0].size or 0
+            if self._deficits[client_id] >= cost:
+                self._deficits[client_id] -= cost
+                item = sub_q.popleft()
+                self._remove_if_empty(client_id, sub_q)
+                return item
+            self._deficits[client_id] += self._quantum
+            self._active.rotate(-1)
+
+
+def drain_queue(q: queue.Queue, max_count: int = 0, timeout: float = 0) -> list:
+    """
+    Removes up to max_count items (all items if max_count is zero) from a queue.Queue, or any subclass which uses
+    the storage hooks such as PriorityMessageQueue and FairMessageQueue, with a single acquisition of the queue's lock.
+    If the queue is empty, waits up to timeout seconds for an item to arrive (forever if timeout is None). Returns a
+    list of the removed items, which is empty if nothing arrived in time.
+    """
+    with q.not_empty:
+        if not q._qsize():
+            if timeout is None:
+                while not q._qsize():
+                    q.not_empty.wait()
+            elif timeout > 0:
+                q.not_empty.wait_for(q._qsize, timeout)
+        size = q._qsize()
+        if not size:
+            return []
+        count = size if max_count <= 0 else min(size, max_count)
+        if type(q) is queue.Queue and count == size:
+            # Swap out the whole deque rather than popping items one at a time
+            items = list(q.queue)
+            q.queue.clear()
+        else:
+            items = [q._get() for _ in range(count)]
+        q.not_full.notify(count)
+    return items
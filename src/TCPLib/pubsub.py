@@ -0,0 +1,315 @@
+"""
+pubsub.py
+Written by: Joshua Kitchen - 2024
+
+Topic-based publish/subscribe for TCPServer. Clients subscribe and unsubscribe with control frames (see
+TCPClient.subscribe()), and TCPServer.publish() encodes a message once and hands the same frame to every matching
+subscriber.
+
+A topic ending in '*' is a wildcard which matches every topic starting with the part before the '*', so 'sensors.*'
+matches 'sensors.temp' and 'sensors.temp.max', and '*' matches every topic.
+"""
+import collections
+import logging
+import threading
+
+from .utils import encode_header, MSG_FLAG_TOPIC, MSG_FLAG_PRIORITY
+
+logger = logging.getLogger(__name__)
+
+CTRL_SUBSCRIBE = 1
+CTRL_UNSUBSCRIBE = 2
+
+TOPIC_LEN_SIZE = 2
+WILDCARD = "*"
+
+DROP = "drop"
+DISCONNECT = "disconnect"
+
+
+class UnknownPolicy(Exception):
+    pass
+
+
+class InvalidControlFrame(Exception):
+    pass
+
+
+def encode_control(op: int, topic: str) -> bytes:
+    """
+    CONTROL FRAME DATA STRUCTURE:
+    [Operation (1 byte)] [Topic (UTF-8)]
+    """
+    return bytes((op,)) + topic.encode('utf-8')
+
+
+def decode_control(data: bytes) -> tuple[int, str]:
+    """
+    Returns the operation and topic of a control frame. Raises InvalidControlFrame if the data is empty or the topic
+    is not valid UTF-8.
+    """
+    if not data:
+        raise InvalidControlFrame("Control frame has no data")
+    try:
+        return data[0], bytes(data[1:]).decode('utf-8')
+    except UnicodeDecodeError:
+        raise InvalidControlFrame("Control frame topic is not valid UTF-8")
+
+
+def encode_topic(topic: str) -> bytes:
+    """
+    TOPIC PREFIX STRUCTURE (placed before the data of a published message):
+    [Topic size (2 bytes)] [Topic (UTF-8)]
+    """
+    encoded = topic.encode('utf-8')
+    return len(encoded).to_bytes(TOPIC_LEN_SIZE, byteorder='big') + encoded
+
+
+def encode_publish(topic: str, data: bytes, priority: bool = False) -> bytes:
+    """
+    Returns the complete frame for a published message, which is sent unchanged to every subscriber
+    """
+    prefix = encode_topic(topic)
+    flags = MSG_FLAG_TOPIC | (MSG_FLAG_PRIORITY if priority else 0)
+    return b''.join((encode_header(len(prefix) + memoryview(data).nbytes, flags), prefix, data))
+
+
+class TopicIndex:
+    """
+    Maps topics to the ids of the clients subscribed to them. Exact topics are found with one dictionary lookup and
+    wildcards with one lookup per distinct wildcard prefix length. Not thread-safe; Broker locks around it.
+    """
+
+    def __init__(self):
+        self._exact = {}
+        self._prefixes = {}
+        self._prefix_lens = collections.Counter()  # Number of wildcard prefixes of each length
+
+    def add(self, topic: str, client_id) -> bool:
+        if topic.endswith(WILDCARD):
+            prefix = topic[:-1]
+            ids = self._prefixes.setdefault(prefix, set())
+            if len(ids) == 0:
+                self._prefix_lens[len(prefix)] += 1
+        else:
+            ids = self._exact.setdefault(topic, set())
+        if client_id in ids:
+            return False
+        ids.add(client_id)
+        return True
+
+    def remove(self, topic: str, client_id) -> bool:
+        if topic.endswith(WILDCARD):
+            prefix = topic[:-1]
+            ids = self._prefixes.get(prefix)
+            if ids is None or client_id not in ids:
+                return False
+            ids.discard(client_id)
+            if not ids:
+                del self._prefixes[prefix]
+                self._prefix_lens[len(prefix)] -= 1
+                if not self._prefix_lens[len(prefix)]:
+                    del self._prefix_lens[len(prefix)]
+            return True
+        ids = self._exact.get(topic)
+        if ids is None or client_id not in ids:
+            return False
+        ids.discard(client_id)
+        if not ids:
+            del self._exact[topic]
+        return True
+
+    def match(self, topic: str) -> set:
+        """
+        Returns the ids of every client subscribed to topic, directly or through a wildcard
+        """
+        out = set(self._exact.get(topic, ()))
+        for length in self._prefix_lens:
+            if length <= len(topic):
+                ids = self._prefixes.get(topic[:length])
+                if ids:
+                    out.update(ids)
+        return out
+
+
+class Subscriber:
+    """
+    Outbound buffer and sending thread for one subscribed client. Holds at most max_frames frames; offer() refuses
+    frames once the buffer is full so a slow consumer cannot hold up the publisher or the other subscribers.
+    """
+
+    def __init__(self, client_proc, max_frames: int, on_error):
+        self._client_proc = client_proc
+        self._max_frames = max_frames
+        self._on_error = on_error
+        self._frames = collections.deque()
+        self._cond = threading.Condition()
+        self._dropped = 0
+        self._is_running = True
+        self.topics = set()
+        threading.Thread(target=self._send_loop, name=f"Subscriber-{client_proc.id()}", daemon=True).start()
+
+    def client_id(self):
+        return self._client_proc.id()
+
+    def dropped(self) -> int:
+        """
+        Returns the number of frames refused because the buffer was full
+        """
+        return self._dropped
+
+    def offer(self, frame: bytes) -> bool:
+        """
+        Adds a frame to the buffer. Returns False if the buffer is full.
+        """
+        self._cond.acquire()
+        if len(self._frames) >= self._max_frames:
+            self._dropped += 1
+            self._cond.release()
+            return False
+        self._frames.append(frame)
+        self._cond.notify()
+        self._cond.release()
+        return True
+
+    def _send_loop(self):
+        while True:
+            self._cond.acquire()
+            while self._is_running and not self._frames:
+                self._cond.wait()
+            if not self._is_running:
+                self._cond.release()
+                return
+            frame = self._frames.popleft()
+            self._cond.release()
+            try:
+                sent = self._client_proc.send_frame(frame)
+            except OSError:
+                sent = False
+            if not sent:
+                self._on_error(self._client_proc.id())
+                return
+
+    def stop(self):
+        self._cond.acquire()
+        self._is_running = False
+        self._frames.clear()
+        self._cond.notify()
+        self._cond.release()
+
+
+class Broker:
+    """
+    Keeps the subscriptions of a TCPServer and fans published frames out to subscriber buffers of up to buffer_size
+    frames. When a subscriber's buffer is full, slow_consumer decides what happens: 'drop' drops the new frame for
+    that subscriber, 'disconnect' drops it and calls on_slow_consumer with the client id so the server can disconnect
+    the client.
+    """
+
+    def __init__(self, buffer_size: int = 1024, slow_consumer: str = DROP, on_slow_consumer=None):
+        if slow_consumer not in (DROP, DISCONNECT):
+            raise UnknownPolicy(f"No slow consumer policy named '{slow_consumer}'. Choose from "
+                                f"{[DROP, DISCONNECT]}")
+        self._buffer_size = buffer_size
+        self._slow_consumer = slow_consumer
+        self._on_slow_consumer = on_slow_consumer
+        self._index = TopicIndex()
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, client_proc, topic: str) -> bool:
+        """
+        Subscribes a client to a topic. Returns False if it was already subscribed.
+        """
+        self._lock.acquire()
+        sub = self._subscribers.get(client_proc.id())
+        if sub is None:
+            sub = self._subscribers[client_proc.id()] = Subscriber(client_proc, self._buffer_size,
+                                                                   self.remove_client)
+        added = self._index.add(topic, client_proc.id())
+        sub.topics.add(topic)
+        self._lock.release()
+        return added
+
+    def unsubscribe(self, client_id, topic: str) -> bool:
+        """
+        Unsubscribes a client from a topic. Returns False if it was not subscribed.
+        """
+        self._lock.acquire()
+        removed = self._index.remove(topic, client_id)
+        sub = self._subscribers.get(client_id)
+        if sub is not None:
+            sub.topics.discard(topic)
+            if not sub.topics:
+                del self._subscribers[client_id]
+                sub.stop()
+        self._lock.release()
+        return removed
+
+    def remove_client(self, client_id):
+        """
+        Removes every subscription of a client
+        """
+        self._lock.acquire()
+        sub = self._subscribers.pop(client_id, None)
+        if sub is not None:
+            for topic in sub.topics:
+                self._index.remove(topic, client_id)
+            sub.stop()
+        self._lock.release()
+
+    def subscribers(self, topic: str) -> list:
+        """
+        Returns the ids of the clients a message published on topic would go to
+        """
+        self._lock.acquire()
+        ids = self._index.match(topic)
+        self._lock.release()
+        return list(ids)
+
+    def topics(self, client_id) -> list:
+        """
+        Returns the topics a client is subscribed to
+        """
+        self._lock.acquire()
+        sub = self._subscribers.get(client_id)
+        topics = list(sub.topics) if sub is not None else []
+        self._lock.release()
+        return topics
+
+    def dropped(self, client_id) -> int:
+        """
+        Returns the number of published messages dropped for a client because its buffer was full
+        """
+        self._lock.acquire()
+        sub = self._subscribers.get(client_id)
+        self._lock.release()
+        if sub is None:
+            return 0
+        return sub.dropped()
+
+    def publish(self, topic: str, frame: bytes) -> int:
+        """
+        Hands an encoded frame to every subscriber of topic. Returns the number of subscribers it was buffered for.
+        """
+        self._lock.acquire()
+        subs = [self._subscribers[client_id] for client_id in self._index.match(topic)]
+        self._lock.release()
+        count = 0
+        for sub in subs:
+            if sub.offer(frame):
+                count += 1
+            elif self._slow_consumer == DISCONNECT and self._on_slow_consumer is not None:
+                self._on_slow_consumer(sub.client_id())
+        return count
+
+    def clear(self):
+        """
+        Removes every subscription
+        """
+        self._lock.acquire()
+        for sub in self._subscribers.values():
+            sub.stop()
+        self._subscribers.clear()
+        self._index = TopicIndex()
+        self._lock.release()
@@ -0,0 +1,109 @@
+"""
+rate_limit.py
+Written by: Joshua Kitchen - 2024
+"""
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Tokens are added at rate tokens per second up to burst tokens. A rate of zero (or less)
+    disables the limit and every request for tokens succeeds immediately.
+    """
+
+    def __init__(self, rate: float, burst: float = None):
+        self._rate = rate
+        if burst is None:
+            burst = max(rate, 1)
+        self._burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+        self._last = now
+
+    def rate(self) -> float:
+        """
+        Returns the rate tokens are added at (tokens per second)
+        """
+        return self._rate
+
+    def is_limited(self) -> bool:
+        """
+        Returns a boolean flag indicating whether the bucket limits anything
+        """
+        return self._rate > 0
+
+    def try_consume(self, tokens: float = 1) -> bool:
+        """
+        Takes tokens from the bucket if enough are available. Returns True on success, False if not.
+        """
+        if self._rate <= 0:
+            return True
+        self._lock.acquire()
+        self._refill(time.monotonic())
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            self._lock.release()
+            return True
+        self._lock.release()
+        return False
+
+    def wait_time(self, tokens: float = 1) -> float:
+        """
+        Returns the number of seconds until the given number of tokens will be available
+        """
+        if self._rate <= 0:
+            return 0.0
+        self._lock.acquire()
+        self._refill(time.monotonic())
+        missing = min(tokens, self._burst) - self._tokens
+        self._lock.release()
+        if missing <= 0:
+            return 0.0
+        return missing / self._rate
+
+    def consume(self, tokens: float = 1, timeout: float = None) -> bool:
+        """
+        Takes tokens from the bucket, sleeping until enough are available. Requests larger than the burst size wait
+        for a full bucket and then drive the bucket negative, so large requests are delayed rather than refused.
+        If timeout is given and the tokens are not available in time, returns False without taking any tokens.
+        """
+        if self._rate <= 0:
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            self._lock.acquire()
+            now = time.monotonic()
+            self._refill(now)
+            needed = min(tokens, self._burst)
+            if self._tokens >= needed:
+                self._tokens -= tokens
+                self._lock.release()
+                return True
+            wait = (needed - self._tokens) / self._rate
+            self._lock.release()
+            if deadline is not None:
+                if now + wait > deadline:
+                    return False
+            time.sleep(wait)
+
+    def reserve(self, tokens: float = 1) -> float:
+        """
+        Takes tokens from the bucket without waiting, driving the bucket negative if there are not enough. Returns the
+        number of seconds until the bucket is back to zero, which is how long a caller that cannot sleep should hold
+        off before taking more.
+        """
+        if self._rate <= 0:
+            return 0.0
+        self._lock.acquire()
+        self._refill(time.monotonic())
+        self._tokens -= tokens
+        debt = -self._tokens
+        self._lock.release()
+        if debt <= 0:
+            return 0.0
+        return debt / self._rate
@@ -0,0 +1,643 @@
+"""
+reactor.py
+Written by: Joshua Kitchen - 2024
+
+Selector-based backend for TCPServer. Instead of one ClientProcessor thread per client, ReactorTCPServer hands every
+client socket to one of a few Reactor threads, each of which multiplexes its sockets with the platform's best
+selector (epoll on Linux), reads them without blocking and parses frames incrementally. send(), pop_msg(),
+list_clients(), disconnect_client(), _on_connect() and the rest of the TCPServer API keep their signatures and
+semantics.
+
+Sends from application threads are written straight to the socket when it has room and are otherwise buffered for the
+reactor to finish. A send waits while more than SEND_HIGH_WATER bytes are buffered for the client, so a client which
+stops reading pushes back on the sender exactly as a full socket does with TCPServer.
+"""
+import collections
+import logging
+import queue
+import selectors
+import socket
+import threading
+import time
+
+from . import events
+from .budget import MemoryBudget
+from .capture import CaptureWriter
+from .message import Message
+from .rate_limit import TokenBucket
+from .serialization import Codec, get_codec
+from .socket_profiles import SocketProfile, get_profile
+from .spool import SEQ_SIZE, encode_seq, decode_seq
+from .tcp_server import TCPServer
+from .utils import encode_msg, encode_header, decode_header, format_addr, has_flags, HEADER_SIZE, FLAGS_SIZE, \
+    MSG_FLAG_PRIORITY, MSG_FLAG_SHM, MSG_FLAG_CONTROL, MSG_FLAG_SPOOL, MSG_FLAG_ACK
+
+logger = logging.getLogger(__name__)
+
+# Bytes which may be buffered for a client before send() waits for the reactor to write them
+SEND_HIGH_WATER = 4 * 1024 * 1024
+
+
+class Reactor:
+    """
+    One I/O thread and the selector it waits on. Connections are registered, and have their interest changed, through
+    call(), which runs a function on the reactor thread, so the selector is only ever touched from that thread.
+    """
+
+    # Longest time (in seconds) the reactor waits in select() before checking timeouts and paused connections
+    _POLL_INTERVAL = 0.25
+
+    def __init__(self, name: str):
+        self._name = name
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self._calls = collections.deque()
+        self._conns = set()
+        self._thread = None
+        self._is_running = False
+        self._stopped = False
+
+    def start(self):
+        self._is_running = True
+        self._thread = threading.Thread(target=self._loop, name=self._name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self._is_running:
+            return
+        self._is_running = False
+        self._wake()
+        self._thread.join()
+        self._stopped = True
+        # Calls queued while the loop was exiting, and connections nobody closed, are dealt with here
+        self._run_calls()
+        for conn in list(self._conns):
+            conn.close()
+        self._selector.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+    def connection_count(self) -> int:
+        return len(self._conns)
+
+    def call(self, fn, *args):
+        """
+        Runs fn(*args) on the reactor thread
+        """
+        if self._stopped or threading.current_thread() is self._thread:
+            fn(*args)
+            return
+        self._calls.append((fn, args))
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b'\0')
+        except (BlockingIOError, OSError):  # Already woken, or stopped
+            pass
+
+    def add(self, conn):
+        self._conns.add(conn)
+        self.update(conn)
+
+    def remove(self, conn):
+        self._conns.discard(conn)
+        if conn.registered:
+            conn.registered = False
+            try:
+                self._selector.unregister(conn.soc)
+            except (KeyError, ValueError):
+                pass
+
+    def update(self, conn):
+        # Registers the connection for the events it currently wants
+        if conn not in self._conns:
+            return
+        mask = conn.interest()
+        try:
+            if mask == 0:
+                if conn.registered:
+                    self._selector.unregister(conn.soc)
+                    conn.registered = False
+            elif conn.registered:
+                self._selector.modify(conn.soc, mask, conn)
+            else:
+                self._selector.register(conn.soc, mask, conn)
+                conn.registered = True
+        except (KeyError, ValueError, OSError):  # Socket was closed
+            conn.close(notify=True)
+
+    def _run_calls(self):
+        while self._calls:
+            fn, args = self._calls.popleft()
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception("Exception in reactor call %s", fn)
+
+    def _loop(self):
+        while self._is_running:
+            timeout = self._POLL_INTERVAL
+            now = time.monotonic()
+            for conn in self._conns:
+                if conn.resume_at is not None:
+                    timeout = min(timeout, max(conn.resume_at - now, 0))
+            try:
+                ready = self._selector.select(timeout)
+            except OSError:
+                if self._is_running:
+                    logger.exception("Reactor %s could not wait for its sockets", self._name)
+                return
+            for key, mask in ready:
+                if key.data is None:
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except (BlockingIOError, OSError):
+                        pass
+                    continue
+                conn = key.data
+                if mask & selectors.EVENT_WRITE and not conn.is_closed():
+                    conn.on_writable()
+                if mask & selectors.EVENT_READ and not conn.is_closed():
+                    conn.on_readable()
+            self._run_calls()
+            now = time.monotonic()
+            for conn in list(self._conns):
+                conn.on_tick(now)
+
+
+class ReactorConnection:
+    """
+    Non-blocking connection to a single client, driven by a Reactor. Provides the same methods to the server as
+    ClientProcessor. Frames are parsed as they arrive: headers and small frames are read into a shared buffer, and the
+    body of a frame which does not fit in one read is received straight into a buffer of its final size.
+    """
+
+    # How long (in seconds) a connection waiting for memory budget pauses before trying again
+    _BUDGET_RETRY_INTERVAL = 0.01
+
+    def __init__(self, client_id, client_soc: socket.socket, msg_q: queue.Queue, server_obj, reactor: Reactor,
+                 timeout: int = None, profile: str | SocketProfile = None, rate_limiter: TokenBucket = None,
+                 codec: str | Codec = None, max_msg_size: int = None, budget: MemoryBudget = None,
+                 capture: CaptureWriter = None):
+        self._client_id = client_id
+        self.soc = client_soc
+        self._addr = client_soc.getpeername()
+        self._msg_q = msg_q
+        self._server_obj = server_obj
+        self._reactor = reactor
+        self._timeout = timeout
+        self._profile = get_profile(profile)
+        self._profile.apply(client_soc)
+        self._buff_size = self._profile.buff_size
+        self._rate_limiter = rate_limiter
+        self._codec = get_codec(codec)
+        self._max_msg_size = max_msg_size
+        self._budget = budget
+        self._capture = capture
+        self.registered = False
+        self.resume_at = None  # When a connection paused by the rate limit or the memory budget reads again
+        self._is_running = False
+        self._closed = False
+        self._last_recv = time.monotonic()
+        # Receive state
+        self._rx = bytearray()
+        self._frame_size = None  # Size of the frame whose header has been read
+        self._frame_flags = 0
+        self._budget_held = False  # Whether the size of the current frame has been taken from the budget
+        self._body = None  # Buffer the body of a large frame is received into
+        self._body_pos = 0
+        self._ack_seq = None  # Latest spooled message to acknowledge
+        # Send state
+        self._tx = collections.deque()
+        self._tx_bytes = 0
+        self._send_cond = threading.Condition()
+
+    def start(self):
+        if self._is_running:
+            return
+        self._is_running = True
+        self.soc.setblocking(False)
+        events.RING.record(events.CONNECT, self._client_id)
+        if self._capture is not None:
+            self._capture.record_connect(self._client_id)
+        self._reactor.call(self._reactor.add, self)
+
+    def id(self) -> str:
+        """
+        Returns a string indicating the id of the client.
+        """
+        return self._client_id
+
+    def addr(self) -> tuple[str, int]:
+        """
+        Returns a tuple with the host's ip (str) and the port (int)
+        """
+        return self._addr
+
+    def timeout(self) -> int:
+        """
+        Returns an int representing the current timeout value.
+        """
+        return self._timeout
+
+    def set_timeout(self, timeout: int) -> bool:
+        """
+        Sets how long the client may go without sending anything before it is disconnected (in seconds). Passing None
+        will set the timeout to infinity. Returns True on success, False if not.
+        """
+        if timeout is not None and timeout < 0:
+            return False
+        self._timeout = timeout
+        return True
+
+    def is_running(self) -> bool:
+        """
+        Returns a boolean indicating whether the connection is set up and running
+        """
+        return self._is_running
+
+    def is_closed(self) -> bool:
+        return self._closed
+
+    def shm_enabled(self) -> bool:
+        """
+        Shared memory messages are not offered by the reactor backend
+        """
+        return False
+
+    def interest(self) -> int:
+        mask = 0
+        if self.resume_at is None and not self._closed:
+            mask |= selectors.EVENT_READ
+        if self._tx:
+            mask |= selectors.EVENT_WRITE
+        return mask
+
+    # Receiving, on the reactor thread
+
+    def on_readable(self):
+        try:
+            if self._body is not None:
+                received = self.soc.recv_into(memoryview(self._body)[self._body_pos:])
+                if received:
+                    self._body_pos += received
+            else:
+                data = self.soc.recv(self._buff_size)
+                received = len(data)
+                self._rx.extend(data)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            logger.debug("Exception while receiving from %s", format_addr(self._addr), exc_info=e)
+            events.RING.record_error(self._client_id)
+            self.close(notify=True)
+            return
+        if not received:  # Connection was closed by the client
+            self.close(notify=True)
+            return
+        self._last_recv = time.monotonic()
+        self._parse()
+
+    def _parse(self):
+        while not self._closed and self.resume_at is None:
+            if self._frame_size is None and not self._read_header():
+                break
+            if not self._budget_held and self._budget is not None:
+                if not self._budget.acquire(self._frame_size, 0):
+                    # Stop reading until budget is given back, which pushes back on the client through TCP
+                    self._pause(self._BUDGET_RETRY_INTERVAL)
+                    break
+                self._budget_held = True
+            if self._body is not None:
+                if self._body_pos < len(self._body):
+                    break
+                body = self._body
+                self._body = None
+            elif len(self._rx) >= self._frame_size:
+                body = self._rx[:self._frame_size]
+                del self._rx[:self._frame_size]
+            else:
+                # The rest of the body goes straight into a buffer of the right size
+                self._body = bytearray(self._frame_size)
+                self._body[:len(self._rx)] = self._rx
+                self._body_pos = len(self._rx)
+                self._rx.clear()
+                break
+            self._frame_size = None
+            self._budget_held = False
+            self._deliver(body, self._frame_flags)
+        self._send_ack()
+
+    def _read_header(self) -> bool:
+        if len(self._rx) < HEADER_SIZE:
+            return False
+        header_size = HEADER_SIZE + (FLAGS_SIZE if has_flags(self._rx) else 0)
+        if len(self._rx) < header_size:
+            return False
+        size = decode_header(self._rx[:HEADER_SIZE])
+        self._frame_flags = self._rx[HEADER_SIZE] if header_size > HEADER_SIZE else 0
+        del self._rx[:header_size]
+        if self._max_msg_size is not None and size > self._max_msg_size:
+            logger.warning("Disconnecting %s: message of %d bytes is larger than the limit of %d bytes",
+                           format_addr(self._addr), size, self._max_msg_size)
+            events.RING.record_error(self._client_id)
+            self.close(notify=True)
+            return False
+        if self._frame_flags & MSG_FLAG_SHM:
+            logger.error("Disconnecting %s: shared memory messages are not supported by the reactor backend",
+                         format_addr(self._addr))
+            events.RING.record_error(self._client_id)
+            self.close(notify=True)
+            return False
+        self._frame_size = size
+        return True
+
+    def _deliver(self, data: bytearray, flags: int):
+        size = len(data)
+        events.RING.sample(events.RECV, self._client_id, size)
+        if flags & MSG_FLAG_CONTROL:
+            if self._capture is not None:
+                self._capture.record_frame(self._client_id, flags, data)
+            if self._budget is not None:
+                self._budget.release(size)
+            self._server_obj._on_control(self._client_id, data)
+            return
+        seq = None
+        if flags & MSG_FLAG_SPOOL and size >= SEQ_SIZE:
+            seq = decode_seq(data)
+            del data[:SEQ_SIZE]
+            if self._budget is not None:
+                self._budget.release(SEQ_SIZE)
+        if self._capture is not None:
+            self._capture.record_frame(self._client_id, flags, data)
+        self._msg_q.put(Message(len(data), data, self._client_id, bool(flags & MSG_FLAG_PRIORITY)))
+        if seq is not None:
+            self._ack_seq = seq
+        if self._rate_limiter is not None:
+            wait = self._rate_limiter.reserve(size)
+            if wait > 0:
+                self._pause(wait)
+
+    def _send_ack(self):
+        # One cumulative acknowledgement covers every spooled message delivered by this read
+        if self._ack_seq is None:
+            return
+        frame = encode_msg(encode_seq(self._ack_seq), MSG_FLAG_ACK)
+        self._ack_seq = None
+        self._send_cond.acquire()
+        try:
+            self._write([frame])
+        finally:
+            self._send_cond.release()
+        self._reactor.update(self)
+
+    def _pause(self, delay: float):
+        self.resume_at = time.monotonic() + delay
+        self._reactor.update(self)
+
+    def on_tick(self, now: float):
+        if self._closed:
+            return
+        if self.resume_at is not None and now >= self.resume_at:
+            self.resume_at = None
+            self._reactor.update(self)
+            self._parse()
+        if self._timeout is not None and now - self._last_recv > self._timeout:
+            logger.debug("Client %s timed out", self._client_id)
+            self.close(notify=True)
+
+    # Sending, from any thread
+
+    def _buffer(self, buf, view: memoryview):
+        # Queues the unsent part of a caller's buffer. Anything but bytes is copied, since send() returns before it is
+        # written and the caller may change the buffer as soon as it does.
+        if not isinstance(buf, bytes):
+            view = memoryview(bytes(view))
+        self._tx.append(view)
+        self._tx_bytes += view.nbytes
+
+    def _write(self, buffers: list) -> bool:
+        # Called with the send lock held. Writes what the socket takes now and buffers the rest for the reactor.
+        if self._tx:
+            for buf in buffers:
+                self._buffer(buf, memoryview(buf).cast('B'))
+            return True
+        views = [memoryview(buf).cast('B') for buf in buffers]
+        try:
+            sent = self.soc.sendmsg(views)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError as e:
+            logger.debug("Exception while sending to %s", format_addr(self._addr), exc_info=e)
+            return False
+        for buf, view in zip(buffers, views):
+            if sent >= view.nbytes:
+                sent -= view.nbytes
+                continue
+            self._buffer(buf, view[sent:])
+            sent = 0
+        return True
+
+    def send_buffers(self, buffers: list) -> bool:
+        """
+        Sends a list of bytes-like objects back to back. Waits while more than SEND_HIGH_WATER bytes are buffered for
+        the client. Returns True once the data is written or buffered, False if the client has disconnected.
+        """
+        self._send_cond.acquire()
+        try:
+            while self._tx_bytes > SEND_HIGH_WATER and not self._closed:
+                self._send_cond.wait()
+            if self._closed:
+                return False
+            had_tx = bool(self._tx)
+            sent = self._write(buffers)
+            wants_write = not had_tx and bool(self._tx)
+        finally:
+            self._send_cond.release()
+        if not sent:
+            self._reactor.call(self.close, True)
+            return False
+        if wants_write:
+            self._reactor.call(self._reactor.update, self)
+        return True
+
+    def on_writable(self):
+        failed = False
+        self._send_cond.acquire()
+        try:
+            while self._tx:
+                view = self._tx[0]
+                try:
+                    sent = self.soc.send(view)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except OSError as e:
+                    logger.debug("Exception while sending to %s", format_addr(self._addr), exc_info=e)
+                    failed = True
+                    break
+                self._tx_bytes -= sent
+                if sent < view.nbytes:
+                    self._tx[0] = view[sent:]
+                    break
+                self._tx.popleft()
+            self._send_cond.notify_all()
+        finally:
+            self._send_cond.release()
+        if failed:
+            self.close(notify=True)
+        elif not self._tx:
+            self._reactor.update(self)
+
+    def send(self, data: bytes, priority: bool = False) -> bool:
+        """
+        Send all bytes of the data argument with a header attached. If priority is True, the message is marked as
+        high priority. Returns True on successful transmission, False on failed transmission.
+        """
+        size = memoryview(data).nbytes
+        sent = self.send_buffers([encode_header(size, MSG_FLAG_PRIORITY if priority else 0), data])
+        if sent:
+            events.RING.sample(events.SEND, self._client_id, size)
+        return sent
+
+    def send_obj(self, obj, codec: str | Codec = None, priority: bool = False) -> bool:
+        """
+        Encodes obj with codec (the server's codec if None) and sends it to the client. Returns True on successful
+        transmission, False on failed transmission.
+        """
+        codec = self._codec if codec is None else get_codec(codec)
+        parts = codec.encode(obj)
+        if not isinstance(parts, list):
+            parts = [parts]
+        size = sum(memoryview(part).nbytes for part in parts)
+        return self.send_buffers([encode_header(size, MSG_FLAG_PRIORITY if priority else 0), *parts])
+
+    def send_frame(self, frame: bytes) -> bool:
+        """
+        Sends an already encoded frame (header included) to the client as it is. Returns True on successful
+        transmission, False on failed transmission.
+        """
+        return self.send_buffers([frame])
+
+    def flush(self) -> bool:
+        """
+        Buffered data is already written as soon as the socket has room, so there is nothing to flush. Returns False if
+        the client has disconnected.
+        """
+        return not self._closed
+
+    def batch_stats(self) -> dict | None:
+        return None
+
+    def close(self, notify: bool = False):
+        """
+        Closes the connection. If notify is True, a message signalling the disconnect is put in the queue, as
+        ClientProcessor does when a client goes away. Must run on the reactor thread.
+        """
+        if self._closed:
+            return
+        self._send_cond.acquire()
+        self._closed = True
+        self._tx.clear()
+        self._tx_bytes = 0
+        self._send_cond.notify_all()
+        self._send_cond.release()
+        was_running = self._is_running
+        self._is_running = False
+        self._reactor.remove(self)
+        try:
+            self.soc.close()
+        except OSError:
+            pass
+        if self._budget_held and self._budget is not None:
+            self._budget.release(self._frame_size)
+            self._budget_held = False
+        events.RING.record(events.DISCONNECT, self._client_id)
+        if self._capture is not None:
+            self._capture.record_disconnect(self._client_id)
+        if notify and was_running:
+            self._msg_q.put(Message(0, None, self._client_id))
+
+    def stop(self):
+        """
+        Stops the connection. If the connection is not running, this method will do nothing.
+        """
+        if not self._is_running:
+            return
+        self._is_running = False
+        self._send_cond.acquire()
+        self._send_cond.notify_all()
+        self._send_cond.release()
+        self._reactor.call(self.close, False)
+
+
+class ReactorTCPServer(TCPServer):
+    """
+    Drop-in replacement for TCPServer which serves every client from io_threads Reactor threads instead of a thread
+    per client. Takes the same arguments as TCPServer, and the same methods behave the same way, with three
+    exceptions: shared memory messages are never offered (shm_threshold is ignored), a client's timeout is how long it
+    may go without sending anything before it is disconnected, and batch_window and batch_bytes are ignored, since
+    everything buffered for a client is already written together as soon as the socket has room.
+    """
+
+    def __init__(self, *args, io_threads: int = 1, **kwargs):
+        super().__init__(*args, **kwargs)
+        if io_threads < 1:
+            raise ValueError("io_threads must be at least 1")
+        self._io_threads = io_threads
+        self._reactors = []
+        self._next_reactor = 0
+
+    def io_threads(self) -> int:
+        return self._io_threads
+
+    def _shm_allowed(self, client_soc: socket.socket) -> bool:
+        return False
+
+    def _new_client_proc(self, client_id: str, client_soc: socket.socket, shm_token: str = None) -> ReactorConnection:
+        reactor = self._reactors[self._next_reactor % len(self._reactors)]
+        self._next_reactor += 1
+        return ReactorConnection(client_id=client_id,
+                                 client_soc=client_soc,
+                                 msg_q=self._messages,
+                                 server_obj=self,
+                                 reactor=reactor,
+                                 timeout=self._timeout,
+                                 profile=self._profile,
+                                 rate_limiter=self._new_client_limiter(),
+                                 codec=self._codec,
+                                 max_msg_size=self._max_msg_size,
+                                 budget=self._budget,
+                                 capture=self._capture)
+
+    def start(self) -> bool:
+        """
+        Starts the server and its reactor threads. Returns True on successful start up, False if not.
+        """
+        if self._is_running:
+            return False
+        self._reactors = [Reactor(f"TCPServer-reactor-{i}") for i in range(self._io_threads)]
+        for reactor in self._reactors:
+            reactor.start()
+        if not super().start():
+            self._stop_reactors()
+            return False
+        return True
+
+    def stop(self):
+        """
+        Stops the server and its reactor threads. If the server is not running, this method will do nothing.
+        """
+        if not self._is_running:
+            return
+        super().stop()
+        self._stop_reactors()
+
+    def _stop_reactors(self):
+        for reactor in self._reactors:
+            reactor.stop()
+        self._reactors = []
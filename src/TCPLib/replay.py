@@ -0,0 +1,217 @@
+"""
+replay.py
+Written by: Joshua Kitchen - 2024
+
+Replays a capture file recorded by a TCPServer (see capture.py) against a server. Every client connection in the
+capture is replayed by its own TCPClient, which connects, sends the recorded messages and disconnects in the same
+order as the original client did, either at the original timing (scaled by a speed factor) or as fast as possible.
+Connection success rate, throughput and latency percentiles are reported like the load generator does.
+
+Usage:
+    python -m TCPLib.replay HOST PORT CAPTURE [-s SPEED | --fast] [--echo] [-t TIMEOUT] [-i INTERVAL]
+"""
+import argparse
+import logging
+import sys
+import threading
+import time
+
+from .capture import read_capture, InvalidCapture, CONNECT, FRAME, SIZE_ONLY, DISCONNECT, RUN_START
+from .loadgen import LoadStats, format_report
+from .tcp_client import TCPClient
+from .utils import encode_msg, MSG_FLAG_PRIORITY, MSG_FLAG_CONTROL
+
+logger = logging.getLogger(__name__)
+
+
+class Replayer:
+    """
+    Replays the capture file at path against the server at host and port. The whole capture is read into memory
+    first, so reading the file does not slow the replay down.
+
+    With speed 1.0, every connection and message happens at the same time after the start of the replay as it did
+    after the start of the capture; a speed of 2.0 replays twice as fast. A capture appended to by several server runs
+    is replayed one run after another, each run starting where the previous one ended. In timed mode latency is
+    measured from the scheduled send time, so a server which falls behind shows up as latency rather than as a slower
+    replay. With speed 0, each client sends its messages back to back as fast as possible and latency is the time taken
+    to send each one. If echo is True, each message waits for a reply from the server and the latency is the full round
+    trip.
+
+    Messages recorded without their data (see CaptureWriter) are replayed as zeros of the recorded size. Control frames
+    such as subscriptions are replayed as they were sent, but not counted as messages.
+    """
+
+    def __init__(self, host: str, port: int, path: str, speed: float = 1.0, echo: bool = False,
+                 timeout: int = None, report_interval: float = 1):
+        if speed < 0:
+            raise ValueError("speed cannot be negative")
+        self._addr = (host, port)
+        self._speed = speed
+        self._echo = echo
+        self._timeout = timeout
+        self._report_interval = report_interval
+        self._stats = LoadStats()
+        self._stop_event = threading.Event()
+        self._sessions = []
+        self._load(path)
+
+    def _load(self, path: str):
+        # Splits the capture into one list of (time, record) pairs per client connection, each starting with its
+        # CONNECT record. The time is when the record is replayed at speed 1.0, in seconds after the start of the
+        # replay. Raises InvalidCapture and OSError.
+        open_sessions = {}
+        run_offset = 0.0  # Replay time at which the current run starts
+        run_start = None  # Capture time at which the current run starts
+        at = 0.0
+        for record in read_capture(path):
+            if record.kind == RUN_START or run_start is None:
+                # Clients still connected at the end of a run end with it
+                open_sessions = {}
+                run_offset = at
+                run_start = record.timestamp
+            at = run_offset + max(record.timestamp - run_start, 0.0)
+            if record.kind == RUN_START:
+                continue
+            if record.kind == CONNECT:
+                session = [(at, record)]
+                open_sessions[record.client_id] = session
+                self._sessions.append(session)
+                continue
+            session = open_sessions.get(record.client_id)
+            if session is None:
+                continue
+            session.append((at, record))
+            if record.kind == DISCONNECT:
+                del open_sessions[record.client_id]
+
+    def sessions(self) -> int:
+        """
+        Returns the number of client connections in the capture
+        """
+        return len(self._sessions)
+
+    def stats(self) -> LoadStats:
+        """
+        Returns the LoadStats object results are being collected in
+        """
+        return self._stats
+
+    def stop(self):
+        """
+        Stops a running replay before the end of the capture.
+        """
+        self._stop_event.set()
+
+    def _scheduled(self, start: float, at: float) -> float:
+        return start + at / self._speed
+
+    def _wait_until(self, when: float) -> bool:
+        # Returns False if the replay was stopped while waiting
+        delay = when - time.perf_counter()
+        if delay > 0:
+            return not self._stop_event.wait(delay)
+        return not self._stop_event.is_set()
+
+    def _client_loop(self, session: list, start: float):
+        timed = self._speed > 0
+        if timed and not self._wait_until(self._scheduled(start, session[0][0])):
+            return
+        client = TCPClient(self._addr[0], self._addr[1], self._timeout)
+        try:
+            connected = client.connect()
+        except OSError:
+            connected = False
+        self._stats.record_connect(connected)
+        if not connected:
+            return
+        zeros = {}
+        try:
+            for at, record in session[1:]:
+                if timed:
+                    scheduled = self._scheduled(start, at)
+                    if not self._wait_until(scheduled):
+                        break
+                elif self._stop_event.is_set():
+                    break
+                if record.kind == DISCONNECT:
+                    break
+                if record.flags & MSG_FLAG_CONTROL:
+                    # Control frames recorded without their data cannot be rebuilt
+                    if record.kind == FRAME and not client.send_bytes(encode_msg(record.data, MSG_FLAG_CONTROL)):
+                        self._stats.record_error()
+                        break
+                    continue
+                data = record.data
+                if record.kind == SIZE_ONLY:
+                    data = zeros.get(record.size)
+                    if data is None:
+                        data = zeros.setdefault(record.size, bytes(record.size))
+                send_start = scheduled if timed else time.perf_counter()
+                if not client.send(data, bool(record.flags & MSG_FLAG_PRIORITY)):
+                    self._stats.record_error()
+                    break
+                if self._echo:
+                    reply = client.receive_all()
+                    if reply.data is None:
+                        self._stats.record_error()
+                        break
+                self._stats.record_msg(record.size, time.perf_counter() - send_start)
+        except OSError as e:
+            logger.debug("Replay of client %s failed", session[0][1].client_id, exc_info=e)
+            self._stats.record_error()
+        finally:
+            client.disconnect()
+
+    def run(self, on_report=None) -> dict:
+        """
+        Replays the capture and blocks until every client has finished. If on_report is given, it is called with an
+        interval report every report_interval seconds. Returns a report covering the whole replay.
+        """
+        start = time.perf_counter()
+        threads = []
+        for session in self._sessions:
+            th = threading.Thread(target=self._client_loop, args=[session, start], daemon=True)
+            th.start()
+            threads.append(th)
+        while any(th.is_alive() for th in threads):
+            if self._stop_event.wait(self._report_interval):
+                break
+            if on_report is not None:
+                on_report(self._stats.interval_report())
+        self._stop_event.set()
+        for th in threads:
+            th.join()
+        return self._stats.total_report()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m TCPLib.replay",
+                                     description="Replay traffic captured by a TCPServer against a server")
+    parser.add_argument("host")
+    parser.add_argument("port", type=int)
+    parser.add_argument("capture", help="capture file recorded by a TCPServer")
+    speed = parser.add_mutually_exclusive_group()
+    speed.add_argument("-s", "--speed", type=float, default=1.0,
+                       help="replay speed relative to the original timing")
+    speed.add_argument("--fast", action="store_true", help="send as fast as possible, ignoring the original timing")
+    parser.add_argument("--echo", action="store_true", help="wait for the server to echo each message")
+    parser.add_argument("-t", "--timeout", type=float, default=None, help="socket timeout in seconds")
+    parser.add_argument("-i", "--interval", type=float, default=1, help="reporting interval in seconds")
+    args = parser.parse_args(argv)
+
+    try:
+        replayer = Replayer(args.host, args.port, args.capture, 0 if args.fast else args.speed, args.echo,
+                            args.timeout, args.interval)
+    except (InvalidCapture, OSError, ValueError) as e:
+        parser.error(str(e))
+    try:
+        total = replayer.run(on_report=lambda report: print(format_report(report), flush=True))
+    except KeyboardInterrupt:
+        replayer.stop()
+        total = replayer.stats().total_report()
+    print(format_report(total))
+    return 0 if total["conn_successes"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,215 @@
+"""
+serialization.py
+Written by: Joshua Kitchen - 2024
+
+Codecs used by send_obj() and receive_obj() to turn Python objects into message data and back.
+"""
+import itertools
+import json
+import pickle
+import struct
+
+
+class UnknownCodec(Exception):
+    pass
+
+
+class NumpyNotAvailable(Exception):
+    pass
+
+
+def require_numpy():
+    """
+    Imports and returns the numpy module. NumPy is only imported the first time an array is sent or received, so
+    importing the library does not pay for it. Raises NumpyNotAvailable if NumPy is not installed.
+    """
+    try:
+        import numpy
+    except ImportError:
+        raise NumpyNotAvailable("NumPy must be installed to send or receive arrays")
+    return numpy
+
+
+class Codec:
+    """
+    Base class for codecs. encode() returns either a bytes-like object or a list of bytes-like objects which are sent
+    back to back as the data of a single message, which lets a codec avoid joining large buffers together. decode()
+    takes the data of a received message.
+    """
+    name = None
+
+    def encode(self, obj) -> bytes | list:
+        raise NotImplementedError
+
+    def decode(self, data: bytes | bytearray | memoryview):
+        raise NotImplementedError
+
+
+class JSONCodec(Codec):
+    """
+    Encodes objects as compact UTF-8 JSON.
+    """
+    name = "json"
+
+    def encode(self, obj) -> bytes:
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def decode(self, data: bytes | bytearray | memoryview):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return json.loads(data)
+
+
+class PickleCodec(Codec):
+    """
+    Encodes objects with pickle protocol 5. If out_of_band is True, buffers which support out-of-band pickling
+    (pickle.PickleBuffer objects and NumPy arrays) are sent as they are after the pickle instead of being copied into
+    it, and on decode they are views into the received message rather than copies.
+
+    NOTE: Unpickling data from an untrusted peer can execute arbitrary code.
+
+    DATA STRUCTURE:
+    [Buffer count (4 bytes)] [Pickle size (8 bytes)] [Buffer sizes (8 bytes each)] [Pickle] [Buffers]
+    """
+    name = "pickle"
+    _COUNT = struct.Struct('>IQ')
+    _SIZE = struct.Struct('>Q')
+
+    def __init__(self, out_of_band: bool = True):
+        self._out_of_band = out_of_band
+
+    def encode(self, obj) -> list:
+        buffers = []
+        data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append if self._out_of_band else None)
+        raw = [buf.raw() for buf in buffers]
+        header = bytearray(self._COUNT.pack(len(raw), len(data)))
+        for buf in raw:
+            header.extend(self._SIZE.pack(buf.nbytes))
+        return [header, data, *raw]
+
+    def decode(self, data: bytes | bytearray | memoryview):
+        view = memoryview(data)
+        count, pickle_size = self._COUNT.unpack_from(view)
+        offset = self._COUNT.size
+        sizes = []
+        for _ in range(count):
+            sizes.append(self._SIZE.unpack_from(view, offset)[0])
+            offset += self._SIZE.size
+        pickled = view[offset:offset + pickle_size]
+        offset += pickle_size
+        buffers = []
+        for size in sizes:
+            buffers.append(view[offset:offset + size])
+            offset += size
+        return pickle.loads(pickled, buffers=buffers)
+
+
+class StructCodec(Codec):
+    """
+    Encodes fixed-layout records with a struct format (see https://docs.python.org/3/library/struct.html), which is
+    compiled once when the codec is created. Records are tuples (or the record_type, if given, such as a namedtuple
+    class). If batch is True, the codec encodes and decodes lists of records, packed back to back, so a whole batch is
+    handled with one C call per record and no per-field Python work.
+    """
+    name = "struct"
+
+    def __init__(self, fmt: str, batch: bool = False, record_type=None):
+        self._struct = struct.Struct(fmt)
+        self._batch = batch
+        self._record_type = record_type
+
+    def record_size(self) -> int:
+        """
+        Returns the size in bytes of one encoded record
+        """
+        return self._struct.size
+
+    def encode(self, obj) -> bytes:
+        if not self._batch:
+            return self._struct.pack(*obj)
+        return b''.join(itertools.starmap(self._struct.pack, obj))
+
+    def decode(self, data: bytes | bytearray | memoryview):
+        if not self._batch:
+            record = self._struct.unpack(data)
+            return record if self._record_type is None else self._record_type._make(record)
+        records = self._struct.iter_unpack(data)
+        if self._record_type is None:
+            return list(records)
+        return list(map(self._record_type._make, records))
+
+
+class ArrayCodec(Codec):
+    """
+    Encodes NumPy arrays as their dtype and shape followed by the raw contents of the array. encode() returns a view
+    of the array's memory rather than a copy (arrays which are not C-contiguous are copied once to make them so), and
+    decode() returns an array which is a view into the received message. Arrays of Python objects are not supported.
+    Raises NumpyNotAvailable if NumPy is not installed.
+
+    DATA STRUCTURE:
+    [Metadata size (4 bytes)] [Metadata (JSON with 'dtype' and 'shape')] [Array data]
+    """
+    name = "array"
+    _META_SIZE = struct.Struct('>I')
+    META_HEADER_SIZE = _META_SIZE.size
+
+    def encode_meta(self, arr) -> bytes:
+        """
+        Returns the metadata part of the encoded array
+        """
+        meta = json.dumps({"dtype": arr.dtype.str, "shape": arr.shape}).encode('utf-8')
+        return self._META_SIZE.pack(len(meta)) + meta
+
+    def meta_size(self, data: bytes | bytearray | memoryview) -> int:
+        """
+        Returns the size of the JSON metadata given the first META_HEADER_SIZE bytes of an encoded array
+        """
+        return self._META_SIZE.unpack_from(data)[0]
+
+    def decode_meta(self, meta: bytes | bytearray | memoryview) -> tuple:
+        """
+        Returns the dtype and shape of an array given its JSON metadata
+        """
+        np = require_numpy()
+        info = json.loads(bytes(meta))
+        return np.dtype(info["dtype"]), tuple(info["shape"])
+
+    def encode(self, obj) -> list:
+        np = require_numpy()
+        arr = np.ascontiguousarray(obj)
+        if arr.dtype.hasobject:
+            raise ValueError("Arrays of Python objects cannot be sent as raw buffers, use PickleCodec instead")
+        return [self.encode_meta(arr), arr.reshape(-1).view(np.uint8)]
+
+    def decode(self, data: bytes | bytearray | memoryview):
+        np = require_numpy()
+        meta_size = self.meta_size(data)
+        offset = self.META_HEADER_SIZE
+        dtype, shape = self.decode_meta(memoryview(data)[offset:offset + meta_size])
+        offset += meta_size
+        count = 1
+        for dim in shape:
+            count *= dim
+        return np.frombuffer(data, dtype=dtype, count=count, offset=offset).reshape(shape)
+
+
+CODECS = {
+    "json": JSONCodec(),
+    "pickle": PickleCodec(),
+    "array": ArrayCodec(),
+}
+
+
+def get_codec(codec: str | Codec | None) -> Codec:
+    """
+    Returns the Codec for a codec name ('json', 'pickle' or 'array'). Codec objects are returned unchanged and None
+    returns the JSON codec. Raises UnknownCodec if no codec with that name exists.
+    """
+    if codec is None:
+        return CODECS["json"]
+    if isinstance(codec, Codec):
+        return codec
+    try:
+        return CODECS[codec]
+    except KeyError:
+        raise UnknownCodec(f"No codec named '{codec}'. Choose from {list(CODECS.keys())} or pass a Codec object")
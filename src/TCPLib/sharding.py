@@ -0,0 +1,324 @@
+"""
+sharding.py
+Written by: Joshua Kitchen - 2024
+
+Client-side sharding across several TCPServers. ShardedTCPClient keeps a TCPClient per server and sends each message
+to the server its key maps to on a consistent hash ring, so the same key always reaches the same server while that
+server is up, and adding or removing a server only moves the keys that map to it.
+"""
+import bisect
+import hashlib
+import logging
+import threading
+import time
+
+from .serialization import Codec
+from .tcp_client import TCPClient
+from .utils import format_addr
+
+logger = logging.getLogger(__name__)
+
+
+def _hash(data: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'big')
+
+
+def _key_bytes(key) -> bytes:
+    if isinstance(key, (bytes, bytearray, memoryview)):
+        return bytes(key)
+    if isinstance(key, str):
+        return key.encode()
+    return str(key).encode()
+
+
+class HashRing:
+    """
+    Consistent hash ring. Every node is placed on the ring at vnodes points (virtual nodes), which spreads keys evenly
+    between nodes; a key belongs to the first node point at or after the key's hash. Adding or removing a node only
+    moves the keys owned by that node's points. Nodes can be any hashable objects with a stable str().
+    """
+
+    def __init__(self, nodes: list = None, vnodes: int = 160):
+        if vnodes < 1:
+            raise ValueError("vnodes must be at least 1")
+        self._vnodes = vnodes
+        self._hashes = []
+        self._owners = []
+        self._nodes = set()
+        for node in nodes or []:
+            self.add(node)
+
+    def vnodes(self) -> int:
+        return self._vnodes
+
+    def nodes(self) -> list:
+        return list(self._nodes)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, node):
+        return node in self._nodes
+
+    def add(self, node) -> bool:
+        """
+        Places node on the ring. Returns False if it was already on it.
+        """
+        if node in self._nodes:
+            return False
+        self._nodes.add(node)
+        name = str(node).encode()
+        for i in range(self._vnodes):
+            point = _hash(b'%s#%d' % (name, i))
+            index = bisect.bisect(self._hashes, point)
+            self._hashes.insert(index, point)
+            self._owners.insert(index, node)
+        return True
+
+    def remove(self, node) -> bool:
+        """
+        Takes node off the ring. Returns False if it was not on it.
+        """
+        if node not in self._nodes:
+            return False
+        self._nodes.discard(node)
+        keep = [i for i, owner in enumerate(self._owners) if owner != node]
+        self._hashes = [self._hashes[i] for i in keep]
+        self._owners = [self._owners[i] for i in keep]
+        return True
+
+    def lookup(self, key):
+        """
+        Returns the node key belongs to, or None if the ring is empty. key can be bytes, a str, or anything with a
+        stable str().
+        """
+        for node in self.preference(key):
+            return node
+        return None
+
+    def preference(self, key):
+        """
+        Generator over every node in the order key falls back to them: the node it belongs to first, then each other
+        node in the order they next appear on the ring.
+        """
+        if not self._hashes:
+            return
+        start = bisect.bisect_left(self._hashes, _hash(_key_bytes(key)))
+        seen = set()
+        for i in range(len(self._owners)):
+            node = self._owners[(start + i) % len(self._owners)]
+            if node in seen:
+                continue
+            seen.add(node)
+            yield node
+            if len(seen) == len(self._nodes):
+                return
+
+
+class ShardedTCPClient:
+    """
+    Sends messages to a group of TCPServers, each given as a (host, port) tuple, choosing the server for every message
+    by its key on a HashRing with vnodes virtual nodes per server. Connections are opened when a server is first
+    needed. If a server refuses the connection (SERVER FULL) or the connection fails, the server is skipped for
+    retry_interval seconds and its keys go to the next server on the ring until then. Any other keyword arguments (such
+    as timeout, profile or codec) are passed to every TCPClient.
+
+    A ShardedTCPClient can be shared between threads. Connects and sends to one server are serialized by a lock of
+    its own, so a slow or unresponsive server only holds up the messages for it, not those for the other servers.
+    """
+
+    def __init__(self, servers: list[tuple[str, int]], vnodes: int = 160, retry_interval: float = 5.0,
+                 **client_kwargs):
+        self._ring = HashRing(vnodes=vnodes)
+        self._client_kwargs = client_kwargs
+        self._retry_interval = retry_interval
+        self._clients = {}
+        self._down_until = {}  # Servers which failed and when they may be tried again
+        self._lock = threading.Lock()  # Held only while the ring and the tables above are read or changed
+        self._server_locks = {}  # Held while connecting or sending to a server
+        for addr in servers:
+            self._ring.add(tuple(addr))
+
+    def servers(self) -> list[tuple[str, int]]:
+        """
+        Returns the addresses of every server on the ring
+        """
+        self._lock.acquire()
+        servers = self._ring.nodes()
+        self._lock.release()
+        return servers
+
+    def connected_servers(self) -> list[tuple[str, int]]:
+        """
+        Returns the addresses of the servers with an open connection
+        """
+        self._lock.acquire()
+        servers = [addr for addr, client in self._clients.items() if client.is_connected()]
+        self._lock.release()
+        return servers
+
+    def client(self, addr: tuple[str, int]) -> TCPClient | None:
+        """
+        Returns the TCPClient connected to the server at addr, for receiving its replies, or None if there is no open
+        connection to it
+        """
+        self._lock.acquire()
+        client = self._clients.get(tuple(addr))
+        self._lock.release()
+        if client is None or not client.is_connected():
+            return None
+        return client
+
+    def add_server(self, addr: tuple[str, int]) -> bool:
+        """
+        Adds a server to the ring. Only the keys which now belong to it move. Returns False if it was already added.
+        """
+        self._lock.acquire()
+        added = self._ring.add(tuple(addr))
+        self._lock.release()
+        return added
+
+    def remove_server(self, addr: tuple[str, int]) -> bool:
+        """
+        Removes a server from the ring and disconnects from it. Its keys move to the next servers on the ring, and no
+        others move. Returns False if it was not on the ring.
+        """
+        addr = tuple(addr)
+        self._lock.acquire()
+        removed = self._ring.remove(addr)
+        client = self._clients.pop(addr, None)
+        self._down_until.pop(addr, None)
+        self._server_locks.pop(addr, None)
+        self._lock.release()
+        if client is not None:
+            client.disconnect()
+        return removed
+
+    def server_for(self, key) -> tuple[str, int] | None:
+        """
+        Returns the address of the server key belongs to on the ring, whether or not it is up, or None if there are no
+        servers
+        """
+        self._lock.acquire()
+        addr = self._ring.lookup(key)
+        self._lock.release()
+        return addr
+
+    def connect(self) -> int:
+        """
+        Connects to every server which is not connected or marked down. Returns the number of open connections.
+        """
+        connected = 0
+        for addr in self.servers():
+            server_lock = self._server_lock(addr)
+            if server_lock is None:
+                continue
+            server_lock.acquire()
+            try:
+                if self._get_client(addr) is not None:
+                    connected += 1
+            finally:
+                server_lock.release()
+        return connected
+
+    def _server_lock(self, addr: tuple[str, int]):
+        # Returns the lock for a server, or None if it is no longer on the ring
+        self._lock.acquire()
+        try:
+            if addr not in self._ring:
+                return None
+            return self._server_locks.setdefault(addr, threading.Lock())
+        finally:
+            self._lock.release()
+
+    def _mark_down(self, addr: tuple[str, int], client: TCPClient):
+        # Called with the server's lock held, so the client in the table is client or one which has disconnected
+        self._lock.acquire()
+        if addr in self._ring:
+            self._down_until[addr] = time.monotonic() + self._retry_interval
+        stale = self._clients.pop(addr, None)
+        self._lock.release()
+        client.disconnect()
+        if stale is not None and stale is not client:
+            stale.disconnect()
+
+    def _get_client(self, addr: tuple[str, int]) -> TCPClient | None:
+        # Returns a connected client for addr, connecting if needed, or None if the server is down. Called with the
+        # server's lock held, but not self._lock, which is not held while connecting.
+        self._lock.acquire()
+        client = self._clients.get(addr)
+        down = self._down_until.get(addr, 0) > time.monotonic()
+        self._lock.release()
+        if client is not None and client.is_connected():
+            return client
+        if down:
+            return None
+        client = TCPClient(*addr, **self._client_kwargs)
+        try:
+            connected = client.connect()
+        except OSError as e:
+            logger.warning("Could not connect to %s, failing over", format_addr(addr), exc_info=e)
+            connected = False
+        if not connected:
+            self._mark_down(addr, client)
+            return None
+        self._lock.acquire()
+        on_ring = addr in self._ring
+        if on_ring:
+            self._down_until.pop(addr, None)
+            self._clients[addr] = client
+        self._lock.release()
+        if not on_ring:  # Removed while connecting
+            client.disconnect()
+            return None
+        return client
+
+    def _send(self, key, send) -> bool:
+        self._lock.acquire()
+        preference = list(self._ring.preference(key))
+        self._lock.release()
+        for addr in preference:
+            server_lock = self._server_lock(addr)
+            if server_lock is None:
+                continue
+            server_lock.acquire()
+            try:
+                client = self._get_client(addr)
+                if client is None:
+                    continue
+                try:
+                    if send(client):
+                        return True
+                except OSError as e:
+                    logger.warning("Could not send to %s, failing over", format_addr(addr), exc_info=e)
+                self._mark_down(addr, client)
+            finally:
+                server_lock.release()
+        return False
+
+    def send(self, key, data: bytes, priority: bool = False) -> bool:
+        """
+        Sends data to the server key belongs to, or to the next server on the ring that is up if it is down. key can
+        be bytes, a str, or anything with a stable str(). Returns True on successful transmission, False if no server
+        could take the message.
+        """
+        return self._send(key, lambda client: client.send(data, priority))
+
+    def send_obj(self, key, obj, codec: str | Codec = None, priority: bool = False) -> bool:
+        """
+        Encodes obj like TCPClient.send_obj() and sends it to the server key belongs to, failing over like send().
+        Returns True on successful transmission, False if no server could take the message.
+        """
+        return self._send(key, lambda client: client.send_obj(obj, codec, priority))
+
+    def disconnect(self):
+        """
+        Disconnects from every server
+        """
+        self._lock.acquire()
+        clients = list(self._clients.values())
+        self._clients.clear()
+        self._down_until.clear()
+        self._lock.release()
+        for client in clients:
+            client.disconnect()
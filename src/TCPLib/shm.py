@@ -0,0 +1,186 @@
+"""
+shm.py
+Written by: Joshua Kitchen - 2024
+
+Shared memory fast path for large messages between peers on the same machine. Instead of sending a large payload
+through the socket, the sender writes it to a file in a memory-backed directory (/dev/shm where available) and sends
+a small descriptor frame naming the file. The receiver maps the file and gets the payload as a view of the mapping,
+without the payload ever being copied through the kernel's socket buffers.
+
+Lifecycle of a segment:
+    - The receiver unlinks the file as soon as it has mapped it, so the name disappears while the receiver holds the
+      only reference. The memory is freed when the last view of the mapping is released or garbage collected.
+    - The sender remembers the segments it has sent and forgets those the receiver has unlinked. When its connection
+      closes, descriptors may still be waiting in the socket buffers for the peer to read, so the segments which are
+      still there are unlinked after a grace period (see unlink_later()) rather than at once. A segment the peer has
+      not read by then is lost, and one which is still there when the sending process exits is left behind.
+
+Segment names are tied to a connection. Each receiving end picks a random token (see new_token()) and tells only its
+peer, which puts the token in the name of every segment it sends there. A receiver maps only the segments carrying its
+own token, so a client sharing shm_dir cannot make its connection read or remove the segments of another connection,
+even though the names are visible in the directory.
+"""
+import ipaddress
+import mmap
+import os
+import re
+import secrets
+import socket
+import struct
+import tempfile
+import threading
+
+_PREFIX = "tcplib-"
+_TOKEN_PATTERN = re.compile(r"[0-9a-f]{16}")
+_NAME_PATTERN = re.compile(r"tcplib-[0-9a-f]{16}-[A-Za-z0-9_]+")
+_DESCRIPTOR = struct.Struct('>Q')
+
+
+class InvalidShmDescriptor(Exception):
+    pass
+
+
+def is_supported() -> bool:
+    """
+    Returns a boolean flag indicating whether the shared memory fast path can be used on this platform. Windows cannot
+    remove a file which is still mapped, so it is not supported there.
+    """
+    return os.name != "nt" and hasattr(socket, "AF_UNIX")
+
+
+def default_shm_dir() -> str:
+    """
+    Returns the directory segments are created in when none is given: /dev/shm if it exists, otherwise the temporary
+    directory.
+    """
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def is_local(soc: socket.socket) -> bool:
+    """
+    Returns a boolean flag indicating whether the peer of a connected socket is on the same machine, which is true
+    for Unix domain sockets and loopback TCP connections.
+    """
+    if soc.family == getattr(socket, "AF_UNIX", None):
+        return True
+    try:
+        host = soc.getpeername()[0]
+        return ipaddress.ip_address(host).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+def new_token() -> str:
+    """
+    Returns a new random token for the names of the segments a connection receives
+    """
+    return secrets.token_hex(8)
+
+
+def is_valid_token(token: str) -> bool:
+    return bool(_TOKEN_PATTERN.fullmatch(token))
+
+
+def write_segment(parts: list, shm_dir: str, token: str) -> tuple[str, int]:
+    """
+    Writes a list of bytes-like objects back to back into a new segment in shm_dir, named with the receiver's token.
+    The file is only readable by the current user. Returns the name of the segment and the number of bytes written.
+    Raises OSError.
+    """
+    fd, path = tempfile.mkstemp(prefix=f"{_PREFIX}{token}-", dir=shm_dir)
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for part in parts:
+                size += f.write(part)
+    except OSError as e:
+        unlink_segment(os.path.basename(path), shm_dir)
+        raise e
+    return os.path.basename(path), size
+
+
+def encode_descriptor(name: str, size: int) -> bytes:
+    """
+    DESCRIPTOR STRUCTURE:
+    [Payload size (8 bytes)] [Segment name (UTF-8)]
+    """
+    return _DESCRIPTOR.pack(size) + name.encode('utf-8')
+
+
+def decode_descriptor(descriptor: bytes, token: str | None) -> tuple[str, int]:
+    """
+    Returns the segment name and payload size from a descriptor. Raises InvalidShmDescriptor if the descriptor does
+    not name a segment created by this library for the receiver with the given token (None if the receiver never
+    agreed to shared memory), so a peer cannot make the receiver open or remove any other file.
+    """
+    if len(descriptor) <= _DESCRIPTOR.size:
+        raise InvalidShmDescriptor("Shared memory descriptor is too short")
+    size = _DESCRIPTOR.unpack_from(descriptor)[0]
+    name = bytes(descriptor[_DESCRIPTOR.size:]).decode('utf-8', 'replace')
+    if not _NAME_PATTERN.fullmatch(name):
+        raise InvalidShmDescriptor(f"'{name}' is not the name of a shared memory segment")
+    if token is None or not name.startswith(f"{_PREFIX}{token}-"):
+        raise InvalidShmDescriptor(f"Shared memory segment '{name}' was not sent to this connection")
+    return name, size
+
+
+def map_segment(descriptor: bytes, shm_dir: str, token: str | None) -> memoryview:
+    """
+    Maps the segment named by a descriptor, unlinks it and returns a writable view of the payload. Only segments named
+    with the receiver's token are accepted (see decode_descriptor()). Writes to the view are private to the receiver.
+    Raises InvalidShmDescriptor and OSError.
+    """
+    name, size = decode_descriptor(descriptor, token)
+    path = os.path.join(shm_dir, name)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.unlink(path)
+        if os.fstat(fd).st_size < size:
+            raise InvalidShmDescriptor(f"Shared memory segment '{name}' is smaller than the {size} bytes described")
+        if size == 0:
+            return memoryview(bytearray())
+        mapping = mmap.mmap(fd, size, access=mmap.ACCESS_COPY)
+    finally:
+        os.close(fd)
+    return memoryview(mapping)
+
+
+def unlink_segment(name: str, shm_dir: str):
+    """
+    Removes a segment if it still exists
+    """
+    try:
+        os.unlink(os.path.join(shm_dir, name))
+    except FileNotFoundError:
+        pass
+
+
+def existing_segments(names, shm_dir: str) -> set:
+    """
+    Returns the names of the segments which have not been unlinked yet
+    """
+    return {name for name in names if os.path.exists(os.path.join(shm_dir, name))}
+
+
+def _unlink_segments(names, shm_dir: str):
+    for name in names:
+        unlink_segment(name, shm_dir)
+
+
+def unlink_later(names, shm_dir: str, delay: float):
+    """
+    Removes the segments which still exist after delay seconds, which gives the peer time to read descriptors still
+    waiting in the socket buffers. The removal runs on a daemon timer thread; with a delay of zero or less the
+    segments are removed at once.
+    """
+    names = existing_segments(names, shm_dir)
+    if not names:
+        return
+    if delay <= 0:
+        _unlink_segments(names, shm_dir)
+        return
+    timer = threading.Timer(delay, _unlink_segments, args=(names, shm_dir))
+    timer.daemon = True
+    timer.start()
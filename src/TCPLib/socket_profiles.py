@@ -0,0 +1,155 @@
+"""
+socket_profiles.py
+Written by: Joshua Kitchen - 2024
+
+Named socket tuning profiles which are applied to client, listening and accepted sockets.
+"""
+import logging
+import socket
+import sys
+
+logger = logging.getLogger(__name__)
+
+# Linux option which makes connect() return at once and sends the first write in the SYN. Older Python versions do
+# not export it.
+TCP_FASTOPEN_CONNECT = getattr(socket, "TCP_FASTOPEN_CONNECT", 30)
+
+
+class UnknownProfile(Exception):
+    pass
+
+
+class SocketProfile:
+    """
+    Container class for a set of socket options.
+
+    nodelay disables Nagle's algorithm (TCP_NODELAY). sndbuf and rcvbuf set the kernel buffer sizes (SO_SNDBUF and
+    SO_RCVBUF), None leaves the OS default. backlog is the listen backlog used by servers. buff_size is the chunk size
+    used when receiving messages. If adaptive is True, the receive chunk size and kernel receive buffer of each
+    connection grow towards the sizes of the messages actually observed, up to max_buff_size and max_rcvbuf.
+    """
+
+    def __init__(self, name: str, nodelay: bool = False, sndbuf: int = None, rcvbuf: int = None,
+                 backlog: int = 128, buff_size: int = 4096, adaptive: bool = False, max_buff_size: int = 1048576,
+                 max_rcvbuf: int = 8388608):
+        self.name = name
+        self.nodelay = nodelay
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+        self.backlog = backlog
+        self.buff_size = buff_size
+        self.adaptive = adaptive
+        self.max_buff_size = max_buff_size
+        self.max_rcvbuf = max_rcvbuf
+
+    def apply(self, soc: socket.socket):
+        """
+        Applies the profile's options to a socket. Options the socket does not support (for example TCP_NODELAY on a
+        Unix domain socket) are skipped.
+        """
+        if self.nodelay:
+            _set_opt(soc, socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.sndbuf is not None:
+            _set_opt(soc, socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        if self.rcvbuf is not None:
+            _set_opt(soc, socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+
+    def __repr__(self):
+        return f"SocketProfile({self.name!r})"
+
+
+def _set_opt(soc: socket.socket, level: int, opt: int, value: int) -> bool:
+    try:
+        soc.setsockopt(level, opt, value)
+        return True
+    except OSError:
+        logger.debug("Socket option %d could not be set on %s", opt, soc)
+        return False
+
+
+def _fast_open_supported(soc: socket.socket) -> bool:
+    return sys.platform.startswith("linux") and soc.family in (socket.AF_INET, socket.AF_INET6)
+
+
+def set_fast_open_listener(soc: socket.socket, queue_len: int = 256) -> bool:
+    """
+    Enables TCP Fast Open on a listening socket, which must not be listening yet, so clients which have connected
+    before can send data in their SYN. Up to queue_len such connections may be waiting to be accepted. Only supported
+    on Linux, where the net.ipv4.tcp_fastopen sysctl must also allow it. Returns True if the option was set.
+    """
+    if not _fast_open_supported(soc):
+        return False
+    return _set_opt(soc, socket.IPPROTO_TCP, socket.TCP_FASTOPEN, queue_len)
+
+
+def set_fast_open_connect(soc: socket.socket) -> bool:
+    """
+    Enables TCP Fast Open on a client socket before connect(). connect() then returns immediately and the first data
+    written goes in the SYN once the server has issued the client a cookie; otherwise the connection falls back to the
+    normal handshake. Only supported on Linux. Returns True if the option was set.
+    """
+    if not _fast_open_supported(soc):
+        return False
+    return _set_opt(soc, socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT, 1)
+
+
+PROFILES = {
+    "default": SocketProfile("default"),
+    "low_latency": SocketProfile("low_latency", nodelay=True, buff_size=16384),
+    "bulk_throughput": SocketProfile("bulk_throughput", sndbuf=4194304, rcvbuf=4194304, backlog=1024,
+                                     buff_size=262144),
+    "adaptive": SocketProfile("adaptive", nodelay=True, adaptive=True),
+}
+
+
+def get_profile(profile: str | SocketProfile | None) -> SocketProfile:
+    """
+    Returns the SocketProfile for a profile name. SocketProfile objects are returned unchanged and None returns the
+    default profile. Raises UnknownProfile if no profile with that name exists.
+    """
+    if profile is None:
+        return PROFILES["default"]
+    if isinstance(profile, SocketProfile):
+        return profile
+    try:
+        return PROFILES[profile]
+    except KeyError:
+        raise UnknownProfile(f"No socket profile named '{profile}'. Choose from {list(PROFILES.keys())}")
+
+
+class AdaptiveBuffer:
+    """
+    Tracks the sizes of messages received on one connection and grows the receive chunk size and the kernel receive
+    buffer to match. Sizes only ever grow, so a connection which has carried large messages keeps its large buffers.
+    """
+
+    def __init__(self, profile: SocketProfile):
+        self._max_buff_size = profile.max_buff_size
+        self._max_rcvbuf = profile.max_rcvbuf
+        self._buff_size = profile.buff_size
+        self._rcvbuf = profile.rcvbuf or 0
+        self._avg_size = 0.0
+
+    def buff_size(self) -> int:
+        """
+        Returns the current receive chunk size
+        """
+        return self._buff_size
+
+    def observe(self, msg_size: int, soc: socket.socket = None) -> int:
+        """
+        Records the size of a received message and returns the new receive chunk size. If soc is given, its kernel
+        receive buffer is grown when the chunk size grows.
+        """
+        # Exponentially weighted moving average so a single outlier does not blow up the buffers
+        self._avg_size += (msg_size - self._avg_size) / 8
+        target = 1 << max(int(self._avg_size) - 1, 0).bit_length()
+        target = min(target, self._max_buff_size)
+        if target <= self._buff_size:
+            return self._buff_size
+        self._buff_size = target
+        if soc is not None:
+            rcvbuf = min(target * 4, self._max_rcvbuf)
+            if rcvbuf > self._rcvbuf and _set_opt(soc, socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf):
+                self._rcvbuf = rcvbuf
+        return self._buff_size
@@ -0,0 +1,233 @@
+"""
+spool.py
+Written by: Joshua Kitchen - 2024
+
+Durable outbound spool for TCPClient. Messages are appended to a log of memory-mapped segment files before they are
+sent, each with a sequence number. The receiving ClientProcessor acknowledges every spooled message once it is in the
+server's queue, and acknowledged segments are deleted. After a reconnect, or after the process restarts and opens the
+same directory, every unacknowledged message is sent again, so delivery is at-least-once: a message whose
+acknowledgement was lost is delivered twice.
+
+SEGMENT FILE STRUCTURE ({first sequence number:020d}.seg, preallocated to segment_size):
+[Record] [Record] ... [Zeros]
+
+RECORD STRUCTURE:
+[Data size (4 bytes)] [CRC32 of sequence number and data (4 bytes)] [Sequence number (8 bytes)] [Data]
+"""
+import collections
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+_RECORD = struct.Struct('>IIQ')
+_SEQ = struct.Struct('>Q')
+SEQ_SIZE = _SEQ.size
+
+_SEGMENT_SUFFIX = ".seg"
+_ACK_FILE = "acked"
+
+
+def encode_seq(seq: int) -> bytes:
+    return _SEQ.pack(seq)
+
+
+def decode_seq(data: bytes) -> int:
+    return _SEQ.unpack_from(data)[0]
+
+
+class _Segment:
+    def __init__(self, path: str, size: int = None):
+        self.path = path
+        self.last_seq = None
+        self.write_pos = 0
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if size is not None:
+                os.ftruncate(fd, size)
+            self.size = os.fstat(fd).st_size
+            self.map = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+
+    def recover(self):
+        """
+        Yields (sequence number, offset of data, data size) for every intact record and leaves write_pos after the
+        last one. A record which was only partly written when the process stopped fails its CRC and ends the scan.
+        """
+        pos = 0
+        while pos + _RECORD.size <= self.size:
+            size, crc, seq = _RECORD.unpack_from(self.map, pos)
+            end = pos + _RECORD.size + size
+            if size == 0 and crc == 0 or end > self.size:
+                break
+            if zlib.crc32(self.map[pos + 8:end]) != crc:
+                break
+            yield seq, pos + _RECORD.size, size
+            self.last_seq = seq
+            pos = end
+        self.write_pos = pos
+
+    def fits(self, size: int) -> bool:
+        return self.write_pos + _RECORD.size + size <= self.size
+
+    def append(self, seq: int, data) -> int:
+        view = memoryview(data).cast('B')
+        start = self.write_pos + _RECORD.size
+        self.map[start:start + view.nbytes] = view
+        crc = zlib.crc32(view, zlib.crc32(encode_seq(seq)))
+        # The header is written last so a record is only found by recover() once its data is in place
+        _RECORD.pack_into(self.map, self.write_pos, view.nbytes, crc, seq)
+        self.write_pos = start + view.nbytes
+        self.last_seq = seq
+        return start
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+
+
+class Spool:
+    """
+    Append-only log of outbound messages in directory, split into segment files of segment_size bytes (a message
+    larger than that gets a segment of its own). After every fsync_every appends the active segment is flushed to
+    disk; 1 makes every message durable before it is sent, larger values trade the last few messages on a crash for
+    throughput, and 0 leaves flushing to the OS and to flush().
+    """
+
+    def __init__(self, directory: str, segment_size: int = 64 * 1024 * 1024, fsync_every: int = 1):
+        self._dir = directory
+        self._segment_size = segment_size
+        self._fsync_every = fsync_every
+        self._since_fsync = 0
+        self._lock = threading.Lock()
+        self._segments = []
+        self._records = collections.deque()  # (seq, segment, offset, size) of unacknowledged records
+        os.makedirs(directory, exist_ok=True)
+        fd = os.open(os.path.join(directory, _ACK_FILE), os.O_RDWR | os.O_CREAT, 0o600)
+        self._ack_file = os.fdopen(fd, 'r+b', buffering=0)
+        acked = self._ack_file.read(SEQ_SIZE)
+        self._acked = decode_seq(acked) if len(acked) == SEQ_SIZE else 0
+        self._next_seq = self._acked + 1
+        self._open_segments()
+
+    def _open_segments(self):
+        names = sorted(name for name in os.listdir(self._dir) if name.endswith(_SEGMENT_SUFFIX))
+        for name in names:
+            path = os.path.join(self._dir, name)
+            if os.path.getsize(path) == 0:  # Created but never preallocated
+                os.unlink(path)
+                continue
+            segment = _Segment(path)
+            for seq, offset, size in segment.recover():
+                if seq > self._acked:
+                    self._records.append((seq, segment, offset, size))
+                self._next_seq = max(self._next_seq, seq + 1)
+            self._segments.append(segment)
+        self._remove_acked_segments()
+
+    def _remove_acked_segments(self):
+        # The last segment is kept since it is the one being appended to
+        while len(self._segments) > 1:
+            segment = self._segments[0]
+            if segment.last_seq is not None and segment.last_seq > self._acked:
+                return
+            segment.close()
+            os.unlink(segment.path)
+            self._segments.pop(0)
+
+    def directory(self) -> str:
+        return self._dir
+
+    def append(self, data) -> int:
+        """
+        Appends a message to the spool. Returns its sequence number.
+        """
+        size = memoryview(data).nbytes
+        self._lock.acquire()
+        try:
+            seq = self._next_seq
+            segment = self._segments[-1] if self._segments else None
+            if segment is None or not segment.fits(size):
+                if segment is not None:
+                    segment.flush()
+                path = os.path.join(self._dir, f"{seq:020d}{_SEGMENT_SUFFIX}")
+                segment = _Segment(path, max(self._segment_size, _RECORD.size + size))
+                self._segments.append(segment)
+            offset = segment.append(seq, data)
+            self._records.append((seq, segment, offset, size))
+            self._next_seq = seq + 1
+            self._since_fsync += 1
+            if self._fsync_every and self._since_fsync >= self._fsync_every:
+                segment.flush()
+                self._since_fsync = 0
+        finally:
+            self._lock.release()
+        return seq
+
+    def ack(self, seq: int):
+        """
+        Marks every message up to and including seq as delivered and deletes segments holding only delivered
+        messages. The acknowledged position is written to disk without waiting for it, so after a crash a few
+        delivered messages may be sent again.
+        """
+        self._lock.acquire()
+        if seq <= self._acked:
+            self._lock.release()
+            return
+        self._acked = seq
+        while self._records and self._records[0][0] <= seq:
+            self._records.popleft()
+        self._ack_file.seek(0)
+        self._ack_file.write(encode_seq(seq))
+        self._remove_acked_segments()
+        self._lock.release()
+
+    def pending(self) -> int:
+        """
+        Returns the number of messages which have not been acknowledged
+        """
+        return len(self._records)
+
+    def acked(self) -> int:
+        """
+        Returns the sequence number of the last acknowledged message
+        """
+        return self._acked
+
+    def unacked(self) -> list[tuple[int, bytes]]:
+        """
+        Returns (sequence number, data) for every unacknowledged message, oldest first. The data is copied out of the
+        segments, so it stays valid after the segments are acknowledged and removed.
+        """
+        self._lock.acquire()
+        out = [(seq, segment.map[offset:offset + size]) for seq, segment, offset, size in self._records]
+        self._lock.release()
+        return out
+
+    def flush(self):
+        """
+        Flushes every segment to disk
+        """
+        self._lock.acquire()
+        for segment in self._segments:
+            segment.flush()
+        self._since_fsync = 0
+        self._lock.release()
+
+    def close(self):
+        """
+        Flushes and closes the spool. Unacknowledged messages stay in the directory for the next Spool opened on it.
+        """
+        self._lock.acquire()
+        for segment in self._segments:
+            segment.flush()
+            segment.close()
+        self._segments.clear()
+        self._records.clear()
+        os.fsync(self._ack_file.fileno())
+        self._ack_file.close()
+        self._lock.release()
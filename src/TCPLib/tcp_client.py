@@ -2,15 +2,30 @@
 tcp_client.py
 Written by: Joshua Kitchen - 2024
 """
+import collections
 import logging
+import math
+import select
 import socket
+import threading
+import time
 from typing import Generator
 
 from .message import Message
-from .utils import encode_msg, decode_header
+from . import events, pubsub, shm
+from .budget import MemoryBudget
+from .coalesce import WriteCoalescer
+from .spool import Spool, SEQ_SIZE, encode_seq, decode_seq
+from .serialization import Codec, ArrayCodec, get_codec, require_numpy
+from .socket_profiles import SocketProfile, AdaptiveBuffer, get_profile, set_fast_open_connect
+from .utils import encode_msg, encode_header, decode_header, format_addr, has_flags, HEADER_SIZE, FLAGS_SIZE, \
+    MSG_FLAG_PRIORITY, MSG_FLAG_SHM, MSG_FLAG_CONTROL, MSG_FLAG_TOPIC, MSG_FLAG_SPOOL, MSG_FLAG_ACK
 
 logger = logging.getLogger(__name__)
 
+# Flags of the frame each end sends the token for the shared memory segments it receives in (see shm.py)
+_SHM_TOKEN_FLAGS = MSG_FLAG_SHM | MSG_FLAG_CONTROL
+
 
 class NoAddressSupplied(Exception):
     pass
@@ -20,34 +35,169 @@ class NegativeBufferValue(Exception):
     pass
 
 
+class BufferTooSmall(Exception):
+    pass
+
+
+class MessageTooLarge(Exception):
+    pass
+
+
 class TCPClient:
     """
-    A basic TCP client.
+    A basic TCP client. The profile argument takes the name of a socket tuning profile (see socket_profiles.py) or
+    a SocketProfile object. The codec argument takes the name of a codec (see serialization.py) or a Codec object and
+    is used by send_obj() and receive_obj().
+
+    If unix_path is given, the client connects to a TCPServer listening on that Unix domain socket path instead of
+    host and port, which avoids the TCP stack for processes on the same machine. Framing and methods are identical.
+
+    If shm_threshold is given and the server is on the same machine and also has shared memory enabled, messages of
+    at least shm_threshold bytes are passed through a shared memory segment in shm_dir instead of the socket, and
+    received ones arrive as a Message whose data is a memoryview of the segment (see shm.py). Both ends must use the
+    same shm_dir and run as the same user.
+
+    If spool is given (a directory or a Spool object), every message sent is first appended to a durable spool and
+    kept until the server acknowledges it. Unacknowledged messages are sent again after connect(), including after a
+    restart of the process, so nothing is lost when the connection drops (see spool.py). A client which only sends
+    reads the server's acknowledgements every few sends; any other messages found while doing so are kept for
+    receive_all(). Receives are serialized with a lock so this never interleaves with a receive on another thread.
+
+    If max_msg_size is given, a message larger than max_msg_size bytes is refused as soon as its header arrives: the
+    connection is closed and MessageTooLarge is raised before anything is allocated for it.
+
+    If batch_window (in seconds) or batch_bytes is given, sends are coalesced: frames are held for up to batch_window
+    seconds, or until batch_bytes bytes are waiting, and then written together with one vectored write (see
+    coalesce.py). A send returns once its frame is queued, and failures show up on a later send or flush(). flush()
+    writes waiting frames immediately, and batch_stats() reports the batch sizes achieved.
+
+    If optimistic is True, connect() returns as soon as the socket is connected, without waiting a round trip for the
+    server to accept the connection, so the first messages can be sent straight away. The server's reply is read
+    before the first message received, or by wait_accepted(). A server which refuses the connection discards anything
+    sent before the reply; the refusal shows up as a closed connection on the next receive, or as False from
+    wait_accepted(). If fast_open is True, TCP Fast Open is enabled on Linux, so once the server has issued a cookie
+    the first write of a new connection is carried in the SYN (see socket_profiles.set_fast_open_connect()).
     """
 
-    def __init__(self, host: str = None, port: int = None, timeout: int = None):
+    # Most systems limit a single sendmsg() call to 1024 buffers
+    _IOV_MAX = 1024
+    _ARRAY_CODEC = ArrayCodec()
+    # How often (in seconds) a receive waiting for memory budget checks whether the connection has been closed
+    _BUDGET_POLL_INTERVAL = 0.25
+    # How long (in seconds) shared memory segments which have not been read are kept after the connection closes, so
+    # the peer can still read descriptors waiting in the socket buffers (see shm.unlink_later())
+    _SHM_LINGER = 30.0
+    # Number of remembered segment names at which those the receiver has already unlinked are forgotten
+    _SHM_PRUNE_AT = 64
+    # Number of spooled sends between checks for acknowledgements waiting on the socket
+    _ACK_DRAIN_EVERY = 64
+    # Largest reply to a new connection the client reads; anything longer is not one the server sends
+    _MAX_REPLY_SIZE = 64
+
+    def __init__(self, host: str = None, port: int = None, timeout: int = None,
+                 profile: str | SocketProfile = None, codec: str | Codec = None, unix_path: str = None,
+                 shm_threshold: int = None, shm_dir: str = None, spool: str | Spool = None,
+                 max_msg_size: int = None, batch_window: float = None, batch_bytes: int = None,
+                 optimistic: bool = False, fast_open: bool = False):
         self._soc = None
-        self._addr = (host, port)
+        if unix_path is not None:
+            self._family = socket.AF_UNIX
+            self._addr = unix_path
+        else:
+            self._family = socket.AF_INET
+            self._addr = (host, port)
         self._timeout = timeout
         self._is_connected = False
+        self._profile = get_profile(profile)
+        self._adaptive = None
+        self._recv_flags = 0  # Flags of the message currently being received
+        self._recv_topic = None  # Topic of the message currently being received, if it was published on one
+        self._codec = get_codec(codec)
+        self._shm_threshold = shm_threshold
+        self._shm_dir = shm_dir if shm_dir is not None else shm.default_shm_dir()
+        self._peer_shm = False  # Whether the peer has said it can receive shared memory messages
+        self._shm_token = None  # Token in the names of the segments this end accepts (see shm.py)
+        self._peer_shm_token = None  # Token in the names of the segments sent to the peer
+        self._shm_sent = set()  # Names of segments sent on this connection
+        self._shm_prune_at = self._SHM_PRUNE_AT
+        self._event_id = None  # Client id recorded with events, set for clients created by a server
+        self._spool = Spool(spool) if isinstance(spool, str) else spool
+        self._recv_seq = None  # Spool sequence number of the message currently being received
+        self._stash = collections.deque()  # Messages received by wait_acked() and _drain_acks()
+        self._spooled_sends = 0
+        self._recv_lock = threading.Lock()  # Held while a message is being received
+        self._max_msg_size = max_msg_size
+        self._budget = None
+        self._batch_window = batch_window
+        self._batch_bytes = batch_bytes
+        self._coalescer = None
+        self._last_batch_stats = None  # Batch statistics of the previous connection
+        self._optimistic = optimistic
+        self._fast_open = fast_open
+        self._handshake_pending = False  # Whether the server's reply to an optimistic connect is still unread
 
     @classmethod
-    def from_socket(cls, soc: socket.socket):
+    def from_socket(cls, soc: socket.socket, profile: str | SocketProfile = None, codec: str | Codec = None,
+                    shm_threshold: int = None, shm_dir: str = None, event_id=None, max_msg_size: int = None,
+                    budget: MemoryBudget = None, batch_window: float = None, batch_bytes: int = None,
+                    shm_token: str = None):
         """
         Allows for a client to be created from a socket object.
-        The socket must be initialized and connected.
+        The socket must be initialized and connected. event_id is the client id recorded with the client's events
+        (see events.py). If budget is given, receive_all() takes the size of each message from it before reading the
+        message; whoever consumes the message must give it back. shm_token is the token sent to the peer when shared
+        memory messages were offered to it, which the names of the segments it sends must carry.
         """
-        out = cls(None, None, soc.gettimeout())
+        out = cls(None, None, soc.gettimeout(), profile, codec, shm_threshold=shm_threshold, shm_dir=shm_dir,
+                  max_msg_size=max_msg_size, batch_window=batch_window, batch_bytes=batch_bytes)
+        out._event_id = event_id
+        out._budget = budget
+        out._shm_token = shm_token
         out._soc = soc
         out._addr = soc.getpeername()
         out._is_connected = True
+        out._apply_profile()
+        out._start_coalescer()
         return out
 
+    def _apply_profile(self):
+        self._profile.apply(self._soc)
+        if self._profile.adaptive:
+            self._adaptive = AdaptiveBuffer(self._profile)
+
+    def _start_coalescer(self):
+        if self._batch_window is None and self._batch_bytes is None:
+            return
+        self._coalescer = WriteCoalescer(self._write_buffers, self._batch_window, self._batch_bytes,
+                                         self._on_batch_error, f"WriteCoalescer-{format_addr(self._addr)}")
+
+    def _on_batch_error(self, e: OSError):
+        logger.debug("Exception while writing a batch to %s", format_addr(self._addr), exc_info=e)
+        self._clean_up()
+
     def _clean_up(self):
-        if self._soc is not None:
-            self._soc.close()
-            self._soc = None
+        # Can run on two threads at once, since shutting the socket down wakes any other thread using it, which then
+        # cleans up too. Each resource is swapped out in one step so only one of them releases it.
+        coalescer, self._coalescer = self._coalescer, None
+        if coalescer is not None:
+            coalescer.close()
+            self._last_batch_stats = coalescer.stats()
+        soc, self._soc = self._soc, None
+        if soc is not None:
+            try:
+                # close() alone neither wakes a thread blocked receiving on the socket nor, while one is, tells the peer
+                soc.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            soc.close()
         self._is_connected = False
+        self._handshake_pending = False
+        self._peer_shm = False
+        self._shm_token = None
+        self._peer_shm_token = None
+        shm_sent, self._shm_sent = self._shm_sent, set()
+        if shm_sent:
+            shm.unlink_later(shm_sent, self._shm_dir, self._SHM_LINGER)
 
     def is_connected(self) -> bool:
         """
@@ -76,6 +226,48 @@ class TCPClient:
             self._soc.settimeout(self._timeout)
             return True
 
+    def profile(self) -> SocketProfile:
+        """
+        Returns the SocketProfile applied to the client's socket
+        """
+        return self._profile
+
+    def buff_size(self) -> int:
+        """
+        Returns the chunk size used by receive() and receive_all() when no buff_size is passed. With an adaptive
+        profile, this grows as larger messages are received.
+        """
+        if self._adaptive is not None:
+            return self._adaptive.buff_size()
+        return self._profile.buff_size
+
+    def codec(self) -> Codec:
+        """
+        Returns the Codec used by send_obj() and receive_obj()
+        """
+        return self._codec
+
+    def set_codec(self, codec: str | Codec):
+        """
+        Sets the codec used by send_obj() and receive_obj(). Raises UnknownCodec if no codec with that name exists.
+        """
+        self._codec = get_codec(codec)
+
+    def shm_enabled(self) -> bool:
+        """
+        Returns a boolean flag indicating whether large messages are sent to the peer through shared memory
+        """
+        return self._peer_shm
+
+    def shm_allowed(self) -> bool:
+        """
+        Returns a boolean flag indicating whether shared memory messages can be used on the current connection: the
+        client must have a shm_threshold, the platform must support it and the peer must be on the same machine.
+        """
+        if self._shm_threshold is None or self._soc is None:
+            return False
+        return shm.is_supported() and shm.is_local(self._soc)
+
     def set_addr(self, host: str, port: int):
         """
         Allows for the address to be changed after class creation. If the server is running, this function will do
@@ -83,11 +275,22 @@ class TCPClient:
         """
         if self._is_connected:
             return
+        self._family = socket.AF_INET
         self._addr = (host, port)
 
-    def addr(self) -> tuple[str, int]:
+    def set_unix_path(self, path: str):
         """
-        Returns a tuple with the host's ip (str) and the port (int)
+        Makes the client connect to a Unix domain socket at path instead of a host and port. If the client is
+        connected, this function will do nothing.
+        """
+        if self._is_connected:
+            return
+        self._family = socket.AF_UNIX
+        self._addr = path
+
+    def addr(self) -> tuple[str, int] | str:
+        """
+        Returns a tuple with the host's ip (str) and the port (int), or the path of the Unix domain socket
         """
         return self._addr
 
@@ -97,19 +300,20 @@ class TCPClient:
         Returns False if server object refused the connection and True if the connection was
         accepted.
         """
-        if self._addr == (None, None):
+        if self._addr == (None, None) or self._addr is None:
             raise NoAddressSupplied("TCPClient was not given an address to connect to. Either pass it to __init__() or "
                                     "call set_addr()")
         if self._is_connected:
             return False
-        self._soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._soc = socket.socket(self._family, socket.SOCK_STREAM)
         self._soc.settimeout(self._timeout)
+        self._apply_profile()
+        if self._fast_open:
+            set_fast_open_connect(self._soc)
 
-        logger.info("Attempting to connect to %s @ %d", self._addr[0], self._addr[1])
+        logger.info("Attempting to connect to %s", format_addr(self._addr))
         try:
             self._soc.connect(self._addr)
-            size = decode_header(self._soc.recv(4))
-            msg = self._soc.recv(size)
         except TimeoutError as e:
             self._clean_up()
             raise e
@@ -122,28 +326,234 @@ class TCPClient:
         except OSError as e:
             self._clean_up()
             raise e
+        if self._optimistic:
+            return self._connect_optimistic()
+        return self._read_handshake()
 
-        if msg == b'CONNECTION ACCEPTED':
-            self._is_connected = True
-            logger.info("Successfully connected to %s @ %d", self._addr[0], self._addr[1])
-            return True
-        elif msg == b'SERVER FULL':
-            self._clean_up()
-            logger.info("Connection to %s @ %d was denied due to the server being full",
-                        self._addr[0], self._addr[1])
+    def connect_socket(self, soc: socket.socket) -> bool:
+        """
+        Completes the connection handshake over a socket which is already connected to a server, such as the socket
+        returned by TCPServer.connect_local(). Returns False if server object refused the connection and True if the
+        connection was accepted. Raises TimeoutError, ConnectionError, and OSError.
+        """
+        if self._is_connected:
             return False
+        self._soc = soc
+        self._soc.settimeout(self._timeout)
+        self._apply_profile()
+        try:
+            self._addr = soc.getpeername()
+        except OSError:
+            self._addr = None
+        return self._read_handshake()
+
+    def _read_reply(self) -> tuple[bytes | None, int]:
+        # Reads the server's reply to a new connection. Returns the reply and its flags, or None if the connection was
+        # closed first. Raises TimeoutError, ConnectionError, and OSError.
+        header = self._receive_exact(HEADER_SIZE)
+        if header is None:
+            return None, 0
+        flags = 0
+        if has_flags(header):
+            flag_byte = self._receive_exact(FLAGS_SIZE)
+            if flag_byte is None:
+                return None, 0
+            flags = flag_byte[0]
+        size = decode_header(header)
+        if size > self._MAX_REPLY_SIZE:
+            return b'', flags
+        return self._receive_exact(size) or b'', flags
+
+    def _read_handshake(self) -> bool:
+        reply, flags = self._read_reply()
+        pending = self._handshake_pending
+        self._handshake_pending = False
+        if reply == b'CONNECTION ACCEPTED':
+            if not pending:
+                self._is_connected = True
+                self._start_coalescer()
+                logger.info("Successfully connected to %s", format_addr(self._addr))
+            if flags & MSG_FLAG_SHM and not self._accept_shm():
+                logger.info("Connection to %s was closed during the handshake", format_addr(self._addr))
+                self._clean_up()
+                return False
+            if self._spool is not None and not pending:
+                self._resend_spool()
+            return True
+        self._clean_up()
+        if reply == b'SERVER FULL':
+            logger.info("Connection to %s was denied due to the server being full",
+                        format_addr(self._addr))
+        elif reply is None:
+            logger.info("Connection to %s was closed before the server replied", format_addr(self._addr))
         else:
-            self._clean_up()
-            logger.error("Unrecognized reply from %s @ %d. Size=%d", self._addr[0], self._addr[1], size)
+            logger.error("Unrecognized reply from %s", format_addr(self._addr))
+        return False
+
+    def _accept_shm(self) -> bool:
+        # The server offered shared memory messages and sent the token for the segments it receives. If shared memory
+        # can be used, tell it we can receive them too, with the token for the segments we receive. Returns False if
+        # the connection was closed.
+        token, flags = self._read_reply()
+        if token is None:
+            return False
+        token = token.decode('ascii', 'replace')
+        if flags & _SHM_TOKEN_FLAGS != _SHM_TOKEN_FLAGS or not shm.is_valid_token(token):
+            logger.warning("Ignoring an invalid shared memory offer from %s", format_addr(self._addr))
+            return True
+        if not self.shm_allowed():
+            return True
+        self._shm_token = shm.new_token()
+        if self.send_bytes(encode_msg(self._shm_token.encode('ascii'), _SHM_TOKEN_FLAGS)):
+            self._peer_shm_token = token
+            self._peer_shm = True
+            logger.debug("Using shared memory for messages of at least %d bytes to %s",
+                         self._shm_threshold, format_addr(self._addr))
+        return self._is_connected
+
+    def _connect_optimistic(self) -> bool:
+        # Treats the connection as accepted without waiting for the reply, which is read before the first message
+        self._handshake_pending = True
+        self._is_connected = True
+        self._start_coalescer()
+        logger.info("Connected to %s without waiting for the server to accept", format_addr(self._addr))
+        if self._spool is not None:
+            self._resend_spool()
+        return True
+
+    def wait_accepted(self) -> bool:
+        """
+        With optimistic connects, reads the server's reply to the connection if no receive has read it yet. Returns
+        True if the server accepted the connection, False if it refused it or the connection is closed. Raises
+        TimeoutError, ConnectionError, and OSError.
+        """
+        self._recv_lock.acquire()
+        try:
+            if self._handshake_pending:
+                return self._read_handshake()
+            return self._is_connected
+        finally:
+            self._recv_lock.release()
+
+    def spool(self) -> Spool | None:
+        """
+        Returns the client's Spool, or None if sent messages are not spooled
+        """
+        return self._spool
+
+    def _resend_spool(self):
+        unacked = self._spool.unacked()
+        if unacked:
+            logger.info("Resending %d unacknowledged messages to %s", len(unacked), format_addr(self._addr))
+        for seq, data in unacked:
+            if not self.send_buffers([encode_header(SEQ_SIZE + len(data), MSG_FLAG_SPOOL), encode_seq(seq), data]):
+                return
+
+    def _send_spooled(self, parts: list, flags: int) -> bool:
+        data = parts[0] if len(parts) == 1 else b''.join(parts)
+        seq = self._spool.append(data)
+        if self._is_connected:
+            size = memoryview(data).nbytes
+            self.send_buffers([encode_header(SEQ_SIZE + size, flags | MSG_FLAG_SPOOL), encode_seq(seq), data])
+            self._spooled_sends += 1
+            if self._spooled_sends >= self._ACK_DRAIN_EVERY:
+                self._spooled_sends = 0
+                self._drain_acks()
+        return True
+
+    def _drain_acks(self):
+        # Reads the acknowledgements waiting on the socket without blocking, so the spool of a client which only sends
+        # still shrinks and the server never blocks writing acknowledgements nobody reads. Skipped while another
+        # thread is receiving, since that thread handles them.
+        if not self._recv_lock.acquire(blocking=False):
+            return
+        try:
+            while self._is_connected and self._spool.pending():
+                readable, _, _ = select.select([self._soc], [], [], 0)
+                if not readable or not self._receive_frame():
+                    return
+        finally:
+            self._recv_lock.release()
+
+    def _receive_frame(self) -> bool:
+        # Receives one frame, handling internal frames and keeping messages for receive_all(). Returns False if the
+        # connection was closed.
+        size = self._read_header()
+        if size is None:
+            return False
+        if self._handle_internal_frame(size):
+            return True
+        msg = self._receive_body(self._read_prefixes(size))
+        if msg.data is None:
             return False
+        self._stash.append(msg)
+        return True
+
+    def wait_acked(self, timeout: float = None) -> bool:
+        """
+        Receives from the server until every spooled message has been acknowledged, for clients which otherwise only
+        send. Messages received while waiting are kept and returned by later calls to receive_all(). Returns True if
+        every message was acknowledged, False if the timeout expired or the connection was closed first. Raises
+        TimeoutError, ConnectionError, socket.gaierror, and OSError.
+        """
+        if self._spool is None:
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._recv_lock.acquire()
+        try:
+            while self._spool.pending():
+                if not self._is_connected:
+                    return False
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                readable, _, _ = select.select([self._soc], [], [], remaining)
+                if not readable or not self._receive_frame():
+                    return False
+            return True
+        finally:
+            self._recv_lock.release()
+
+    def recv_seq(self) -> int | None:
+        """
+        Returns the spool sequence number of the last message received, or None if it was not sent from a spool
+        """
+        return self._recv_seq
+
+    def recv_flags(self) -> int:
+        """
+        Returns the flags of the last message received (see utils.py)
+        """
+        return self._recv_flags
+
+    def subscribe(self, topic: str) -> bool:
+        """
+        Subscribes to messages the server publishes on topic. A topic ending in '*' subscribes to every topic starting
+        with the part before the '*'. Published messages are received like any other message, with the topic in
+        Message.topic. Returns True on successful transmission, False on failed transmission. Raises TimeoutError,
+        ConnectionError, socket.gaierror, and OSError.
+        """
+        return self.send_bytes(encode_msg(pubsub.encode_control(pubsub.CTRL_SUBSCRIBE, topic), MSG_FLAG_CONTROL))
+
+    def unsubscribe(self, topic: str) -> bool:
+        """
+        Cancels a subscription made with subscribe(). Returns True on successful transmission, False on failed
+        transmission. Raises TimeoutError, ConnectionError, socket.gaierror, and OSError.
+        """
+        return self.send_bytes(encode_msg(pubsub.encode_control(pubsub.CTRL_UNSUBSCRIBE, topic), MSG_FLAG_CONTROL))
 
     def disconnect(self):
         """
         Disconnect from the currently connected server. If no connection is opened, this method does nothing.
         """
         if self._is_connected:
+            if self._coalescer is not None:
+                try:
+                    self._coalescer.flush()
+                except OSError:
+                    pass
             self._clean_up()
-            logger.info("Disconnected from %s @ %d", self._addr[0], self._addr[1])
+            logger.info("Disconnected from %s", format_addr(self._addr))
 
     def send_bytes(self, data: bytes):
         """
@@ -152,6 +562,8 @@ class TCPClient:
         """
         if not self._is_connected:
             return False
+        if self._coalescer is not None:
+            return self.send_buffers([data])
         try:
             self._soc.sendall(data)
             return True
@@ -171,12 +583,156 @@ class TCPClient:
             self._clean_up()
             raise e
 
-    def send(self, data: bytes) -> bool:
+    def _write_buffers(self, buffers: list):
+        if not hasattr(self._soc, "sendmsg"):  # Windows has no sendmsg()
+            for buf in buffers:
+                self._soc.sendall(buf)
+            return
+        views = [memoryview(buf).cast('B') for buf in buffers]
+        while views:
+            sent = self._soc.sendmsg(views[:self._IOV_MAX])
+            # Drop whatever was fully sent and trim the first buffer that was only partly sent
+            i = 0
+            while i < len(views) and sent >= views[i].nbytes:
+                sent -= views[i].nbytes
+                i += 1
+            views = views[i:]
+            if views and sent:
+                views[0] = views[0][sent:]
+
+    def send_buffers(self, buffers: list) -> bool:
+        """
+        Send all bytes of a list of bytes-like objects back to back WITHOUT a header attached, using a single vectored
+        write where the OS supports it. Returns True on successful transmission, False on failed transmission. Raises
+        TimeoutError, ConnectionError, socket.gaierror, and OSError.
+        """
+        if not self._is_connected:
+            return False
+        try:
+            if self._coalescer is not None:
+                self._coalescer.add(buffers)
+            else:
+                self._write_buffers(buffers)
+            return True
+        except AttributeError:  # Socket was closed from another thread
+            self._clean_up()
+            return False
+        except TimeoutError as e:
+            self._clean_up()
+            raise e
+        except ConnectionError as e:
+            self._clean_up()
+            raise e
+        except socket.gaierror as e:
+            self._clean_up()
+            raise e
+        except OSError as e:
+            self._clean_up()
+            raise e
+
+    def flush(self) -> bool:
         """
-        Send all bytes of the data argument WITH a header attached. Returns True on successful transmission,
-        False on failed transmission. Raises TimeoutError, ConnectionError, socket.gaierror, and OSError.
+        Writes every frame waiting to be coalesced now, for latency-critical messages. Does nothing if sends are not
+        coalesced. Returns True on successful transmission, False on failed transmission. Raises TimeoutError,
+        ConnectionError, socket.gaierror, and OSError.
+        """
+        if not self._is_connected:
+            return False
+        if self._coalescer is None:
+            return True
+        try:
+            self._coalescer.flush()
+            return True
+        except AttributeError:  # Socket was closed from another thread
+            self._clean_up()
+            return False
+        except TimeoutError as e:
+            self._clean_up()
+            raise e
+        except ConnectionError as e:
+            self._clean_up()
+            raise e
+        except socket.gaierror as e:
+            self._clean_up()
+            raise e
+        except OSError as e:
+            self._clean_up()
+            raise e
+
+    def batch_stats(self) -> dict | None:
+        """
+        Returns the statistics of coalesced sends on the current connection, or the last one if the client is not
+        connected (see WriteCoalescer.stats()). Returns None if sends are not coalesced or the client has never
+        connected.
+        """
+        if self._coalescer is not None:
+            return self._coalescer.stats()
+        return self._last_batch_stats
+
+    def send_parts(self, parts: list, priority: bool = False) -> bool:
+        """
+        Send a list of bytes-like objects as the data of a single message WITH a header attached, without joining them
+        together first. Returns True on successful transmission, False on failed transmission. Raises TimeoutError,
+        ConnectionError, socket.gaierror, and OSError.
         """
-        return self.send_bytes(encode_msg(data))
+        size = sum(memoryview(part).nbytes for part in parts)
+        flags = MSG_FLAG_PRIORITY if priority else 0
+        events.RING.sample(events.SEND, self._event_id, size)
+        if self._spool is not None:
+            return self._send_spooled(parts, flags)
+        if self._use_shm(size):
+            return self._send_shm(parts, flags)
+        header = encode_header(size, flags)
+        return self.send_buffers([header, *parts])
+
+    def _use_shm(self, size: int) -> bool:
+        return self._peer_shm and size >= self._shm_threshold
+
+    def _send_shm(self, parts: list, flags: int) -> bool:
+        try:
+            name, size = shm.write_segment(parts, self._shm_dir, self._peer_shm_token)
+        except OSError:
+            logger.warning("Could not write a shared memory segment in %s, sending through the socket instead",
+                           self._shm_dir, exc_info=True)
+            size = sum(memoryview(part).nbytes for part in parts)
+            return self.send_buffers([encode_header(size, flags), *parts])
+        self._shm_sent.add(name)
+        if len(self._shm_sent) >= self._shm_prune_at:
+            self._shm_sent = shm.existing_segments(self._shm_sent, self._shm_dir)
+            self._shm_prune_at = max(self._SHM_PRUNE_AT, 2 * len(self._shm_sent))
+        if not self.send_bytes(encode_msg(shm.encode_descriptor(name, size), flags | MSG_FLAG_SHM)):
+            shm.unlink_segment(name, self._shm_dir)
+            self._shm_sent.discard(name)
+            return False
+        return True
+
+    def send_obj(self, obj, codec: str | Codec = None, priority: bool = False) -> bool:
+        """
+        Encodes obj with codec (the client's codec if None) and sends it as a message. Returns True on successful
+        transmission, False on failed transmission. Raises TimeoutError, ConnectionError, socket.gaierror, and
+        OSError.
+        """
+        codec = self._codec if codec is None else get_codec(codec)
+        data = codec.encode(obj)
+        if isinstance(data, list):
+            return self.send_parts(data, priority)
+        return self.send(data, priority)
+
+    def send(self, data: bytes, priority: bool = False) -> bool:
+        """
+        Send all bytes of the data argument WITH a header attached. If priority is True, the message is marked as
+        high priority, which lets it overtake other messages in a server using a PriorityMessageQueue. Returns True on
+        successful transmission, False on failed transmission. With a spool, returns True once the message is in the
+        spool, even if it could not be sent yet. Raises TimeoutError, ConnectionError, socket.gaierror, and OSError.
+        """
+        flags = MSG_FLAG_PRIORITY if priority else 0
+        size = memoryview(data).nbytes
+        events.RING.sample(events.SEND, self._event_id, size)
+        if self._spool is not None:
+            return self._send_spooled([data], flags)
+        if self._use_shm(size):
+            return self._send_shm([data], flags)
+        return self.send_bytes(encode_msg(data, flags))
 
     def receive_bytes(self, size: int) -> bytes | None:
         """
@@ -202,23 +758,201 @@ class TCPClient:
             self._clean_up()
             raise e
 
-    def receive(self, buff_size: int = 4096) -> Generator[bytes | int, None, None]:
+    def receive_bytes_into(self, buffer) -> int | None:
+        """
+        Receive bytes directly into a writable bytes-like object, such as a bytearray or memoryview, without
+        allocating. Returns the number of bytes received, 0 if the connection was closed by the other end, or None if
+        the socket was closed from another thread. Raises TimeoutError, ConnectionError, socket.gaierror, and OSError.
+        """
+        try:
+            return self._soc.recv_into(buffer)
+        except AttributeError:  # Socket was closed from another thread
+            self._clean_up()
+            return
+        except TimeoutError as e:
+            self._clean_up()
+            raise e
+        except ConnectionError as e:
+            self._clean_up()
+            raise e
+        except socket.gaierror as e:
+            self._clean_up()
+            raise e
+        except OSError as e:
+            self._clean_up()
+            raise e
+
+    def _receive_into_exact(self, view: memoryview) -> bool:
+        while view.nbytes:
+            received = self.receive_bytes_into(view)
+            if not received:
+                return False
+            view = view[received:]
+        return True
+
+    def _receive_exact(self, size: int) -> bytearray | None:
+        # Received straight into one buffer of the final size, as recv() would allocate the whole requested size again
+        # for every short read
+        buf = bytearray(size)
+        if not self._receive_into_exact(memoryview(buf)):
+            return
+        return buf
+
+    def _discard(self, size: int) -> bool:
+        while size > 0:
+            data = self.receive_bytes(min(size, self.buff_size()))
+            if not data:
+                return False
+            size -= len(data)
+        return True
+
+    def _read_header(self) -> int | None:
+        if self._handshake_pending and not self._read_handshake():
+            return
+        header = self._receive_exact(HEADER_SIZE)
+        if header is None:  # Socket was closed
+            return
+        self._recv_flags = 0
+        if has_flags(header):
+            flags = self._receive_exact(FLAGS_SIZE)
+            if flags is None:
+                return
+            self._recv_flags = flags[0]
+        size = decode_header(header)
+        if self._max_msg_size is not None and size > self._max_msg_size:
+            self._refuse(size)
+        return size
+
+    def _refuse(self, size: int):
+        logger.warning("Refusing a message of %d bytes from %s, which is larger than the limit of %d bytes",
+                       size, format_addr(self._addr), self._max_msg_size)
+        self._clean_up()
+        raise MessageTooLarge(f"Message of {size} bytes is larger than the limit of {self._max_msg_size} bytes")
+
+    def _handle_internal_frame(self, size: int) -> bool:
+        """
+        Handles frames which are meant for the client itself rather than the application. Returns True if the frame
+        was one of them.
+        """
+        if self._recv_flags & _SHM_TOKEN_FLAGS == _SHM_TOKEN_FLAGS:
+            # The peer accepted the shared memory offer made in the handshake and sent its token
+            if size > self._MAX_REPLY_SIZE:
+                self._discard(size)
+                return True
+            token = self._receive_exact(size)
+            if token is None:
+                return True
+            token = token.decode('ascii', 'replace')
+            if self._shm_token is not None and self._shm_threshold is not None and shm.is_valid_token(token):
+                self._peer_shm_token = token
+                self._peer_shm = True
+            return True
+        if self._recv_flags & MSG_FLAG_ACK:
+            seq = self._receive_exact(size)
+            if seq is not None and len(seq) == SEQ_SIZE and self._spool is not None:
+                self._spool.ack(decode_seq(seq))
+            return True
+        return False
+
+    def _read_prefixes(self, size: int) -> int | None:
+        # Strips the topic and sequence number which some frames carry before their data
+        self._recv_topic = None
+        self._recv_seq = None
+        if size is not None and self._recv_flags & MSG_FLAG_TOPIC:
+            size = self._receive_topic(size)
+        if size is not None and self._recv_flags & MSG_FLAG_SPOOL:
+            seq = self._receive_exact(SEQ_SIZE)
+            if seq is None:
+                return
+            self._recv_seq = decode_seq(seq)
+            size -= SEQ_SIZE
+        return size
+
+    def _receive_header(self) -> int | None:
+        while True:
+            size = self._read_header()
+            if size is None:
+                return
+            if not self._handle_internal_frame(size):
+                return self._read_prefixes(size)
+
+    def _receive_body(self, size: int | None) -> Message:
+        msg = Message(None, None)
+        if size is None:
+            return msg
+        if self._recv_flags & MSG_FLAG_SHM:
+            data = self._receive_shm(size)
+        elif size == 0:
+            data = bytearray()
+        else:
+            data = self._receive_exact(size)
+        if data is None:
+            return msg
+        msg.size = memoryview(data).nbytes
+        msg.data = data
+        msg.priority = bool(self._recv_flags & MSG_FLAG_PRIORITY)
+        msg.topic = self._recv_topic
+        return msg
+
+    def _receive_topic(self, size: int) -> int | None:
+        topic_size = self._receive_exact(pubsub.TOPIC_LEN_SIZE)
+        if topic_size is None:
+            return
+        topic_size = int.from_bytes(topic_size, byteorder='big')
+        topic = self._receive_exact(topic_size) if topic_size else b''
+        if topic is None:
+            return
+        self._recv_topic = topic.decode('utf-8', 'replace')
+        return size - pubsub.TOPIC_LEN_SIZE - topic_size
+
+    def _receive_shm(self, size: int) -> memoryview | None:
+        descriptor = self._receive_exact(size)
+        if descriptor is None:
+            return
+        try:
+            view = shm.map_segment(descriptor, self._shm_dir, self._shm_token)
+            if self._max_msg_size is not None and view.nbytes > self._max_msg_size:
+                view.release()
+                self._refuse(view.nbytes)
+            return view
+        except shm.InvalidShmDescriptor as e:
+            self._clean_up()
+            raise e
+        except OSError as e:
+            self._clean_up()
+            raise e
+
+    def receive(self, buff_size: int = None) -> Generator[bytes | int, None, None]:
         """
         Returns a generator for iterating over the bytes of an incoming message. An integer representing the message
-        size is yielded first. Subsequent calls yield the contents of the message as it is received. Raises
-        TimeoutError, ConnectionError, socket.gaierror, and OSError.
+        size is yielded first. Subsequent calls yield the contents of the message as it is received. If buff_size is
+        None, the chunk size from the client's profile is used. Raises TimeoutError, ConnectionError,
+        socket.gaierror, and OSError.
         """
+        self._recv_lock.acquire()
+        try:
+            yield from self._receive(buff_size)
+        finally:
+            self._recv_lock.release()
+
+    def _receive(self, buff_size: int = None) -> Generator[bytes | int, None, None]:
         if not self._is_connected:
             return
+        if buff_size is None:
+            buff_size = self.buff_size()
         if buff_size <= 0:
             raise NegativeBufferValue("Argument buff_size must be a non-zero, positive integer")
         bytes_recv = 0
-        header = self.receive_bytes(4)
-        if not header:  # Socket was closed from another thread
+        size = self._receive_header()
+        if size is None:  # Socket was closed
+            return
+        if self._recv_flags & MSG_FLAG_SHM:
+            view = self._receive_shm(size)
+            if view is None:
+                return
+            yield view.nbytes
+            yield view
             return
-        size = decode_header(header)
-        logger.debug("Incoming message from %s @ %d, SIZE=%d",
-                     self._addr[0], self._addr[1], size)
         yield size
         if size < buff_size:
             buff_size = size
@@ -232,26 +966,195 @@ class TCPClient:
                 buff_size = remaining
             yield data
 
-    def receive_all(self, buff_size: int = 4096) -> Message:
+    def receive_all(self, buff_size: int = None) -> Message:
         """
-        Receive all the bytes of an incoming message in one, easy method. Raises TimeoutError, ConnectionError,
-        socket.gaierror, and OSError.
+        Receive all the bytes of an incoming message in one, easy method. If buff_size is None, the chunk size from
+        the client's profile is used. Raises TimeoutError, ConnectionError, socket.gaierror, and OSError.
         """
+        self._recv_lock.acquire()
+        try:
+            return self._receive_all(buff_size)
+        finally:
+            self._recv_lock.release()
+
+    def _receive_all(self, buff_size: int = None) -> Message:
+        if self._stash:
+            return self._stash.popleft()
         msg = Message(None, None)
         if not self._is_connected:
             return msg
         data = bytearray()
-        gen = self.receive(buff_size)
+        gen = self._receive(buff_size)
         if not gen:
             return msg
         try:
             msg.size = next(gen)
         except StopIteration:
             return msg
-        for chunk in gen:
-            if not chunk:
-                return msg
-            data.extend(chunk)
+        if self._budget is not None and not self._acquire_budget(msg.size):
+            return msg
+        complete = False
+        try:
+            if self._recv_flags & MSG_FLAG_SHM:
+                # The whole message arrives as one view of the shared memory segment, which is used without copying
+                data = next(gen, None)
+                if data is None:
+                    return msg
+            else:
+                for chunk in gen:
+                    if not chunk:
+                        return msg
+                    data.extend(chunk)
+                if len(data) != msg.size:  # Socket was closed part way through the message
+                    return msg
+            complete = True
+        finally:
+            if not complete and self._budget is not None:
+                self._budget.release(msg.size)
         msg.data = data
-        logger.debug("Received a total of %d bytes from %s @ %d", len(data), self._addr[0], self._addr[1])
+        msg.priority = bool(self._recv_flags & MSG_FLAG_PRIORITY)
+        msg.topic = self._recv_topic
+        if self._adaptive is not None and not self._recv_flags & MSG_FLAG_SHM:
+            self._adaptive.observe(msg.size, self._soc)
+        events.RING.sample(events.RECV, self._event_id, msg.size)
+        return msg
+
+    def _acquire_budget(self, size: int) -> bool:
+        while not self._budget.acquire(size, self._BUDGET_POLL_INTERVAL):
+            if not self._is_connected:
+                return False
+        return True
+
+    def receive_obj(self, codec: str | Codec = None, buff_size: int = None) -> Message:
+        """
+        Receives a message and decodes its data with codec (the client's codec if None). Returns a Message whose data
+        is the decoded object, or whose data is None if the connection was closed. Raises TimeoutError,
+        ConnectionError, socket.gaierror, and OSError.
+        """
+        codec = self._codec if codec is None else get_codec(codec)
+        msg = self.receive_all(buff_size)
+        if msg.data is not None:
+            msg.data = codec.decode(msg.data)
         return msg
+
+    def receive_into(self, buffer) -> Message:
+        """
+        Receive the next message directly into a writable bytes-like object (a bytearray, memoryview, array.array,
+        NumPy array, etc.) with no intermediate copies. Returns a Message whose data is a memoryview of the part of
+        buffer that was filled, or whose data is None if the connection was closed. If the message is larger than the
+        buffer, it is discarded and BufferTooSmall is raised. Raises TimeoutError, ConnectionError, socket.gaierror,
+        and OSError.
+        """
+        self._recv_lock.acquire()
+        try:
+            return self._receive_into(buffer)
+        finally:
+            self._recv_lock.release()
+
+    def _receive_into(self, buffer) -> Message:
+        msg = Message(None, None)
+        if not self._is_connected:
+            return msg
+        size = self._receive_header()
+        if size is None:
+            return msg
+        view = memoryview(buffer).cast('B')
+        if self._recv_flags & MSG_FLAG_SHM:
+            segment = self._receive_shm(size)
+            if segment is None:
+                return msg
+            size = segment.nbytes
+            if size > view.nbytes:
+                raise BufferTooSmall(f"Message of {size} bytes does not fit in a buffer of {view.nbytes} bytes")
+            view[:size] = segment
+        elif size > view.nbytes:
+            self._discard(size)
+            raise BufferTooSmall(f"Message of {size} bytes does not fit in a buffer of {view.nbytes} bytes")
+        elif not self._receive_into_exact(view[:size]):
+            return msg
+        msg.size = size
+        msg.data = view[:size]
+        msg.priority = bool(self._recv_flags & MSG_FLAG_PRIORITY)
+        msg.topic = self._recv_topic
+        events.RING.sample(events.RECV, self._event_id, size)
+        return msg
+
+    def send_array(self, arr, priority: bool = False) -> bool:
+        """
+        Send a NumPy array straight from its memory, along with its dtype and shape. Arrays which are not
+        C-contiguous are copied once to make them so. Returns True on successful transmission, False on failed
+        transmission. Raises NumpyNotAvailable if NumPy is not installed. Raises TimeoutError, ConnectionError,
+        socket.gaierror, and OSError.
+        """
+        return self.send_parts(self._ARRAY_CODEC.encode(arr), priority)
+
+    def receive_array(self, out=None):
+        """
+        Receive an array sent with send_array(). The array data is received straight into the memory of the returned
+        array. If out is given, it must be a C-contiguous array with the same dtype and shape as the incoming array and
+        is filled and returned instead of allocating a new array; if it does not match, the message is discarded and
+        ValueError is raised. Returns None if the connection was closed. Raises NumpyNotAvailable if NumPy is not
+        installed. Raises TimeoutError, ConnectionError, socket.gaierror, and OSError.
+        """
+        np = require_numpy()
+        self._recv_lock.acquire()
+        try:
+            return self._receive_array(np, out)
+        finally:
+            self._recv_lock.release()
+
+    def _receive_array(self, np, out):
+        if not self._is_connected:
+            return
+        size = self._receive_header()
+        if size is None:
+            return
+        if self._recv_flags & MSG_FLAG_SHM:
+            segment = self._receive_shm(size)
+            if segment is None:
+                return
+            arr = self._ARRAY_CODEC.decode(segment)
+            if out is None:
+                return arr
+            if out.dtype != arr.dtype or out.shape != arr.shape or not out.flags.c_contiguous:
+                raise ValueError(f"Incoming array has dtype={arr.dtype} and shape={arr.shape}, which does not match "
+                                 f"out")
+            out[...] = arr
+            return out
+        # Every size below comes from the peer, so each is checked against the frame size before anything is
+        # allocated for it
+        if size < self._ARRAY_CODEC.META_HEADER_SIZE:
+            self._discard(size)
+            raise ValueError(f"Incoming array message is {size} bytes, which is too short to hold an array")
+        meta_size_bytes = self._receive_exact(self._ARRAY_CODEC.META_HEADER_SIZE)
+        if meta_size_bytes is None:
+            return
+        remaining = size - len(meta_size_bytes)
+        meta_size = self._ARRAY_CODEC.meta_size(meta_size_bytes)
+        if meta_size > remaining:
+            self._discard(remaining)
+            raise ValueError(f"Incoming array metadata is {meta_size} bytes, more than the {remaining} bytes left in "
+                             f"the message")
+        meta = self._receive_exact(meta_size)
+        if meta is None:
+            return
+        data_size = remaining - meta_size
+        try:
+            dtype, shape = self._ARRAY_CODEC.decode_meta(meta)
+            if any(dim < 0 for dim in shape):
+                raise ValueError
+            expected = math.prod(shape) * dtype.itemsize
+        except (ValueError, TypeError, KeyError):
+            self._discard(data_size)
+            raise ValueError("Incoming array metadata is not valid")
+        if data_size != expected:
+            self._discard(data_size)
+            raise ValueError(f"Incoming array data is {data_size} bytes, expected {expected}")
+        if out is None:
+            out = np.empty(shape, dtype=dtype)
+        elif out.dtype != dtype or out.shape != shape or not out.flags.c_contiguous:
+            self._discard(data_size)
+            raise ValueError(f"Incoming array has dtype={dtype} and shape={shape}, which does not match out")
+        if not self._receive_into_exact(memoryview(out.reshape(-1).view(np.uint8))):
+            return
+        return out
@@ -3,28 +3,234 @@ tcp_server.py
 Written by: Joshua Kitchen - 2024
 """
 import logging
+import os
+import selectors
 import socket
+import stat
 import threading
+import time
 import queue
 import random
+from concurrent.futures import ThreadPoolExecutor
 from typing import Generator
 
+from . import events, pubsub, shm
+from .budget import MemoryBudget
+from .capture import CaptureWriter
 from .client_processor import ClientProcessor
-from .utils import encode_msg
+from .message_queue import drain_queue
+from .rate_limit import TokenBucket
+from .serialization import Codec, get_codec
+from .socket_profiles import SocketProfile, get_profile, set_fast_open_listener
+from .tcp_client import TCPClient
+from .utils import encode_msg, format_addr, MSG_FLAG_SHM, MSG_FLAG_CONTROL
 from .message import Message
 
 logger = logging.getLogger(__name__)
 
 
+class _RejectDrainer:
+    """
+    Closes refused connections on a single thread. Closing a socket with unread data resets the connection, which can
+    destroy the refusal before the client reads it, so each socket is shut down for writing and anything the client
+    sent (such as messages an optimistic client sent before the reply) is read and thrown away until the client closes
+    its end or linger seconds pass. Handshake workers hand sockets over instead of draining them, so a server full of
+    idle peers does not hold up handshakes.
+    """
+
+    def __init__(self, linger: float):
+        self._linger = linger
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self._lock = threading.Lock()
+        self._new = []
+        self._deadlines = {}
+        self._is_running = True
+        self._thread = threading.Thread(target=self._loop, name="TCPServer-reject-drainer", daemon=True)
+        self._thread.start()
+
+    def add(self, client_soc: socket.socket):
+        """
+        Hands a refused socket over to be drained and closed
+        """
+        try:
+            client_soc.shutdown(socket.SHUT_WR)
+            client_soc.setblocking(False)
+        except OSError:
+            client_soc.close()
+            return
+        self._lock.acquire()
+        try:
+            if not self._is_running:
+                client_soc.close()
+                return
+            self._new.append(client_soc)
+            self._wake_w.send(b'\0')
+        finally:
+            self._lock.release()
+
+    def _close(self, client_soc: socket.socket):
+        self._selector.unregister(client_soc)
+        del self._deadlines[client_soc]
+        client_soc.close()
+
+    def _loop(self):
+        while True:
+            self._lock.acquire()
+            is_running = self._is_running
+            new, self._new = self._new, []
+            self._lock.release()
+            if not is_running:
+                for client_soc in new + list(self._deadlines):
+                    client_soc.close()
+                self._deadlines.clear()
+                break
+            now = time.monotonic()
+            for client_soc in new:
+                self._selector.register(client_soc, selectors.EVENT_READ)
+                self._deadlines[client_soc] = now + self._linger
+            for client_soc, deadline in list(self._deadlines.items()):
+                if deadline <= now:
+                    self._close(client_soc)
+            wait = min(self._deadlines.values()) - now if self._deadlines else None
+            for key, _ in self._selector.select(wait):
+                if key.fileobj is self._wake_r:
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                    continue
+                try:
+                    if self._drain(key.fileobj):
+                        continue
+                except OSError:
+                    pass
+                self._close(key.fileobj)
+        self._selector.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+    @staticmethod
+    def _drain(client_soc: socket.socket) -> bool:
+        # Returns False once the client has closed its end
+        while True:
+            try:
+                if not client_soc.recv(65536):
+                    return False
+            except (BlockingIOError, InterruptedError):
+                return True
+
+    def stop(self):
+        """
+        Closes every socket still being drained and stops the thread
+        """
+        self._lock.acquire()
+        self._is_running = False
+        self._wake_w.send(b'\0')  # With the lock held, as the thread closes the wake sockets once it sees the flag
+        self._lock.release()
+        self._thread.join()
+
+
 class TCPServer:
     """
     Class for creating, maintaining, and transmitting data to multiple client connections. This class can
-    accept and use an external Queue object
+    accept and use an external Queue object, such as a PriorityMessageQueue or FairMessageQueue (see
+    message_queue.py). The profile argument takes the name of a socket tuning profile (see socket_profiles.py) or a
+    SocketProfile object, which is applied to the listening socket and every accepted socket.
+
+    New connections are accepted in batches of up to accept_batch on the accept thread, and the handshake and
+    _on_connect() run on a pool of handshake_workers threads, so a slow peer cannot hold up other connections. A
+    handshake taking longer than handshake_timeout seconds drops the connection. backlog overrides the listen backlog
+    of the profile. If conn_rate is greater than zero, at most conn_rate new connections per second are accepted (with
+    bursts of up to conn_burst); connections over the limit wait in the kernel backlog.
+
+    To stop one client from dominating the queue, pass a FairMessageQueue as msg_q and/or set client_rate, which
+    limits every client to client_rate bytes per second (with bursts of up to client_burst bytes).
+
+    The codec argument takes the name of a codec (see serialization.py) or a Codec object and is used by send_obj()
+    and receive_obj().
+
+    If unix_path is given, the server listens on a Unix domain socket at that path instead of host and port. Clients
+    in the same process can also connect without any listening socket through connect_local().
+
+    If shm_threshold is given, the server offers shared memory messages to clients on the same machine during the
+    handshake. Messages of at least shm_threshold bytes to and from clients which accept the offer go through shared
+    memory segments in shm_dir instead of the socket (see TCPClient and shm.py).
+
+    Clients can subscribe to topics (see TCPClient.subscribe()) and publish() sends a message to every subscriber of a
+    topic. Each subscriber has a buffer of up to sub_buffer published messages; when a subscriber falls that far
+    behind, slow_consumer decides whether new messages for it are dropped ('drop') or it is disconnected
+    ('disconnect'). See pubsub.py.
+
+    A client which sends a message larger than max_msg_size bytes is disconnected as soon as the message's header
+    arrives. If mem_budget is greater than zero, received messages waiting in the queue may hold at most mem_budget
+    bytes between them: once the budget is used up, clients are not read from until messages are popped, which pushes
+    back on them through TCP. max_msg_size is lowered to mem_budget if it is larger or not given. Messages count
+    against the budget until they are popped with pop_msg(), pop_msgs(), get_all_msg() or receive_obj(), so an
+    application reading an external msg_q directly should not set mem_budget. See memory_stats().
+
+    If batch_window or batch_bytes is given, sends to each client are coalesced as described for TCPClient. flush()
+    writes a client's waiting frames immediately and batch_stats() reports the batch sizes achieved.
+
+    If fast_open is True, TCP Fast Open is enabled on the listening socket (Linux only), so clients which also enable
+    it can send their first message in the SYN of later connections. A refused connection is drained before it is
+    closed, on a thread of its own, so anything an optimistic client sent before reading the refusal is discarded (see
+    TCPClient).
+
+    If capture is given, every message received from clients is recorded, with its client id and arrival time, for
+    replaying later (see capture.py and replay.py). capture is either the path of a capture file, which is opened on
+    start() and closed on stop(), or a CaptureWriter owned by the caller, which is only flushed on stop().
     """
 
+    # How often (in seconds) the accept thread wakes up to check whether the server has been stopped
+    _ACCEPT_POLL_INTERVAL = 0.25
+    # Longest time (in seconds) a refused connection is drained before it is closed
+    _REJECT_LINGER = 1.0
+
     def __init__(self, host: str = None, port: int = None, max_clients: int = 0, timeout: int = None,
-                 msg_q: queue.Queue = None):
-        self._addr = (host, port)
+                 msg_q: queue.Queue = None, profile: str | SocketProfile = None, backlog: int = None,
+                 accept_batch: int = 64, handshake_workers: int = 8, handshake_timeout: float = 5,
+                 conn_rate: float = 0, conn_burst: int = None, client_rate: float = 0, client_burst: int = None,
+                 codec: str | Codec = None, unix_path: str = None, shm_threshold: int = None, shm_dir: str = None,
+                 sub_buffer: int = 1024, slow_consumer: str = pubsub.DROP, max_msg_size: int = None,
+                 mem_budget: int = 0, batch_window: float = None, batch_bytes: int = None, fast_open: bool = False,
+                 capture: str | CaptureWriter = None):
+        if unix_path is not None:
+            self._family = socket.AF_UNIX
+            self._addr = unix_path
+        else:
+            self._family = socket.AF_INET
+            self._addr = (host, port)
+        self._profile = get_profile(profile)
+        self._backlog = backlog if backlog is not None else self._profile.backlog
+        self._accept_batch = accept_batch
+        self._handshake_workers = handshake_workers
+        self._handshake_timeout = handshake_timeout
+        self._handshake_pool = None
+        self._reject_drainer = None
+        self._conn_limiter = TokenBucket(conn_rate, conn_burst)
+        self._client_rate = client_rate
+        self._codec = get_codec(codec)
+        self._shm_threshold = shm_threshold
+        self._shm_dir = shm_dir
+        self._broker = pubsub.Broker(sub_buffer, slow_consumer, self._on_slow_consumer)
+        self._budget = MemoryBudget(mem_budget)
+        if self._budget.is_limited() and (max_msg_size is None or max_msg_size > mem_budget):
+            max_msg_size = mem_budget
+        self._max_msg_size = max_msg_size
+        self._batch_window = batch_window
+        self._batch_bytes = batch_bytes
+        self._fast_open = fast_open
+        if isinstance(capture, str):
+            self._capture_path = capture
+            self._capture = None
+        else:
+            self._capture_path = None
+            self._capture = capture
+        self._client_burst = client_burst
         self._max_clients = max_clients
         self._timeout = timeout
         if msg_q:
@@ -32,8 +238,10 @@ class TCPServer:
         else:
             self._messages = queue.Queue()
         self._soc = None
+        self._unix_soc_ino = None
         self._is_running = False
         self._connected_clients = {}
+        self._pending_clients = 0
         self._connected_clients_lock = threading.Lock()
 
     @staticmethod
@@ -52,37 +260,169 @@ class TCPServer:
         self._connected_clients_lock.release()
         return client
 
-    def _update_connected_clients(self, client_id: str, client: ClientProcessor):
+    def _update_connected_clients(self, client_id: str, client: ClientProcessor, reserved: bool = False) -> bool:
+        # Registers and starts the client under the lock stop() takes, so a handshake which finishes while the server
+        # is stopping cannot leave a client running after stop() has returned
         self._connected_clients_lock.acquire()
+        if not self._is_running:
+            self._connected_clients_lock.release()
+            return False
         self._connected_clients.update({client_id: client})
+        if reserved:
+            # Swap the reserved slot for the registered client under the same lock so the client is never counted
+            # twice by _reserve_slot()
+            self._pending_clients -= 1
+        client.start()
         self._connected_clients_lock.release()
+        return True
 
     def _create_soc(self) -> bool:
-        self._soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._soc = socket.socket(self._family, socket.SOCK_STREAM)
+        if self._family == socket.AF_UNIX:
+            if not self._remove_stale_unix_soc():
+                self._soc.close()
+                self._soc = None
+                return False
+        elif os.name != "nt":
+            # Lets a restarted server bind while old connections are in TIME_WAIT. On Windows SO_REUSEADDR would
+            # allow another process to steal the port, so it is left off there.
+            self._soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Buffer sizes must be set before listen() for the kernel to pick a matching TCP window scale
+        self._profile.apply(self._soc)
+        if self._fast_open and not set_fast_open_listener(self._soc):
+            logger.warning("TCP Fast Open could not be enabled on %s", format_addr(self._addr))
         try:
             self._soc.bind(self._addr)
+            self._soc.listen(self._backlog)
         except socket.gaierror:
-            logger.exception(f"Exception when trying to bind to %s @ %d", self._addr[0], self._addr[1])
+            logger.exception("Exception when trying to bind to %s", format_addr(self._addr))
             return False
+        if self._family == socket.AF_UNIX:
+            self._unix_soc_ino = os.stat(self._addr).st_ino
+        self._soc.setblocking(False)
         return True
 
-    def _mainloop(self):
-        while self.is_running():
+    def _remove_stale_unix_soc(self) -> bool:
+        # A socket file left behind by a server which was not stopped cleanly would make bind() fail. Returns False
+        # if another server is still listening on the path.
+        try:
+            if not stat.S_ISSOCK(os.stat(self._addr).st_mode):
+                return True
+        except FileNotFoundError:
+            return True
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self._addr)
+        except OSError:
+            os.unlink(self._addr)
+            return True
+        finally:
+            probe.close()
+        logger.error("Another server is already listening on %s", self._addr)
+        return False
+
+    def _remove_unix_soc(self):
+        # Only removes the socket file if it is still the one this server bound, not one a newer server created
+        try:
+            if os.stat(self._addr).st_ino == self._unix_soc_ino:
+                os.unlink(self._addr)
+        except FileNotFoundError:
+            pass
+        self._unix_soc_ino = None
+
+    def _reserve_slot(self) -> bool:
+        self._connected_clients_lock.acquire()
+        if self._max_clients > 0 and len(self._connected_clients) + self._pending_clients >= self._max_clients:
+            self._connected_clients_lock.release()
+            return False
+        self._pending_clients += 1
+        self._connected_clients_lock.release()
+        return True
+
+    def _release_slot(self):
+        self._connected_clients_lock.acquire()
+        self._pending_clients -= 1
+        self._connected_clients_lock.release()
+
+    def _accept_batch_from(self, listen_soc: socket.socket) -> bool:
+        """
+        Accepts waiting connections until the backlog is empty, the batch is full, or the connection rate limit is
+        reached. Returns False if the listening socket has failed.
+        """
+        for _ in range(self._accept_batch):
+            if self._conn_limiter.wait_time() > 0:
+                return True
             try:
-                self._soc.listen()
-                client_soc, client_addr = self._soc.accept()
-                logger.info("Accepted Connection from %s @ %d", client_addr[0], client_addr[1])
-                if self.is_full():
-                    logger.warning("%s @ %d was denied connection due to server being full",
-                                   client_addr[0], client_addr[1])
-                    client_soc.sendall(encode_msg(b'SERVER FULL'))
-                    client_soc.close()
-                    continue
-                client_soc.sendall(encode_msg(b'CONNECTION ACCEPTED'))
-                self._start_client_proc(self._generate_client_id(), client_soc)
+                client_soc, client_addr = listen_soc.accept()
+            except BlockingIOError:
+                return True
             except OSError:
-                logger.exception(f"Exception occurred while listening on %s @ %d", self._addr[0], self._addr[1])
-                break
+                if self.is_running():
+                    logger.exception("Exception occurred while listening on %s", format_addr(self._addr))
+                return False
+            self._conn_limiter.try_consume()
+            events.RING.record(events.ACCEPT)
+            client_soc.setblocking(True)
+            try:
+                self._handshake_pool.submit(self._handshake, client_soc, client_addr)
+            except RuntimeError:  # Pool was shut down by stop()
+                client_soc.close()
+                return False
+        return True
+
+    def _handshake(self, client_soc: socket.socket, client_addr: tuple | str | None):
+        if not self._reserve_slot():
+            events.RING.record(events.REJECT)
+            try:
+                client_soc.settimeout(self._handshake_timeout)
+                client_soc.sendall(encode_msg(b'SERVER FULL'))
+            except OSError:
+                client_soc.close()
+                return
+            self._reject_drainer.add(client_soc)
+            return
+        registered = False
+        try:
+            client_soc.settimeout(self._handshake_timeout)
+            if self._shm_allowed(client_soc):
+                # Offer shared memory messages, with the token the names of the segments the client sends must carry
+                shm_token = shm.new_token()
+                client_soc.sendall(encode_msg(b'CONNECTION ACCEPTED', MSG_FLAG_SHM) +
+                                   encode_msg(shm_token.encode('ascii'), MSG_FLAG_SHM | MSG_FLAG_CONTROL))
+            else:
+                shm_token = None
+                client_soc.sendall(encode_msg(b'CONNECTION ACCEPTED'))
+            registered = self._start_client_proc(self._generate_client_id(), client_soc, reserved=True,
+                                                 shm_token=shm_token)
+        except OSError:
+            logger.exception("Handshake with %s failed", format_addr(client_addr))
+            events.RING.record_error()
+            client_soc.close()
+        finally:
+            if not registered:
+                self._release_slot()
+
+    def _mainloop(self):
+        listen_soc = self._soc
+        selector = selectors.DefaultSelector()
+        try:
+            selector.register(listen_soc, selectors.EVENT_READ)
+        except ValueError:  # stop() closed the socket before this thread got to run
+            selector.close()
+            return
+        try:
+            while self.is_running():
+                wait = self._conn_limiter.wait_time()
+                if wait > 0:
+                    # Leave connections in the kernel backlog until the rate limit allows more
+                    time.sleep(min(wait, self._ACCEPT_POLL_INTERVAL))
+                    continue
+                if not selector.select(self._ACCEPT_POLL_INTERVAL):
+                    continue
+                if not self._accept_batch_from(listen_soc):
+                    break
+        finally:
+            selector.close()
 
     def _on_connect(self, *args, **kwargs):
         """
@@ -91,24 +431,61 @@ class TCPServer:
         """
         pass
 
-    def _start_client_proc(self, client_id: str, client_soc: socket.socket):
+    def _new_client_limiter(self) -> TokenBucket | None:
+        if self._client_rate <= 0:
+            return None
+        return TokenBucket(self._client_rate, self._client_burst)
+
+    def _shm_allowed(self, client_soc: socket.socket) -> bool:
+        if self._shm_threshold is None:
+            return False
+        return shm.is_supported() and shm.is_local(client_soc)
+
+    def _new_client_proc(self, client_id: str, client_soc: socket.socket, shm_token: str = None) -> ClientProcessor:
+        # Creates the object which maintains a newly connected client. Overridden by other server backends. shm_token
+        # is set if shared memory messages were offered to the client.
+        return ClientProcessor(client_id=client_id,
+                               client_soc=client_soc,
+                               msg_q=self._messages,
+                               server_obj=self,
+                               timeout=self._timeout,
+                               profile=self._profile,
+                               rate_limiter=self._new_client_limiter(),
+                               codec=self._codec,
+                               shm_threshold=self._shm_threshold,
+                               shm_dir=self._shm_dir,
+                               max_msg_size=self._max_msg_size,
+                               budget=self._budget,
+                               batch_window=self._batch_window,
+                               batch_bytes=self._batch_bytes,
+                               capture=self._capture,
+                               shm_token=shm_token)
+
+    def _start_client_proc(self, client_id: str, client_soc: socket.socket, reserved: bool = False,
+                           shm_token: str = None) -> bool:
         result = self._on_connect(client_soc, client_id)
         if result is False:
             client_soc.close()
-            return
-        client_proc = ClientProcessor(client_id=client_id,
-                                      client_soc=client_soc,
-                                      msg_q=self._messages,
-                                      server_obj=self,
-                                      timeout=self._timeout)
-        self._update_connected_clients(client_proc.id(), client_proc)
+            return False
+        client_proc = self._new_client_proc(client_id, client_soc, shm_token)
+        if not self._update_connected_clients(client_proc.id(), client_proc, reserved):
+            client_soc.close()
+            return False
+        return True
 
-    def addr(self) -> tuple[str, int]:
+    def addr(self) -> tuple[str, int] | str:
         """
-        Returns a tuple with the current ip (str) and the port (int) the server is listening on.
+        Returns a tuple with the current ip (str) and the port (int) the server is listening on, or the path of the
+        Unix domain socket.
         """
         return self._addr
 
+    def profile(self) -> SocketProfile:
+        """
+        Returns the SocketProfile applied to the server's sockets
+        """
+        return self._profile
+
     def set_addr(self, host: str, port: int):
         """
         Allows for the address to be changed after class creation. If the server is running, this function will do
@@ -116,8 +493,19 @@ class TCPServer:
         """
         if self._is_running:
             return
+        self._family = socket.AF_INET
         self._addr = (host, port)
 
+    def set_unix_path(self, path: str):
+        """
+        Makes the server listen on a Unix domain socket at path instead of a host and port. If the server is running,
+        this function will do nothing.
+        """
+        if self._is_running:
+            return
+        self._family = socket.AF_UNIX
+        self._addr = path
+
     def is_running(self) -> bool:
         """
         Returns a boolean indicating whether the server is set up and running
@@ -178,15 +566,15 @@ class TCPServer:
 
     def set_server_timeout(self, timeout: int) -> bool:
         """
-        Sets timeout (in seconds) of the server's socket object used for listening for new connections. The Timeout
-        argument should be a positive integer. Passing None will set the timeout to infinity. See
-        https://docs.python.org/3/library/socket.html#socket-timeouts for more information about timeouts.
+        Sets the server timeout (in seconds), which is given to newly connected clients. The listening socket itself
+        is non-blocking and is not affected. The Timeout argument should be a positive integer. Passing None will set
+        the timeout to infinity. See https://docs.python.org/3/library/socket.html#socket-timeouts for more
+        information about timeouts.
         """
         if timeout is not None:
             if timeout < 0:
                 return False
         self._timeout = timeout
-        self._soc.settimeout(timeout)
         return True
 
     def server_timeout(self) -> int:
@@ -216,7 +604,9 @@ class TCPServer:
         return {
             "is_running": client.is_running(),
             "timeout": client.timeout(),
-            "addr": (client.addr()[0], client.addr()[1]),
+            "addr": client.addr(),
+            "topics": self._broker.topics(client_id),
+            "dropped": self._broker.dropped(client_id),
         }
 
     def disconnect_client(self, client_id: str) -> bool:
@@ -232,6 +622,7 @@ class TCPServer:
             return False
         del self._connected_clients[client_id]
         self._connected_clients_lock.release()
+        self._broker.remove_client(client_id)
         if client.is_running():
             client.stop()
         return True
@@ -244,19 +635,64 @@ class TCPServer:
         See  https://docs.python.org/3/library/queue.html#queue.Queue.get for more information
         """
         try:
-            return self._messages.get(block=block, timeout=timeout)
+            msg = self._messages.get(block=block, timeout=timeout)
         except queue.Empty:
             return None
+        self._release_budget(msg)
+        return msg
+
+    def pop_msgs(self, max_count: int = 0, max_wait: float = 0) -> list[Message]:
+        """
+        Gets a batch of up to max_count messages (every queued message if max_count is zero) with a single lock
+        acquisition. If the queue is empty, waits up to max_wait seconds for a message to arrive, or forever if
+        max_wait is None. Returns a list of messages, which is empty if no message arrived in time.
+        """
+        msgs = drain_queue(self._messages, max_count, max_wait)
+        for msg in msgs:
+            self._release_budget(msg)
+        return msgs
+
+    def _release_budget(self, msg: Message):
+        if msg.data is not None:
+            self._budget.release(msg.size)
 
     def get_all_msg(self, block: bool = False, timeout: int = None) -> Generator[Message | None, None, None]:
         """
-        Generator for iterating over the queue. If block is True, each iteration of this method will block until it
-        can pop something from the queue, else it will try to get a value and yield None if queue is empty. If block
-        is True and a timeout is given, block until timeout expires and then yield None if no item was received. See
-        https://docs.python.org/3/library/queue.html#queue.Queue.get for more information
+        Generator for iterating over the queue until it is empty. Messages are taken from the queue in batches with
+        pop_msgs(). The generator stops as soon as the queue is empty, including when it starts out empty; block and
+        timeout are kept for compatibility. Use pop_msgs() with max_wait to wait for messages.
+        """
+        while True:
+            batch = self.pop_msgs()
+            if not batch:
+                return
+            yield from batch
+
+    def receive_obj(self, block: bool = False, timeout: int = None, codec: str | Codec = None) -> Message | None:
+        """
+        Pops the next message like pop_msg() and decodes its data with codec (the server's codec if None). Returns a
+        Message whose data is the decoded object, or None if the queue is empty. Messages signalling a disconnect are
+        returned unchanged.
+        """
+        codec = self._codec if codec is None else get_codec(codec)
+        msg = self.pop_msg(block, timeout)
+        if msg is not None and msg.data is not None:
+            msg.data = codec.decode(msg.data)
+        return msg
+
+    def max_msg_size(self) -> int | None:
+        """
+        Returns the size (in bytes) of the largest message a client may send, or None if there is no limit
+        """
+        return self._max_msg_size
+
+    def memory_stats(self) -> dict:
+        """
+        Returns a dictionary with keys 'limit', 'used', 'peak' and 'waiting': the memory budget (zero if there is
+        none), the bytes held by received messages which have not been popped yet, the most bytes they have held at
+        once, and the number of clients waiting for budget.
         """
-        while not self._messages.empty():
-            yield self.pop_msg(block=block, timeout=timeout)
+        return self._budget.stats()
 
     def has_messages(self) -> bool:
         """
@@ -264,10 +700,11 @@ class TCPServer:
         """
         return not self._messages.empty()
 
-    def send(self, client_id: str, data: bytes) -> bool:
+    def send(self, client_id: str, data: bytes, priority: bool = False) -> bool:
         """
-        Sends data to a connected client. Data should be a bytes-like object. Returns True on successful sending,
-        False if not or if a client with client_id could not be found.
+        Sends data to a connected client. Data should be a bytes-like object. If priority is True, the message is
+        marked as high priority. Returns True on successful sending, False if not or if a client with client_id could
+        not be found.
         """
         self._connected_clients_lock.acquire()
         try:
@@ -276,7 +713,92 @@ class TCPServer:
             self._connected_clients_lock.release()
             return False
         self._connected_clients_lock.release()
-        return client.send(data)
+        return client.send(data, priority)
+
+    def flush(self, client_id: str) -> bool:
+        """
+        Writes the frames waiting to be coalesced for a client immediately. Returns True on success, False if not or if
+        a client with client_id could not be found.
+        """
+        client = self._get_client(client_id)
+        if not client:
+            return False
+        return client.flush()
+
+    def batch_stats(self, client_id: str) -> dict | None:
+        """
+        Returns the statistics of coalesced sends to a client (see WriteCoalescer.stats()), or None if sends are not
+        coalesced or no client with client_id can be found
+        """
+        client = self._get_client(client_id)
+        if not client:
+            return
+        return client.batch_stats()
+
+    def send_obj(self, client_id: str, obj, codec: str | Codec = None, priority: bool = False) -> bool:
+        """
+        Encodes obj with codec (the server's codec if None) and sends it to a connected client. Returns True on
+        successful sending, False if not or if a client with client_id could not be found.
+        """
+        client = self._get_client(client_id)
+        if client is None:
+            return False
+        return client.send_obj(obj, codec, priority)
+
+    def send_array(self, client_id: str, arr, priority: bool = False) -> bool:
+        """
+        Sends a NumPy array to a connected client straight from the array's memory (see TCPClient.send_array()).
+        Returns True on successful sending, False if not or if a client with client_id could not be found. Raises
+        NumpyNotAvailable if NumPy is not installed.
+        """
+        return self.send_obj(client_id, arr, "array", priority)
+
+    def _on_control(self, client_id: str, data: bytes):
+        try:
+            op, topic = pubsub.decode_control(data)
+        except pubsub.InvalidControlFrame:
+            logger.warning("Client %s sent an invalid control frame", client_id)
+            return
+        if op == pubsub.CTRL_SUBSCRIBE:
+            self.subscribe(client_id, topic)
+        elif op == pubsub.CTRL_UNSUBSCRIBE:
+            self.unsubscribe(client_id, topic)
+        else:
+            logger.warning("Client %s sent an unknown control operation %d", client_id, op)
+
+    def _on_slow_consumer(self, client_id: str):
+        logger.warning("Disconnecting client %s because it is not keeping up with published messages", client_id)
+        self.disconnect_client(client_id)
+
+    def subscribe(self, client_id: str, topic: str) -> bool:
+        """
+        Subscribes a connected client to topic, as if the client had called TCPClient.subscribe(). Returns False if the
+        client could not be found or was already subscribed.
+        """
+        client = self._get_client(client_id)
+        if client is None:
+            return False
+        return self._broker.subscribe(client, topic)
+
+    def unsubscribe(self, client_id: str, topic: str) -> bool:
+        """
+        Unsubscribes a client from topic. Returns False if the client was not subscribed.
+        """
+        return self._broker.unsubscribe(client_id, topic)
+
+    def subscribers(self, topic: str) -> list:
+        """
+        Returns the ids of the clients a message published on topic would be sent to
+        """
+        return self._broker.subscribers(topic)
+
+    def publish(self, topic: str, data: bytes, priority: bool = False) -> int:
+        """
+        Sends data to every client subscribed to topic. The message is encoded once and the same frame is buffered for
+        every subscriber, whose own threads send it, so a slow subscriber does not hold up the caller or the other
+        subscribers. Returns the number of subscribers the message was buffered for.
+        """
+        return self._broker.publish(topic, pubsub.encode_publish(topic, data, priority))
 
     def start(self) -> bool:
         """
@@ -286,7 +808,20 @@ class TCPServer:
             return False
         if not self._create_soc():
             return False
+        if self._capture_path is not None:
+            try:
+                self._capture = CaptureWriter(self._capture_path)
+            except OSError:
+                logger.exception("Could not open capture file %s", self._capture_path)
+                self._soc.close()
+                self._soc = None
+                if self._family == socket.AF_UNIX:
+                    self._remove_unix_soc()
+                return False
         self._is_running = True
+        self._reject_drainer = _RejectDrainer(self._REJECT_LINGER)
+        self._handshake_pool = ThreadPoolExecutor(max_workers=self._handshake_workers,
+                                                  thread_name_prefix="TCPServer-handshake")
         threading.Thread(target=self._mainloop).start()
         logger.info("Server has been started")
         return True
@@ -297,11 +832,46 @@ class TCPServer:
         """
         if self._is_running:
             self._connected_clients_lock.acquire()
-            for client in self._connected_clients.values():
-                client.stop()
-            self._connected_clients.clear()
-            self._connected_clients_lock.release()
+            try:
+                self._is_running = False
+                for client in self._connected_clients.values():
+                    client.stop()
+                self._connected_clients.clear()
+            finally:
+                self._connected_clients_lock.release()
+            self._broker.clear()
+            self._handshake_pool.shutdown(wait=False)
+            self._handshake_pool = None
+            self._reject_drainer.stop()
             self._soc.close()
             self._soc = None
-            self._is_running = False
+            if self._family == socket.AF_UNIX:
+                self._remove_unix_soc()
+            if self._capture is not None:
+                if self._capture_path is not None:
+                    self._capture.close()
+                    self._capture = None
+                else:
+                    self._capture.flush()
             logger.info("Server has been stopped")
+
+    def connect_local(self, timeout: int = None, profile: str | SocketProfile = None,
+                      codec: str | Codec = None) -> TCPClient | None:
+        """
+        Connects a new client to the server over a socket.socketpair(), which goes through neither the TCP stack nor
+        the file system. The server handles the connection exactly like one it accepted. Returns the connected
+        TCPClient, or None if the server is not running or refused the connection.
+        """
+        if not self._is_running:
+            return
+        server_soc, client_soc = socket.socketpair()
+        try:
+            self._handshake_pool.submit(self._handshake, server_soc, None)
+        except RuntimeError:  # Pool was shut down by stop()
+            server_soc.close()
+            client_soc.close()
+            return
+        client = TCPClient(timeout=timeout, profile=profile, codec=codec)
+        if not client.connect_socket(client_soc):
+            return
+        return client
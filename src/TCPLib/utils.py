@@ -3,17 +3,73 @@ utils.py
 Written by: Joshua Kitchen - 2024
 """
 
+HEADER_SIZE = 4
+FLAGS_SIZE = 1
+# The top bit of the size field marks a frame which has a flags byte after the size field. Frames without flags are
+# encoded exactly as before, so the largest message is 2 GiB - 1 bytes.
+FLAG_EXTENDED = 0x80000000
+MAX_MSG_SIZE = 0x7FFFFFFF
 
-def encode_msg(data: bytes) -> bytearray:
+MSG_FLAG_PRIORITY = 0x01
+# The data of the frame is a shared memory descriptor (see shm.py) rather than the message itself. An empty frame with
+# this flag tells the peer that shared memory messages can be sent to it.
+MSG_FLAG_SHM = 0x02
+# The frame is a control frame for the server (such as a pub/sub subscription) rather than a message
+MSG_FLAG_CONTROL = 0x04
+# The data of the frame starts with the topic it was published on (see pubsub.py)
+MSG_FLAG_TOPIC = 0x08
+# The data of the frame starts with the sequence number of a message sent from a spool (see spool.py)
+MSG_FLAG_SPOOL = 0x10
+# The frame acknowledges every spooled message up to the sequence number in its data
+MSG_FLAG_ACK = 0x20
+
+
+def encode_header(size: int, flags: int = 0) -> bytes:
+    """
+    Returns the header for a message of the given size. If flags is non-zero, a flags byte is added after the size.
+    Raises OverflowError if size is larger than MAX_MSG_SIZE.
+    """
+    if size > MAX_MSG_SIZE:
+        raise OverflowError(f"Message of {size} bytes is larger than the maximum of {MAX_MSG_SIZE} bytes")
+    if flags:
+        return (size | FLAG_EXTENDED).to_bytes(HEADER_SIZE, byteorder='big') + flags.to_bytes(FLAGS_SIZE, 'big')
+    return size.to_bytes(HEADER_SIZE, byteorder='big')
+
+
+def encode_msg(data: bytes, flags: int = 0) -> bytearray:
     """
     MSG STRUCTURE:
     [Size (4 bytes)] [Data]
+    or, if any flags are set, with the top bit of the size set:
+    [Size (4 bytes)] [Flags (1 byte)] [Data]
     """
     msg = bytearray()
-    msg.extend(len(data).to_bytes(4, byteorder='big'))
+    msg.extend(encode_header(memoryview(data).nbytes, flags))
     msg.extend(data)
     return msg
 
 
 def decode_header(header: bytes) -> int:
-    return int.from_bytes(header, byteorder='big')
+    return int.from_bytes(header, byteorder='big') & MAX_MSG_SIZE
+
+
+def has_flags(header: bytes) -> bool:
+    """
+    Returns a boolean flag indicating whether a flags byte follows the header
+    """
+    return bool(header[0] & 0x80)
+
+
+def format_addr(addr: tuple | str | None) -> str:
+    """
+    Returns a printable form of a socket address: 'host @ port' for TCP addresses and the path for Unix socket
+    addresses. Unnamed Unix sockets, such as the client end of a Unix socket connection or either end of a
+    socketpair, are shown as '<local>'.
+    """
+    if isinstance(addr, tuple):
+        return f"{addr[0]} @ {addr[1]}"
+    if not addr:
+        return "<local>"
+    if isinstance(addr, bytes):
+        return addr.decode('utf-8', 'replace')
+    return str(addr)
@@ -9,6 +9,9 @@ will automatically get and log messages to your logger.
 
 import logging
 import sys
+import threading
+
+from .TCPLib import events
 
 DEBUG_FORMATTER = logging.Formatter(
     '%(asctime)s - %(module)s.%(funcName)s on %(threadName)s - %(levelname)s :\n %(message)s\n',
@@ -60,3 +63,63 @@ def add_stream_handler(logger, log_level, handler_name):
 
     stream_handler.setFormatter(formatter)
     logger.addHandler(stream_handler)
+
+
+class EventDrain:
+    """
+    Drains the library's event ring buffer (see TCPLib/events.py) on a background thread every interval seconds and
+    logs each event to logger at log_level, so events are recorded cheaply on the hot path and formatted off it. Events
+    which were overwritten before they could be drained are reported with a warning. Starting the drain turns on
+    recording in the ring, which is off by default.
+    """
+
+    def __init__(self, logger, log_level=logging.DEBUG, interval=1.0, ring=None):
+        self._logger = logger
+        self._log_level = log_level
+        self._interval = interval
+        self._ring = ring if ring is not None else events.RING
+        self._stop = threading.Event()
+        self._thread = None
+        self._dropped = self._ring.dropped()
+
+    def drain(self) -> int:
+        """
+        Logs the events recorded since the last drain. Returns the number of events logged.
+        """
+        drained = self._ring.drain()
+        for event in drained:
+            self._logger.log(self._log_level, "%s", events.format_event(event))
+        dropped = self._ring.dropped()
+        if dropped > self._dropped:
+            self._logger.warning("%d events were overwritten before they could be logged", dropped - self._dropped)
+            self._dropped = dropped
+        return len(drained)
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self.drain()
+        self.drain()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._ring.set_enabled(True)
+        self._thread = threading.Thread(target=self._run, name="EventDrain", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the drain thread after logging any remaining events
+        """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+
+def add_event_drain(logger, log_level=logging.DEBUG, interval=1.0, ring=None) -> EventDrain:
+    drain = EventDrain(logger, log_level, interval, ring)
+    drain.start()
+    return drain
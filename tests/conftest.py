@@ -10,6 +10,7 @@ import socket
 import os
 import shutil
 
+from src.TCPLib.impair import ImpairmentProxy
 from src.TCPLib.tcp_client import TCPClient
 from src.TCPLib.tcp_server import TCPServer
 from src.TCPLib.utils import encode_msg
@@ -47,6 +48,7 @@ def setup_log_folder(folder_name):
 class DummyServer:
     def __init__(self, host, port):
         self.soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.soc.bind((host, port))
 
     def listen(self):
@@ -104,3 +106,22 @@ def client_list(request):
     yield clients
     for client in clients:
         client.disconnect()
+
+
+@pytest.fixture
+def impaired_proxy():
+    """
+    Returns a function which starts an ImpairmentProxy in front of the test server (or the given target) with the
+    given impairments. Every proxy started is stopped after the test.
+    """
+    proxies = []
+
+    def start_proxy(target=(HOST, PORT), **impairments):
+        proxy = ImpairmentProxy(target, **impairments)
+        assert proxy.start()
+        proxies.append(proxy)
+        return proxy
+
+    yield start_proxy
+    for proxy in proxies:
+        proxy.stop()
@@ -0,0 +1,111 @@
+"""
+test_accept_pipeline.py
+Written by: Joshua Kitchen - 2024
+"""
+import threading
+import time
+import logging
+import os
+
+from tests.globals_for_tests import setup_log_folder, HOST, PORT
+from src.log_util import add_file_handler
+from src.TCPLib.rate_limit import TokenBucket
+from src.TCPLib.tcp_client import TCPClient
+from src.TCPLib.tcp_server import TCPServer
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+log_folder = setup_log_folder("TestAcceptPipeline")
+
+
+class SlowConnectServer(TCPServer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.release = threading.Event()
+
+    def _on_connect(self, client_soc, client_id):
+        if not self.release.is_set():
+            self.release.wait(5)
+
+
+class TestAcceptPipeline:
+    def test_token_bucket(self):
+        bucket = TokenBucket(100, 2)
+        assert bucket.try_consume()
+        assert bucket.try_consume()
+        assert not bucket.try_consume()
+        assert bucket.wait_time() > 0
+        assert bucket.consume(timeout=0.1)
+        assert not bucket.consume(10, timeout=0.001)
+        unlimited = TokenBucket(0)
+        assert not unlimited.is_limited()
+        assert all(unlimited.try_consume() for _ in range(1000))
+
+    def test_slow_on_connect(self):
+        """
+        A client stuck in _on_connect should not stop other clients from completing the handshake
+        """
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_slow_on_connect.log"),
+                         logging.DEBUG,
+                         "test_slow_on_connect-filehandler")
+        server = SlowConnectServer(HOST, PORT, handshake_workers=4)
+        clients = [TCPClient(HOST, PORT, timeout=5) for _ in range(3)]
+        try:
+            server.start()
+            time.sleep(0.1)
+            for c in clients:
+                assert c.connect()
+            assert server.client_count() == 0
+            server.release.set()
+            time.sleep(0.2)
+            assert server.client_count() == 3
+        finally:
+            server.release.set()
+            for c in clients:
+                c.disconnect()
+            server.stop()
+
+    def test_conn_rate_limit(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_conn_rate_limit.log"),
+                         logging.DEBUG,
+                         "test_conn_rate_limit-filehandler")
+        server = TCPServer(HOST, PORT, conn_rate=20, conn_burst=2)
+        clients = [TCPClient(HOST, PORT, timeout=5) for _ in range(6)]
+        try:
+            server.start()
+            time.sleep(0.1)
+            start = time.monotonic()
+            for c in clients:
+                assert c.connect()
+            # 2 connections fit in the burst, the other 4 need 0.05s each
+            assert time.monotonic() - start >= 0.15
+        finally:
+            for c in clients:
+                c.disconnect()
+            server.stop()
+
+    def test_stop_during_handshake(self):
+        """
+        A handshake which finishes after stop() must not leave a client running
+        """
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_stop_during_handshake.log"),
+                         logging.DEBUG,
+                         "test_stop_during_handshake-filehandler")
+        server = SlowConnectServer(HOST, PORT)
+        client = TCPClient(HOST, PORT, timeout=5)
+        try:
+            server.start()
+            time.sleep(0.1)
+            assert client.connect()
+            server.stop()
+            server.release.set()
+            time.sleep(0.2)
+            assert server.list_clients() == []
+            assert client.receive_all().data is None
+        finally:
+            server.release.set()
+            client.disconnect()
+            server.stop()
@@ -0,0 +1,118 @@
+"""
+test_active_client.py
+Written by: Joshua Kitchen - 2024
+"""
+import threading
+import time
+import logging
+import os
+
+from tests.globals_for_tests import setup_log_folder, HOST, PORT
+from src.log_util import add_file_handler
+from src.TCPLib.active_client import ActiveTCPClient
+from src.TCPLib.tcp_server import TCPServer
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+log_folder = setup_log_folder("TestActiveClient")
+
+
+def wait_for(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class TestActiveClient:
+    def test_queue(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_queue.log"),
+                         logging.DEBUG,
+                         "test_queue-filehandler")
+        server = TCPServer(HOST, PORT)
+        client = ActiveTCPClient(HOST, PORT, timeout=5)
+        try:
+            server.start()
+            time.sleep(0.1)
+            assert client.connect()
+            assert client.is_listening()
+            assert wait_for(lambda: server.client_count() == 1)
+            client_id = server.list_clients()[0]
+            for i in range(100):
+                assert server.send(client_id, b'%d' % i)
+            # Pushed messages are received without the application asking for them
+            assert wait_for(lambda: client._messages.qsize() == 100)
+            msgs = client.pop_msgs(max_count=60)
+            msgs += client.pop_msgs()
+            assert [msg.data for msg in msgs] == [b'%d' % i for i in range(100)]
+            assert client.pop_msg() is None
+
+            server.disconnect_client(client_id)
+            msg = client.pop_msg(block=True, timeout=5)
+            assert (msg.size, msg.data) == (0, None)
+            assert not client.is_connected()
+            assert not client.is_listening()
+        finally:
+            client.disconnect()
+            server.stop()
+
+    def test_on_message(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_on_message.log"),
+                         logging.DEBUG,
+                         "test_on_message-filehandler")
+        server = TCPServer(HOST, PORT)
+        received = []
+        done = threading.Event()
+
+        def on_message(msg):
+            received.append(msg.data)
+            if msg.data == b'last':
+                # Replies can be sent from the callback
+                client.send(b'bye')
+                done.set()
+
+        client = ActiveTCPClient(HOST, PORT, timeout=5, on_message=on_message)
+        try:
+            server.start()
+            time.sleep(0.1)
+            assert client.connect()
+            assert wait_for(lambda: server.client_count() == 1)
+            client_id = server.list_clients()[0]
+            assert server.send(client_id, b'first')
+            assert server.send(client_id, b'last')
+            assert done.wait(5)
+            assert received == [b'first', b'last']
+            assert server.pop_msg(block=True, timeout=5).data == b'bye'
+            assert not client.has_messages()
+        finally:
+            client.disconnect()
+            server.stop()
+        assert not client.is_listening()
+
+    def test_concurrent_sends(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_concurrent_sends.log"),
+                         logging.DEBUG,
+                         "test_concurrent_sends-filehandler")
+        server = TCPServer(HOST, PORT)
+        client = ActiveTCPClient(HOST, PORT, timeout=5)
+        payloads = [bytes([i]) * 256 * 1024 for i in range(4)]
+        try:
+            server.start()
+            time.sleep(0.1)
+            assert client.connect()
+            threads = [threading.Thread(target=lambda p=p: [client.send(p) for _ in range(20)]) for p in payloads]
+            for th in threads:
+                th.start()
+            # Messages from every thread arrive whole
+            for _ in range(80):
+                assert server.pop_msg(block=True, timeout=5).data in payloads
+            for th in threads:
+                th.join()
+        finally:
+            client.disconnect()
+            server.stop()
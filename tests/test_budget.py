@@ -0,0 +1,136 @@
+"""
+test_budget.py
+Written by: Joshua Kitchen - 2024
+"""
+import os
+import threading
+import time
+import logging
+
+from tests.globals_for_tests import setup_log_folder, HOST, PORT
+from src.log_util import add_file_handler
+from src.TCPLib.budget import MemoryBudget
+from src.TCPLib.tcp_client import TCPClient, MessageTooLarge
+from src.TCPLib.tcp_server import TCPServer
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+log_folder = setup_log_folder("TestBudget")
+
+
+def wait_for(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class TestMemoryBudget:
+    def test_acquire_release(self):
+        budget = MemoryBudget(100)
+        assert budget.acquire(60)
+        assert not budget.acquire(60, timeout=0.05)
+        assert budget.used() == 60
+        budget.release(60)
+        # A request larger than the limit goes through once nothing else is in use
+        assert budget.acquire(150, timeout=0.05)
+        assert budget.stats() == {"limit": 100, "used": 150, "peak": 150, "waiting": 0}
+
+    def test_waiter_woken_by_release(self):
+        budget = MemoryBudget(100)
+        budget.acquire(80)
+        acquired = threading.Event()
+        th = threading.Thread(target=lambda: budget.acquire(50) and acquired.set())
+        th.start()
+        time.sleep(0.05)
+        assert not acquired.is_set()
+        assert budget.waiting() == 1
+        budget.release(80)
+        assert acquired.wait(1)
+        th.join()
+
+    def test_unlimited(self):
+        budget = MemoryBudget(0)
+        assert not budget.is_limited()
+        assert budget.acquire(10 ** 9, timeout=0)
+        assert budget.used() == 10 ** 9
+
+
+class TestMessageLimits:
+    def test_message_too_large(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_message_too_large.log"),
+                         logging.DEBUG,
+                         "test_message_too_large-filehandler")
+        server = TCPServer(HOST, PORT, max_msg_size=1024)
+        client = TCPClient(HOST, PORT, timeout=5)
+        try:
+            server.start()
+            time.sleep(0.1)
+            assert client.connect()
+            assert wait_for(lambda: server.client_count() == 1)
+            client_id = server.list_clients()[0]
+            assert client.send(b'a' * 1024)
+            assert server.pop_msg(block=True, timeout=5).size == 1024
+            assert client.send(b'a' * 1025)
+            msg = server.pop_msg(block=True, timeout=5)
+            assert msg.data is None
+            assert msg.client_id == client_id
+            assert not server.get_client_info(client_id)["is_running"]
+        finally:
+            client.disconnect()
+            server.stop()
+
+    def test_client_max_msg_size(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_client_max_msg_size.log"),
+                         logging.DEBUG,
+                         "test_client_max_msg_size-filehandler")
+        server = TCPServer(HOST, PORT)
+        client = TCPClient(HOST, PORT, timeout=5, max_msg_size=16)
+        try:
+            server.start()
+            time.sleep(0.1)
+            assert client.connect()
+            assert wait_for(lambda: server.client_count() == 1)
+            server.send(server.list_clients()[0], b'a' * 17)
+            try:
+                client.receive_all()
+                assert False, "MessageTooLarge was not raised"
+            except MessageTooLarge:
+                pass
+            assert not client.is_connected()
+        finally:
+            client.disconnect()
+            server.stop()
+
+    def test_mem_budget(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_mem_budget.log"),
+                         logging.DEBUG,
+                         "test_mem_budget-filehandler")
+        server = TCPServer(HOST, PORT, mem_budget=1000)
+        client = TCPClient(HOST, PORT, timeout=5)
+        try:
+            server.start()
+            time.sleep(0.1)
+            assert server.max_msg_size() == 1000
+            assert client.connect()
+            for i in range(3):
+                assert client.send(bytes([i]) * 400)
+            assert wait_for(lambda: server.memory_stats()["waiting"] == 1)
+            # The third message does not fit until one of the first two is popped
+            stats = server.memory_stats()
+            assert stats["used"] == 800
+            assert stats["waiting"] == 1
+            assert server.pop_msg(block=True, timeout=5).data == bytes([0]) * 400
+            msgs = [server.pop_msg(block=True, timeout=5).data for _ in range(2)]
+            assert msgs == [bytes([1]) * 400, bytes([2]) * 400]
+            stats = server.memory_stats()
+            assert stats["used"] == 0
+            assert stats["peak"] == 800
+        finally:
+            client.disconnect()
+            server.stop()
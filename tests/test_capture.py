@@ -0,0 +1,141 @@
+"""
+test_capture.py
+Written by: Joshua Kitchen - 2024
+"""
+import tempfile
+import time
+import logging
+import os
+
+import pytest
+
+from tests.globals_for_tests import setup_log_folder, HOST, PORT
+from src.log_util import add_file_handler
+from src.TCPLib import capture
+from src.TCPLib.capture import (CaptureWriter, read_capture, InvalidCapture, CONNECT, FRAME, SIZE_ONLY,
+                                DISCONNECT, RUN_START)
+from src.TCPLib.replay import Replayer
+from src.TCPLib.tcp_client import TCPClient
+from src.TCPLib.tcp_server import TCPServer
+from src.TCPLib.utils import MSG_FLAG_PRIORITY, MSG_FLAG_SPOOL
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+log_folder = setup_log_folder("TestCapture")
+
+
+class TestCapture:
+    def test_writer_and_reader(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_writer_and_reader.log"),
+                         logging.DEBUG,
+                         "test_writer_and_reader-filehandler")
+        path = os.path.join(tempfile.mkdtemp(), "traffic.cap")
+        writer = CaptureWriter(path)
+        writer.record_frame("a", MSG_FLAG_PRIORITY | MSG_FLAG_SPOOL, b'hello')
+        writer.record_frame("b", 0, memoryview(b'world'))
+        writer.record_disconnect("a")
+        writer.close()
+        # Appending starts a new run, which numbers its clients afresh
+        writer = CaptureWriter(path, keep_data=False)
+        writer.record_connect("c")
+        writer.record_frame("c", 0, b'12345678')
+        writer.close()
+        records = [(r.kind, r.client_id, r.flags, r.size, r.data) for r in read_capture(path)]
+        assert records == [(RUN_START, None, 0, 0, None),
+                           (CONNECT, "a", 0, 0, None),
+                           (FRAME, "a", MSG_FLAG_PRIORITY, 5, b'hello'),
+                           (CONNECT, "b", 0, 0, None),
+                           (FRAME, "b", 0, 5, b'world'),
+                           (DISCONNECT, "a", 0, 0, None),
+                           (RUN_START, None, 0, 0, None),
+                           (CONNECT, "c", 0, 0, None),
+                           (SIZE_ONLY, "c", 0, 8, None)]
+
+        # A record cut short ends the capture
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 3)
+        assert len(list(read_capture(path))) == 8
+        with open(path, 'wb') as f:
+            f.write(b'not a capture')
+        with pytest.raises(InvalidCapture):
+            list(read_capture(path))
+
+    def test_capture_and_replay(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_capture_and_replay.log"),
+                         logging.DEBUG,
+                         "test_capture_and_replay-filehandler")
+        path = os.path.join(tempfile.mkdtemp(), "traffic.cap")
+        server = TCPServer(HOST, PORT, capture=path)
+        clients = [TCPClient(HOST, PORT, timeout=5) for _ in range(2)]
+        try:
+            assert server.start()
+            time.sleep(0.1)
+            for i, c in enumerate(clients):
+                assert c.connect()
+                for j in range(10):
+                    assert c.send(b'%d-%d' % (i, j), priority=j == 9)
+            for _ in range(20):
+                assert server.pop_msg(block=True, timeout=5).data is not None
+            for c in clients:
+                c.disconnect()
+            for _ in range(2):
+                assert server.pop_msg(block=True, timeout=5).data is None
+        finally:
+            for c in clients:
+                c.disconnect()
+            server.stop()
+
+        frames = [r for r in read_capture(path) if r.kind == FRAME]
+        assert sorted(r.data for r in frames) == sorted(b'%d-%d' % (i, j) for i in range(2) for j in range(10))
+        assert sum(1 for r in frames if r.flags & MSG_FLAG_PRIORITY) == 2
+
+        server = TCPServer(HOST, PORT)
+        replayer = Replayer(HOST, PORT, path, speed=0, timeout=5)
+        assert replayer.sessions() == 2
+        try:
+            assert server.start()
+            time.sleep(0.1)
+            report = replayer.run()
+            assert (report["conn_successes"], report["msgs"], report["errors"]) == (2, 20, 0)
+            # Replayed clients disconnect when they are done, so their disconnects are mixed in
+            received = [msg for msg in (server.pop_msg(block=True, timeout=5) for _ in range(22)) if msg.data]
+            assert sorted(msg.data for msg in received) == sorted(r.data for r in frames)
+            assert sum(1 for msg in received if msg.priority) == 2
+        finally:
+            server.stop()
+
+    def test_replay_runs_back_to_back(self, monkeypatch):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_replay_runs_back_to_back.log"),
+                         logging.DEBUG,
+                         "test_replay_runs_back_to_back-filehandler")
+        path = os.path.join(tempfile.mkdtemp(), "traffic.cap")
+        writer = CaptureWriter(path)
+        writer.record_frame("a", 0, b'first run')
+        writer.record_disconnect("a")
+        writer.close()
+        # The second run is recorded an hour later
+        real_time = time.time
+        monkeypatch.setattr(capture.time, "time", lambda: real_time() + 3600)
+        writer = CaptureWriter(path)
+        writer.record_frame("a", 0, b'second run')
+        writer.record_disconnect("a")
+        writer.close()
+        monkeypatch.undo()
+
+        server = TCPServer(HOST, PORT)
+        replayer = Replayer(HOST, PORT, path, timeout=5)
+        assert replayer.sessions() == 2
+        try:
+            assert server.start()
+            time.sleep(0.1)
+            start = time.monotonic()
+            report = replayer.run()
+            assert time.monotonic() - start < 5
+            assert (report["conn_successes"], report["msgs"], report["errors"]) == (2, 2, 0)
+            received = [msg.data for msg in (server.pop_msg(block=True, timeout=5) for _ in range(4)) if msg.data]
+            assert sorted(received) == [b'first run', b'second run']
+        finally:
+            server.stop()
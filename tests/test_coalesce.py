@@ -0,0 +1,105 @@
+"""
+test_coalesce.py
+Written by: Joshua Kitchen - 2024
+"""
+import time
+import logging
+import os
+
+from tests.globals_for_tests import setup_log_folder, HOST, PORT
+from src.log_util import add_file_handler
+from src.TCPLib.tcp_client import TCPClient
+from src.TCPLib.tcp_server import TCPServer
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+log_folder = setup_log_folder("TestCoalesce")
+
+
+def wait_for(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class TestCoalesce:
+    def test_window(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_window.log"),
+                         logging.DEBUG,
+                         "test_window-filehandler")
+        server = TCPServer(HOST, PORT)
+        client = TCPClient(HOST, PORT, timeout=5, batch_window=0.05)
+        try:
+            server.start()
+            time.sleep(0.1)
+            assert client.connect()
+            for i in range(100):
+                assert client.send(b'%d' % i)
+            assert [server.pop_msg(block=True, timeout=5).data for _ in range(100)] == [b'%d' % i for i in range(100)]
+            stats = client.batch_stats()
+            assert stats["frames"] == 100
+            assert stats["batches"] < 10
+            assert stats["avg_frames"] > 10
+            assert stats["pending"] == 0
+        finally:
+            client.disconnect()
+            server.stop()
+
+    def test_flush_and_threshold(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_flush_and_threshold.log"),
+                         logging.DEBUG,
+                         "test_flush_and_threshold-filehandler")
+        server = TCPServer(HOST, PORT)
+        client = TCPClient(HOST, PORT, timeout=5, batch_window=30, batch_bytes=1000)
+        try:
+            server.start()
+            time.sleep(0.1)
+            assert client.connect()
+            assert client.send(b'urgent')
+            assert server.pop_msg(block=True, timeout=0.2) is None
+            assert client.flush()
+            assert server.pop_msg(block=True, timeout=5).data == b'urgent'
+
+            # Reaching batch_bytes writes the batch without waiting for the window
+            for i in range(10):
+                assert client.send(bytes([i]) * 100)
+            assert [server.pop_msg(block=True, timeout=5).data for _ in range(10)] == \
+                [bytes([i]) * 100 for i in range(10)]
+
+            # A large frame is written at once, after the frames queued ahead of it
+            assert client.send(b'small')
+            assert client.send(bytes(5000))
+            assert server.pop_msg(block=True, timeout=5).data == b'small'
+            assert server.pop_msg(block=True, timeout=5).data == bytes(5000)
+            assert client.batch_stats()["batches"] == 3
+        finally:
+            client.disconnect()
+            server.stop()
+
+    def test_server_batching(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_server_batching.log"),
+                         logging.DEBUG,
+                         "test_server_batching-filehandler")
+        server = TCPServer(HOST, PORT, batch_window=0.05)
+        client = TCPClient(HOST, PORT, timeout=5)
+        try:
+            server.start()
+            time.sleep(0.1)
+            assert client.connect()
+            assert wait_for(lambda: server.client_count() == 1)
+            client_id = server.list_clients()[0]
+            for i in range(50):
+                assert server.send(client_id, b'%d' % i)
+            assert server.flush(client_id)
+            assert [client.receive_all().data for _ in range(50)] == [b'%d' % i for i in range(50)]
+            assert server.batch_stats(client_id)["batches"] < 10
+            assert TCPClient(HOST, PORT).batch_stats() is None
+        finally:
+            client.disconnect()
+            server.stop()
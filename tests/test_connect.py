@@ -0,0 +1,115 @@
+"""
+test_connect.py
+Written by: Joshua Kitchen - 2024
+"""
+import time
+import logging
+import socket
+import os
+
+from tests.globals_for_tests import setup_log_folder, HOST, PORT
+from src.log_util import add_file_handler
+from src.TCPLib.tcp_client import TCPClient
+from src.TCPLib.tcp_server import TCPServer
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+log_folder = setup_log_folder("TestConnect")
+
+
+class TestConnect:
+    def test_fragmented_handshake(self, server, impaired_proxy):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_fragmented_handshake.log"),
+                         logging.DEBUG,
+                         "test_fragmented_handshake-filehandler")
+        server.start()
+        time.sleep(0.1)
+        # The reply reaches the client one byte at a time
+        proxy = impaired_proxy(max_write=1, latency=0.001)
+        client = TCPClient(*proxy.addr(), timeout=5)
+        try:
+            assert client.connect()
+            assert client.send(b'hello')
+            assert server.pop_msg(block=True, timeout=5).data == b'hello'
+        finally:
+            client.disconnect()
+
+    def test_optimistic(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_optimistic.log"),
+                         logging.DEBUG,
+                         "test_optimistic-filehandler")
+        server = TCPServer(HOST, PORT, fast_open=True)
+        client = TCPClient(HOST, PORT, timeout=5, optimistic=True, fast_open=True)
+        try:
+            assert server.start()
+            time.sleep(0.1)
+            assert client.connect()
+            # Sent before the server's reply has been read
+            assert client.send(b'first')
+            msg = server.pop_msg(block=True, timeout=5)
+            assert msg.data == b'first'
+            assert server.send(msg.client_id, b'reply')
+            assert client.receive_all().data == b'reply'
+            assert client.wait_accepted()
+        finally:
+            client.disconnect()
+            server.stop()
+
+    def test_optimistic_refused(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_optimistic_refused.log"),
+                         logging.DEBUG,
+                         "test_optimistic_refused-filehandler")
+        server = TCPServer(HOST, PORT, max_clients=1)
+        first = TCPClient(HOST, PORT, timeout=5)
+        refused = TCPClient(HOST, PORT, timeout=5, optimistic=True)
+        late = TCPClient(HOST, PORT, timeout=5, optimistic=True)
+        try:
+            assert server.start()
+            time.sleep(0.1)
+            assert first.connect()
+            assert refused.connect()
+            for i in range(10):
+                assert refused.send(b'%d' % i)
+            assert not refused.wait_accepted()
+            assert not refused.is_connected()
+            # A refusal is also seen by the first receive
+            assert late.connect()
+            assert late.receive_all().data is None
+            # Nothing sent by the refused clients reached the queue
+            assert first.send(b'accepted')
+            assert server.pop_msg(block=True, timeout=5).data == b'accepted'
+            assert not server.has_messages()
+        finally:
+            first.disconnect()
+            refused.disconnect()
+            late.disconnect()
+            server.stop()
+
+    def test_refusals_do_not_hold_handshakes(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_refusals_do_not_hold_handshakes.log"),
+                         logging.DEBUG,
+                         "test_refusals_do_not_hold_handshakes-filehandler")
+        server = TCPServer(HOST, PORT, max_clients=1, handshake_workers=1)
+        first = TCPClient(HOST, PORT, timeout=5)
+        idle = []
+        refused = TCPClient(HOST, PORT, timeout=5)
+        try:
+            assert server.start()
+            time.sleep(0.1)
+            assert first.connect()
+            # Refused peers which never close their end are drained off the handshake workers
+            for _ in range(3):
+                idle.append(socket.create_connection((HOST, PORT)))
+            start = time.monotonic()
+            assert not refused.connect()
+            assert time.monotonic() - start < server._REJECT_LINGER
+        finally:
+            first.disconnect()
+            refused.disconnect()
+            for soc in idle:
+                soc.close()
+            server.stop()
@@ -0,0 +1,94 @@
+"""
+test_events.py
+Written by: Joshua Kitchen - 2024
+"""
+import time
+import logging
+import os
+
+from tests.globals_for_tests import setup_log_folder
+from src.log_util import add_file_handler, EventDrain
+from src.TCPLib import events
+from src.TCPLib.events import EventRing
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+log_folder = setup_log_folder("TestEvents")
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestEvents:
+    def test_ring(self):
+        ring = EventRing(capacity=4)
+        for i in range(6):
+            ring.record(events.RECV, "a", i)
+        snapshot = ring.snapshot()
+        assert [e.size for e in snapshot] == [2, 3, 4, 5]
+        assert snapshot[0].event == events.RECV and snapshot[0].client_id == "a"
+
+        drained = ring.drain()
+        assert [e.size for e in drained] == [2, 3, 4, 5]
+        assert ring.dropped() == 2
+        assert ring.drain() == []
+        ring.record(events.SEND, "b", 10)
+        assert [e.size for e in ring.drain()] == [10]
+
+        ring.set_enabled(False)
+        ring.record(events.SEND)
+        ring.sample(events.SEND)
+        assert ring.drain() == []
+
+    def test_sampling(self):
+        ring = EventRing(capacity=100, sample_every=10)
+        for i in range(100):
+            ring.sample(events.RECV, None, i)
+        assert len(ring.snapshot()) == 10
+        ring.record(events.CONNECT)
+        assert ring.snapshot()[-1].event == events.CONNECT
+
+    def test_dump_on_error(self):
+        handler = ListHandler()
+        events.logger.addHandler(handler)
+        try:
+            ring = EventRing(dump_on_error=True)
+            ring.record(events.CONNECT, "7")
+            ring.record_error("7")
+        finally:
+            events.logger.removeHandler(handler)
+        assert len(handler.records) == 1
+        assert "connect" in handler.records[0].getMessage()
+
+    def test_server_events(self, server, client):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_server_events.log"),
+                         logging.DEBUG,
+                         "test_server_events-filehandler")
+        events.RING.configure()
+        server.start()
+        time.sleep(0.1)
+        assert client.connect()
+        client.send(b'hello')
+        msg = server.pop_msg(block=True, timeout=5)
+        recorded = events.RING.snapshot()
+        assert events.ACCEPT in [e.event for e in recorded]
+        assert (msg.client_id, events.CONNECT) in [(e.client_id, e.event) for e in recorded]
+        assert (msg.client_id, events.RECV, 5) in [(e.client_id, e.event, e.size) for e in recorded]
+
+        drain_logger = logging.getLogger("test_server_events.drain")
+        handler = ListHandler()
+        drain_logger.addHandler(handler)
+        drain = EventDrain(drain_logger, logging.INFO, interval=0.05)
+        drain.start()
+        time.sleep(0.2)
+        drain.stop()
+        drain_logger.removeHandler(handler)
+        assert len(handler.records) == len(recorded)
+        assert all(r.levelno == logging.INFO for r in handler.records)
@@ -0,0 +1,81 @@
+"""
+test_impair.py
+Written by: Joshua Kitchen - 2024
+"""
+import os
+import time
+import logging
+
+from tests.globals_for_tests import setup_log_folder
+from src.log_util import add_file_handler
+from src.TCPLib.tcp_client import TCPClient
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+log_folder = setup_log_folder("TestImpair")
+
+
+def round_trip(server, client, data):
+    assert client.send(data)
+    msg = server.pop_msg(block=True, timeout=5)
+    assert msg.data == data
+    assert server.send(msg.client_id, msg.data)
+    return client.receive_all()
+
+
+class TestImpairmentProxy:
+    def test_latency(self, server, impaired_proxy):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_latency.log"),
+                         logging.DEBUG,
+                         "test_latency-filehandler")
+        server.start()
+        time.sleep(0.1)
+        proxy = impaired_proxy(latency=0.05, jitter=0.01, seed=1)
+        client = TCPClient(*proxy.addr(), timeout=5)
+        try:
+            assert client.connect()
+            start = time.monotonic()
+            assert round_trip(server, client, b'ping').data == b'ping'
+            # One trip each way, each delayed by at least latency - jitter
+            assert time.monotonic() - start >= 0.08
+        finally:
+            client.disconnect()
+
+    def test_partial_writes_and_bandwidth(self, server, impaired_proxy):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_partial_writes_and_bandwidth.log"),
+                         logging.DEBUG,
+                         "test_partial_writes_and_bandwidth-filehandler")
+        server.start()
+        time.sleep(0.1)
+        # Impaired from the start, so the handshake reply arrives in fragments too
+        proxy = impaired_proxy(max_write=7, bandwidth=1024 * 1024)
+        client = TCPClient(*proxy.addr(), timeout=5)
+        try:
+            assert client.connect()
+            payload = os.urandom(200 * 1024)
+            start = time.monotonic()
+            assert client.send(payload)
+            assert server.pop_msg(block=True, timeout=5).data == payload
+            assert time.monotonic() - start >= 0.15
+        finally:
+            client.disconnect()
+
+    def test_reset(self, server, impaired_proxy):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_reset.log"),
+                         logging.DEBUG,
+                         "test_reset-filehandler")
+        server.start()
+        time.sleep(0.1)
+        proxy = impaired_proxy(reset_after=1000)
+        client = TCPClient(*proxy.addr(), timeout=5)
+        try:
+            assert client.connect()
+            client.send(bytes(5000))
+            msg = server.pop_msg(block=True, timeout=5)
+            assert msg.data is None
+            assert proxy.connection_count() == 0
+        finally:
+            client.disconnect()
@@ -0,0 +1,69 @@
+"""
+test_loadgen.py
+Written by: Joshua Kitchen - 2024
+"""
+import random
+import threading
+import time
+import logging
+import os
+
+import pytest
+
+from tests.globals_for_tests import setup_log_folder, HOST, PORT
+from src.log_util import add_file_handler
+from src.TCPLib.loadgen import LoadGenerator, parse_size_dist, percentile, InvalidSizeDistribution
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+log_folder = setup_log_folder("TestLoadGen")
+
+
+class TestLoadGen:
+    @staticmethod
+    def echo_loop(server, stop_event):
+        while not stop_event.is_set():
+            msg = server.pop_msg(block=True, timeout=0.1)
+            if msg is None or msg.data is None:
+                continue
+            server.send(msg.client_id, msg.data)
+
+    def test_size_dist(self):
+        rng = random.Random(1)
+        assert parse_size_dist("fixed:10")(rng) == 10
+        assert 5 <= parse_size_dist("uniform:5:8")(rng) <= 8
+        assert parse_size_dist("choice:1,2,3")(rng) in (1, 2, 3)
+        assert parse_size_dist("exp:100")(rng) >= 0
+        for spec in ("fixed:-1", "uniform:9:1", "exp:0", "gauss:5", "fixed"):
+            with pytest.raises(InvalidSizeDistribution):
+                parse_size_dist(spec)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        assert percentile(values, 50) == 50
+        assert percentile(values, 99) == 99
+        assert percentile(values, 100) == 100
+        assert percentile([], 50) == 0.0
+
+    def test_echo_load(self, server):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_echo_load.log"),
+                         logging.INFO,
+                         "test_echo_load-filehandler")
+        server.start()
+        time.sleep(0.1)
+        stop_event = threading.Event()
+        threading.Thread(target=self.echo_loop, args=[server, stop_event]).start()
+
+        reports = []
+        gen = LoadGenerator(HOST, PORT, clients=4, duration=0.5, size_dist="uniform:16:256", rate=200,
+                            open_loop=True, echo=True, timeout=5, report_interval=0.2, seed=1)
+        total = gen.run(on_report=reports.append)
+        stop_event.set()
+
+        assert reports
+        assert total["conn_attempts"] == 4
+        assert total["conn_success_rate"] == 1.0
+        assert total["msgs"] > 0
+        assert total["errors"] == 0
+        assert 0 < total["p50"] <= total["p99"] <= total["max"]
@@ -0,0 +1,152 @@
+"""
+test_message_queue.py
+Written by: Joshua Kitchen - 2024
+"""
+import queue
+import threading
+import time
+import logging
+import os
+
+import pytest
+
+from tests.globals_for_tests import setup_log_folder, HOST, PORT
+from src.log_util import add_file_handler
+from src.TCPLib.message import Message
+from src.TCPLib.message_queue import PriorityMessageQueue, FairMessageQueue, drain_queue
+from src.TCPLib.tcp_client import TCPClient
+from src.TCPLib.tcp_server import TCPServer
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+log_folder = setup_log_folder("TestMessageQueue")
+
+
+class TestMessageQueue:
+    def test_priority_order(self):
+        q = PriorityMessageQueue(starvation_limit=2)
+        for i in range(3):
+            q.put(Message(1, f"low{i}"))
+        for i in range(5):
+            q.put(Message(1, f"high{i}", priority=True))
+        order = [q.get().data for _ in range(8)]
+        assert order == ["high0", "high1", "low0", "high2", "high3", "low1", "high4", "low2"]
+        assert q.empty()
+
+    def test_priority_messages(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_priority_messages.log"),
+                         logging.DEBUG,
+                         "test_priority_messages-filehandler")
+        server = TCPServer(HOST, PORT, msg_q=PriorityMessageQueue())
+        client = TCPClient(HOST, PORT, timeout=5)
+        try:
+            server.start()
+            time.sleep(0.1)
+            assert client.connect()
+            for _ in range(10):
+                client.send(b'bulk')
+            client.send(b'control', priority=True)
+            time.sleep(0.2)
+            msg = server.pop_msg()
+            assert msg.data == b'control'
+            assert msg.priority is True
+            assert all(m.data == b'bulk' and m.priority is False for m in server.get_all_msg())
+
+            server.send(msg.client_id, b'reply', priority=True)
+            reply = client.receive_all()
+            assert reply.data == b'reply'
+            assert reply.priority is True
+        finally:
+            client.disconnect()
+            server.stop()
+
+    def test_fair_round_robin(self):
+        q = FairMessageQueue()
+        for i in range(4):
+            q.put(Message(1, f"a{i}", "a"))
+        q.put(Message(1, "b0", "b"))
+        q.put(Message(1, "c0", "c"))
+        q.put(Message(1, "b1", "b"))
+        order = [q.get().data for _ in range(7)]
+        assert order == ["a0", "b0", "c0", "a1", "b1", "a2", "a3"]
+        assert q.empty()
+
+    def test_fair_deficit_round_robin(self):
+        q = FairMessageQueue(quantum=100)
+        for i in range(3):
+            q.put(Message(100, f"big{i}", "big"))
+        for i in range(6):
+            q.put(Message(50, f"small{i}", "small"))
+        order = [q.get().data for _ in range(9)]
+        assert order == ["big0", "small0", "small1", "big1", "small2", "small3", "big2", "small4", "small5"]
+
+    def test_fair_invalid_quantum(self):
+        for quantum in (0, -1):
+            with pytest.raises(ValueError):
+                FairMessageQueue(quantum=quantum)
+
+    def test_client_rate_limit(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_client_rate_limit.log"),
+                         logging.DEBUG,
+                         "test_client_rate_limit-filehandler")
+        server = TCPServer(HOST, PORT, msg_q=FairMessageQueue(), client_rate=10000, client_burst=10000)
+        client = TCPClient(HOST, PORT, timeout=5)
+        try:
+            server.start()
+            time.sleep(0.1)
+            assert client.connect()
+            start = time.monotonic()
+            for _ in range(4):
+                client.send(b'x' * 5000)
+            for _ in range(4):
+                assert server.pop_msg(block=True, timeout=5) is not None
+            # The first 10000 bytes fit in the burst, the last message has to wait for 5000 bytes of tokens
+            assert time.monotonic() - start >= 0.4
+        finally:
+            client.disconnect()
+            server.stop()
+
+    def test_drain_queue(self):
+        q = queue.Queue()
+        assert drain_queue(q) == []
+        for i in range(10):
+            q.put(i)
+        assert drain_queue(q, 3) == [0, 1, 2]
+        assert drain_queue(q) == [3, 4, 5, 6, 7, 8, 9]
+        assert q.empty()
+
+        fair = FairMessageQueue()
+        fair.put(Message(1, "a0", "a"))
+        fair.put(Message(1, "a1", "a"))
+        fair.put(Message(1, "b0", "b"))
+        assert [m.data for m in drain_queue(fair)] == ["a0", "b0", "a1"]
+
+        threading.Timer(0.1, q.put, args=["late"]).start()
+        start = time.monotonic()
+        assert drain_queue(q, timeout=2) == ["late"]
+        assert time.monotonic() - start < 1
+        assert drain_queue(q, timeout=0.05) == []
+
+    def test_pop_msgs(self, server, client):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_pop_msgs.log"),
+                         logging.DEBUG,
+                         "test_pop_msgs-filehandler")
+        server.start()
+        time.sleep(0.1)
+        assert client.connect()
+        for i in range(100):
+            client.send(str(i).encode())
+        msgs = []
+        while len(msgs) < 100:
+            batch = server.pop_msgs(max_count=30, max_wait=5)
+            assert 0 < len(batch) <= 30
+            msgs.extend(batch)
+        assert [m.data for m in msgs] == [str(i).encode() for i in range(100)]
+        assert server.pop_msgs(max_wait=0.05) == []
+        # get_all_msg() stops as soon as the queue is empty, even when asked to block
+        start = time.monotonic()
+        assert list(server.get_all_msg(block=True)) == []
+        assert time.monotonic() - start < 1
@@ -0,0 +1,107 @@
+"""
+test_pubsub.py
+Written by: Joshua Kitchen - 2024
+"""
+import time
+import logging
+import os
+
+from tests.globals_for_tests import setup_log_folder, HOST, PORT
+from src.log_util import add_file_handler
+from src.TCPLib.pubsub import TopicIndex
+from src.TCPLib.tcp_client import TCPClient
+from src.TCPLib.tcp_server import TCPServer
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+log_folder = setup_log_folder("TestPubSub")
+
+
+def wait_for(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class TestPubSub:
+    def test_topic_index(self):
+        index = TopicIndex()
+        assert index.add("news.sport", 1)
+        assert not index.add("news.sport", 1)
+        assert index.add("news.*", 2)
+        assert index.add("*", 3)
+        assert index.match("news.sport") == {1, 2, 3}
+        assert index.match("news.weather") == {2, 3}
+        assert index.match("news") == {3}
+        assert index.remove("news.*", 2)
+        assert not index.remove("news.*", 2)
+        assert index.match("news.weather") == {3}
+
+    def test_publish(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_publish.log"),
+                         logging.DEBUG,
+                         "test_publish-filehandler")
+        server = TCPServer(HOST, PORT)
+        sport = TCPClient(HOST, PORT, timeout=5)
+        everything = TCPClient(HOST, PORT, timeout=5)
+        try:
+            server.start()
+            time.sleep(0.1)
+            assert sport.connect()
+            assert everything.connect()
+            assert sport.subscribe("news.sport")
+            assert everything.subscribe("news.*")
+            assert wait_for(lambda: len(server.subscribers("news.sport")) == 2)
+            # Control frames never reach the message queue
+            assert not server.has_messages()
+
+            assert server.publish("news.sport", b'goal') == 2
+            assert server.publish("news.weather", b'rain', priority=True) == 1
+            msg = sport.receive_all()
+            assert (msg.topic, msg.data) == ("news.sport", bytearray(b'goal'))
+            msg = everything.receive_all()
+            assert (msg.topic, msg.data) == ("news.sport", bytearray(b'goal'))
+            msg = everything.receive_all()
+            assert (msg.topic, msg.data, msg.priority) == ("news.weather", bytearray(b'rain'), True)
+
+            # Ordinary messages still work alongside published ones
+            assert sport.send(b'hello')
+            client_id = server.pop_msg(block=True, timeout=5).client_id
+            assert server.get_client_info(client_id)["topics"] == ["news.sport"]
+
+            assert sport.unsubscribe("news.sport")
+            assert wait_for(lambda: len(server.subscribers("news.sport")) == 1)
+        finally:
+            sport.disconnect()
+            everything.disconnect()
+            server.stop()
+
+    def test_slow_consumer(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_slow_consumer.log"),
+                         logging.DEBUG,
+                         "test_slow_consumer-filehandler")
+        server = TCPServer(HOST, PORT, sub_buffer=2, slow_consumer="disconnect")
+        client = TCPClient(HOST, PORT, timeout=5)
+        try:
+            server.start()
+            time.sleep(0.1)
+            assert client.connect()
+            assert client.subscribe("bulk")
+            assert wait_for(lambda: server.subscribers("bulk"))
+            # The client never reads, so once the socket buffers fill up its subscriber buffer does too
+            payload = bytes(1024 * 1024)
+            for _ in range(200):
+                server.publish("bulk", payload)
+                if server.client_count() == 0:
+                    break
+                time.sleep(0.001)
+            assert server.client_count() == 0
+            assert server.subscribers("bulk") == []
+        finally:
+            client.disconnect()
+            server.stop()
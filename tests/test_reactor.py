@@ -0,0 +1,167 @@
+"""
+test_reactor.py
+Written by: Joshua Kitchen - 2024
+"""
+import tempfile
+import threading
+import time
+import logging
+import os
+
+from tests.globals_for_tests import setup_log_folder, HOST, PORT
+from src.log_util import add_file_handler
+from src.TCPLib.reactor import ReactorTCPServer
+from src.TCPLib.tcp_client import TCPClient
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+log_folder = setup_log_folder("TestReactor")
+
+
+def wait_for(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class TestReactor:
+    def test_echo_many_clients(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_echo_many_clients.log"),
+                         logging.DEBUG,
+                         "test_echo_many_clients-filehandler")
+        server = ReactorTCPServer(HOST, PORT, io_threads=2)
+        clients = [TCPClient(HOST, PORT, timeout=5) for _ in range(50)]
+        try:
+            assert server.start()
+            time.sleep(0.1)
+            threads_before = threading.active_count()
+            for c in clients:
+                assert c.connect()
+            assert wait_for(lambda: server.client_count() == 50)
+            # Clients do not get a thread each
+            assert threading.active_count() < threads_before + 10
+            for i, c in enumerate(clients):
+                assert c.send(b'%d' % i)
+            for _ in clients:
+                msg = server.pop_msg(block=True, timeout=5)
+                assert server.send(msg.client_id, msg.data)
+            for i, c in enumerate(clients):
+                assert c.receive_all().data == b'%d' % i
+        finally:
+            for c in clients:
+                c.disconnect()
+            server.stop()
+
+    def test_large_and_priority(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_large_and_priority.log"),
+                         logging.DEBUG,
+                         "test_large_and_priority-filehandler")
+        server = ReactorTCPServer(HOST, PORT)
+        client = TCPClient(HOST, PORT, timeout=5)
+        payload = os.urandom(8 * 1024 * 1024)
+        try:
+            assert server.start()
+            time.sleep(0.1)
+            assert client.connect()
+            assert not client.shm_enabled()
+            assert client.send(payload)
+            assert client.send(b'urgent', priority=True)
+            msg = server.pop_msg(block=True, timeout=5)
+            assert msg.data == payload
+            # The reply is larger than the socket buffers, so the reactor finishes writing it
+            assert server.send(msg.client_id, payload)
+            msg = server.pop_msg(block=True, timeout=5)
+            assert (msg.data, msg.priority) == (b'urgent', True)
+            assert client.receive_all().data == payload
+            # A buffer the caller changes once send() returns is sent as it was
+            mutable = bytearray(payload)
+            assert server.send(msg.client_id, mutable)
+            mutable[:] = bytes(len(mutable))
+            assert client.receive_all().data == payload
+        finally:
+            client.disconnect()
+            server.stop()
+
+    def test_disconnects(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_disconnects.log"),
+                         logging.DEBUG,
+                         "test_disconnects-filehandler")
+        server = ReactorTCPServer(HOST, PORT, max_msg_size=1024)
+        closer = TCPClient(HOST, PORT, timeout=5)
+        too_large = TCPClient(HOST, PORT, timeout=5)
+        kicked = TCPClient(HOST, PORT, timeout=5)
+        try:
+            assert server.start()
+            time.sleep(0.1)
+            for c in (closer, too_large, kicked):
+                assert c.connect()
+                assert c.send(b'hello')
+            ids = [server.pop_msg(block=True, timeout=5).client_id for _ in range(3)]
+
+            closer.disconnect()
+            msg = server.pop_msg(block=True, timeout=5)
+            assert (msg.data, msg.client_id) == (None, ids[0])
+
+            assert too_large.send(b'a' * 1025)
+            msg = server.pop_msg(block=True, timeout=5)
+            assert (msg.data, msg.client_id) == (None, ids[1])
+            assert not server.get_client_info(ids[1])["is_running"]
+
+            assert server.disconnect_client(ids[2])
+            assert kicked.receive_all().data is None
+            assert not server.has_messages()
+        finally:
+            for c in (closer, too_large, kicked):
+                c.disconnect()
+            server.stop()
+
+    def test_client_timeout(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_client_timeout.log"),
+                         logging.DEBUG,
+                         "test_client_timeout-filehandler")
+        server = ReactorTCPServer(HOST, PORT, timeout=0.3)
+        client = TCPClient(HOST, PORT, timeout=5)
+        try:
+            assert server.start()
+            time.sleep(0.1)
+            assert client.connect()
+            msg = server.pop_msg(block=True, timeout=5)
+            assert msg.data is None
+            assert client.receive_all().data is None
+        finally:
+            client.disconnect()
+            server.stop()
+
+    def test_spool_and_publish(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_spool_and_publish.log"),
+                         logging.DEBUG,
+                         "test_spool_and_publish-filehandler")
+        server = ReactorTCPServer(HOST, PORT, mem_budget=64 * 1024)
+        client = TCPClient(HOST, PORT, timeout=5, spool=tempfile.mkdtemp())
+        try:
+            assert server.start()
+            time.sleep(0.1)
+            assert client.connect()
+            for i in range(100):
+                assert client.send(b'%d' % i)
+            assert client.wait_acked(timeout=5)
+            assert [server.pop_msg(block=True, timeout=5).data for _ in range(100)] == [b'%d' % i for i in range(100)]
+            assert server.memory_stats()["used"] == 0
+
+            assert client.subscribe("news")
+            assert wait_for(lambda: server.subscribers("news"))
+            assert server.publish("news", b'extra') == 1
+            msg = client.receive_all()
+            assert (msg.topic, msg.data) == ("news", b'extra')
+        finally:
+            client.disconnect()
+            client.spool().close()
+            server.stop()
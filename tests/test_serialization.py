@@ -0,0 +1,168 @@
+"""
+test_serialization.py
+Written by: Joshua Kitchen - 2024
+"""
+import array
+import collections
+import pickle
+import time
+import logging
+import os
+
+import pytest
+
+from tests.globals_for_tests import setup_log_folder
+from src.log_util import add_file_handler
+from src.TCPLib.serialization import ArrayCodec, JSONCodec, PickleCodec, StructCodec, UnknownCodec, get_codec
+from src.TCPLib.tcp_client import BufferTooSmall
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+log_folder = setup_log_folder("TestSerialization")
+
+Point = collections.namedtuple("Point", ["x", "y", "label"])
+
+
+def joined(data):
+    if isinstance(data, list):
+        out = bytearray()
+        for part in data:
+            out.extend(part)
+        return out
+    return data
+
+
+class TestSerialization:
+    def test_get_codec(self):
+        assert isinstance(get_codec(None), JSONCodec)
+        assert isinstance(get_codec("pickle"), PickleCodec)
+        codec = StructCodec("<i")
+        assert get_codec(codec) is codec
+        with pytest.raises(UnknownCodec):
+            get_codec("yaml")
+
+    def test_json(self):
+        codec = JSONCodec()
+        obj = {"a": [1, 2.5, "three"], "b": None}
+        assert codec.decode(codec.encode(obj)) == obj
+        assert codec.decode(memoryview(codec.encode(obj))) == obj
+
+    def test_pickle_out_of_band(self):
+        codec = PickleCodec()
+        payload = bytearray(b'\x01' * 100000)
+        obj = {"name": "blob", "data": pickle.PickleBuffer(payload)}
+        parts = codec.encode(obj)
+        # The buffer is sent as it is rather than copied into the pickle
+        assert any(memoryview(part).obj is payload for part in parts)
+        received = joined(parts)
+        decoded = codec.decode(received)
+        assert decoded["name"] == "blob"
+        view = memoryview(decoded["data"])
+        assert view.tobytes() == bytes(payload)
+        assert view.obj is received
+
+        in_band = PickleCodec(out_of_band=False)
+        assert in_band.decode(joined(in_band.encode({"x": 1}))) == {"x": 1}
+
+    def test_struct(self):
+        single = StructCodec("<ddh", record_type=Point)
+        assert single.decode(single.encode((1.0, 2.0, 3))) == Point(1.0, 2.0, 3)
+        batch = StructCodec("<ddh", batch=True)
+        records = [(float(i), float(i) * 2, i) for i in range(100)]
+        data = batch.encode(records)
+        assert len(data) == 100 * batch.record_size()
+        assert batch.decode(data) == records
+
+    def test_send_recv_obj(self, server, client):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_send_recv_obj.log"),
+                         logging.DEBUG,
+                         "test_send_recv_obj-filehandler")
+        server.start()
+        time.sleep(0.1)
+        assert client.connect()
+        obj = {"op": "sum", "values": list(range(10))}
+        assert client.send_obj(obj)
+        msg = server.receive_obj(block=True, timeout=5)
+        assert msg.data == obj
+
+        big = {"data": pickle.PickleBuffer(bytearray(range(256)) * 4000)}
+        assert client.send_obj(big, codec="pickle")
+        msg = server.receive_obj(block=True, timeout=5, codec="pickle")
+        assert bytes(msg.data["data"]) == bytes(bytearray(range(256)) * 4000)
+
+        batch = StructCodec("<ddh", batch=True)
+        records = [(1.5, 2.5, 3)] * 1000
+        assert server.send_obj(msg.client_id, records, codec=batch)
+        assert client.receive_obj(codec=batch).data == records
+
+    def test_receive_into(self, server, client):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_receive_into.log"),
+                         logging.DEBUG,
+                         "test_receive_into-filehandler")
+        server.start()
+        time.sleep(0.1)
+        assert client.connect()
+        client.send(b'hello')
+        client_id = server.pop_msg(block=True, timeout=5).client_id
+
+        values = array.array('d', [float(i) for i in range(1000)])
+        assert server.send(client_id, values)
+        out = array.array('d', bytes(8 * 1000))
+        msg = client.receive_into(out)
+        assert msg.size == 8000
+        assert out == values
+
+        assert server.send(client_id, b'x' * 100)
+        assert server.send(client_id, b'after')
+        with pytest.raises(BufferTooSmall):
+            client.receive_into(bytearray(10))
+        # The oversized message was discarded, so the next message is still readable
+        assert bytes(client.receive_into(bytearray(10)).data) == b'after'
+
+    def test_array_codec(self):
+        np = pytest.importorskip("numpy")
+        codec = ArrayCodec()
+        arr = np.arange(24, dtype=np.float32).reshape(2, 3, 4)
+        parts = codec.encode(arr)
+        assert np.shares_memory(parts[1], arr)
+        decoded = codec.decode(joined(parts))
+        assert decoded.dtype == arr.dtype
+        assert np.array_equal(decoded, arr)
+        # Non-contiguous arrays are made contiguous
+        assert np.array_equal(codec.decode(joined(codec.encode(arr[:, ::2]))), arr[:, ::2])
+
+    def test_send_recv_array(self, server, client):
+        np = pytest.importorskip("numpy")
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_send_recv_array.log"),
+                         logging.DEBUG,
+                         "test_send_recv_array-filehandler")
+        server.start()
+        time.sleep(0.1)
+        assert client.connect()
+        arr = np.random.default_rng(1).random((500, 300))
+        assert client.send_array(arr)
+        msg = server.receive_obj(block=True, timeout=5, codec="array")
+        assert np.array_equal(msg.data, arr)
+
+        assert server.send_array(msg.client_id, arr.astype(np.int16))
+        out = np.zeros((500, 300), dtype=np.int16)
+        assert client.receive_array(out) is out
+        assert np.array_equal(out, arr.astype(np.int16))
+
+        assert server.send_array(msg.client_id, arr)
+        with pytest.raises(ValueError):
+            client.receive_array(out)
+        assert server.send_array(msg.client_id, arr[:10])
+        assert np.array_equal(client.receive_array(), arr[:10])
+
+        # Sizes from the peer are checked before anything is allocated for them
+        meta = b'{"dtype": "<f8", "shape": [100000, 100000, 100000]}'
+        for bad in (b'\x7f\xff\xff\xff' + meta, len(meta).to_bytes(4, 'big') + meta + b'\x00' * 8):
+            assert server.send(msg.client_id, bad)
+            with pytest.raises(ValueError):
+                client.receive_array()
+        assert server.send_array(msg.client_id, arr[:10])
+        assert np.array_equal(client.receive_array(), arr[:10])
@@ -0,0 +1,131 @@
+"""
+test_sharding.py
+Written by: Joshua Kitchen - 2024
+"""
+import socket
+import threading
+import time
+import logging
+import os
+
+from tests.globals_for_tests import setup_log_folder, HOST, PORT
+from src.log_util import add_file_handler
+from src.TCPLib.sharding import HashRing, ShardedTCPClient
+from src.TCPLib.tcp_client import TCPClient
+from src.TCPLib.tcp_server import TCPServer
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+log_folder = setup_log_folder("TestSharding")
+
+ADDRS = [(HOST, PORT), (HOST, PORT + 1), (HOST, PORT + 2)]
+
+
+def wait_for(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class TestHashRing:
+    def test_balance_and_rebalance(self):
+        ring = HashRing(["a", "b", "c"])
+        keys = ["key-%d" % i for i in range(3000)]
+        before = {key: ring.lookup(key) for key in keys}
+        counts = {node: list(before.values()).count(node) for node in "abc"}
+        assert all(700 < count < 1300 for count in counts.values())
+
+        # Only keys which now belong to the new node move
+        ring.add("d")
+        after = {key: ring.lookup(key) for key in keys}
+        moved = [key for key in keys if before[key] != after[key]]
+        assert all(after[key] == "d" for key in moved)
+        assert 450 < len(moved) < 1050
+
+        # Removing it puts every key back where it was
+        ring.remove("d")
+        assert {key: ring.lookup(key) for key in keys} == before
+        assert list(ring.preference("key-1"))[0] == before["key-1"]
+        assert sorted(ring.preference("key-1")) == ["a", "b", "c"]
+        assert HashRing().lookup("key") is None
+
+
+class TestShardedClient:
+    def test_routing_and_failover(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_routing_and_failover.log"),
+                         logging.DEBUG,
+                         "test_routing_and_failover-filehandler")
+        full_addr = (HOST, PORT + 3)
+        servers = {addr: TCPServer(*addr, max_clients=1) for addr in ADDRS + [full_addr]}
+        client = ShardedTCPClient(ADDRS, timeout=5, retry_interval=30)
+        blocker = TCPClient(*full_addr, timeout=5)
+        try:
+            for server in servers.values():
+                assert server.start()
+            time.sleep(0.1)
+            for i in range(30):
+                key = "user-%d" % i
+                assert client.send(key, key.encode())
+                msg = servers[client.server_for(key)].pop_msg(block=True, timeout=5)
+                assert msg.data == key.encode()
+            assert sorted(client.connected_servers()) == ADDRS
+
+            # A server which stops fails over to the next one on the ring
+            key = next("k%d" % i for i in range(1000) if client.server_for("k%d" % i) == ADDRS[0])
+            servers[ADDRS[0]].stop()
+            time.sleep(0.1)
+            for _ in range(3):
+                # The first send may still succeed before the closed connection is noticed
+                client.send(key, b'failover')
+            fallback = list(HashRing(ADDRS).preference(key))[1]
+            assert servers[fallback].pop_msg(block=True, timeout=5).data == b'failover'
+            assert ADDRS[0] not in client.connected_servers()
+            servers[fallback].pop_msgs()
+
+            # A server which answers SERVER FULL is skipped
+            assert blocker.connect()
+            assert client.add_server(full_addr)
+            key = next("k%d" % i for i in range(1000) if client.server_for("k%d" % i) == full_addr)
+            assert client.send(key, b'full')
+            fallback = [addr for addr in HashRing(ADDRS).preference(key) if addr != ADDRS[0]][0]
+            assert servers[fallback].pop_msg(block=True, timeout=5).data == b'full'
+            assert full_addr not in client.connected_servers()
+        finally:
+            blocker.disconnect()
+            client.disconnect()
+            for server in servers.values():
+                server.stop()
+
+    def test_slow_server_does_not_block_others(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_slow_server_does_not_block_others.log"),
+                         logging.DEBUG,
+                         "test_slow_server_does_not_block_others-filehandler")
+        # A listening socket which never accepts: connections to it wait for a handshake reply until they time out
+        silent = socket.create_server((HOST, PORT + 4))
+        silent_addr = (HOST, PORT + 4)
+        server = TCPServer(*ADDRS[0])
+        client = ShardedTCPClient([ADDRS[0], silent_addr], timeout=1, retry_interval=30)
+        try:
+            assert server.start()
+            time.sleep(0.1)
+            slow_key = next("k%d" % i for i in range(1000) if client.server_for("k%d" % i) == silent_addr)
+            fast_key = next("k%d" % i for i in range(1000) if client.server_for("k%d" % i) == ADDRS[0])
+            th = threading.Thread(target=client.send, args=[slow_key, b'slow'])
+            th.start()
+            time.sleep(0.1)
+            start = time.monotonic()
+            assert client.send(fast_key, b'fast')
+            assert time.monotonic() - start < 0.5
+            assert server.pop_msg(block=True, timeout=5).data == b'fast'
+            th.join()
+            # The slow server timed out, so its message failed over
+            assert server.pop_msg(block=True, timeout=5).data == b'slow'
+        finally:
+            client.disconnect()
+            server.stop()
+            silent.close()
@@ -0,0 +1,214 @@
+"""
+test_shm.py
+Written by: Joshua Kitchen - 2024
+"""
+import os
+import tempfile
+import time
+import logging
+
+import pytest
+
+from tests.globals_for_tests import setup_log_folder, HOST, PORT
+from src.log_util import add_file_handler
+from src.TCPLib import shm
+from src.TCPLib.tcp_client import TCPClient
+from src.TCPLib.tcp_server import TCPServer
+from src.TCPLib.utils import encode_msg, MSG_FLAG_SHM
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+log_folder = setup_log_folder("TestShm")
+
+
+def wait_for(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def segments(shm_dir):
+    return [name for name in os.listdir(shm_dir) if name.startswith("tcplib-")]
+
+
+@pytest.mark.skipif(not shm.is_supported(), reason="Shared memory messages are not supported on this platform")
+class TestShm:
+    def test_descriptor(self):
+        shm_dir = tempfile.mkdtemp()
+        token = shm.new_token()
+        name, size = shm.write_segment([b'hello ', bytearray(b'world')], shm_dir, token)
+        # A receiver with another token, such as another connection's, can neither read nor remove the segment
+        for other in (shm.new_token(), None):
+            with pytest.raises(shm.InvalidShmDescriptor):
+                shm.map_segment(shm.encode_descriptor(name, size), shm_dir, other)
+        assert segments(shm_dir) == [name]
+        view = shm.map_segment(shm.encode_descriptor(name, size), shm_dir, token)
+        assert bytes(view) == b'hello world'
+        assert segments(shm_dir) == []
+        with pytest.raises(shm.InvalidShmDescriptor):
+            shm.map_segment(shm.encode_descriptor("../etc/passwd", 10), shm_dir, token)
+
+    def test_send_recv_shm(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_send_recv_shm.log"),
+                         logging.DEBUG,
+                         "test_send_recv_shm-filehandler")
+        shm_dir = tempfile.mkdtemp()
+        server = TCPServer(HOST, PORT, shm_threshold=1024, shm_dir=shm_dir)
+        client = TCPClient(HOST, PORT, timeout=5, shm_threshold=1024, shm_dir=shm_dir)
+        try:
+            server.start()
+            time.sleep(0.1)
+            assert client.connect()
+            assert client.shm_enabled()
+            payload = os.urandom(4 * 1024 * 1024)
+            assert client.send(payload)
+            msg = server.pop_msg(block=True, timeout=5)
+            assert isinstance(msg.data, memoryview)
+            assert msg.size == len(payload)
+            assert msg.data == payload
+            assert segments(shm_dir) == []
+
+            # Small messages still go through the socket
+            assert client.send(b'small')
+            assert server.pop_msg(block=True, timeout=5).data == bytearray(b'small')
+
+            assert server.send(msg.client_id, msg.data)
+            reply = client.receive_all()
+            assert isinstance(reply.data, memoryview)
+            assert reply.data == payload
+        finally:
+            client.disconnect()
+            server.stop()
+
+    def test_not_negotiated(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_not_negotiated.log"),
+                         logging.DEBUG,
+                         "test_not_negotiated-filehandler")
+        shm_dir = tempfile.mkdtemp()
+        server = TCPServer(HOST, PORT)
+        client = TCPClient(HOST, PORT, timeout=5, shm_threshold=1024, shm_dir=shm_dir)
+        try:
+            server.start()
+            time.sleep(0.1)
+            assert client.connect()
+            assert not client.shm_enabled()
+            assert client.send(b'x' * 10000)
+            assert server.pop_msg(block=True, timeout=5).data == bytearray(b'x' * 10000)
+            assert segments(shm_dir) == []
+        finally:
+            client.disconnect()
+            server.stop()
+
+    def test_foreign_segment_refused(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_foreign_segment_refused.log"),
+                         logging.DEBUG,
+                         "test_foreign_segment_refused-filehandler")
+        shm_dir = tempfile.mkdtemp()
+        server = TCPServer(HOST, PORT, shm_threshold=1024, shm_dir=shm_dir)
+        victim = TCPClient(HOST, PORT, timeout=5, shm_threshold=1024, shm_dir=shm_dir)
+        intruder = TCPClient(HOST, PORT, timeout=5, shm_threshold=1024, shm_dir=shm_dir)
+        try:
+            server.start()
+            time.sleep(0.1)
+            assert victim.connect()
+            assert intruder.connect()
+            assert victim.send(b'victim')
+            victim_id = server.pop_msg(block=True, timeout=5).client_id
+            payload = os.urandom(100000)
+            assert server.send(victim_id, payload)
+            [name] = segments(shm_dir)
+            # The intruder names the victim's segment in a descriptor of its own
+            assert intruder.send_bytes(encode_msg(shm.encode_descriptor(name, len(payload)), MSG_FLAG_SHM))
+            msg = server.pop_msg(block=True, timeout=5)
+            assert msg.data is None and msg.client_id != victim_id
+            assert segments(shm_dir) == [name]
+            assert victim.receive_all().data == payload
+        finally:
+            victim.disconnect()
+            intruder.disconnect()
+            server.stop()
+
+    def test_cleanup_on_disconnect(self, monkeypatch):
+        monkeypatch.setattr(TCPClient, "_SHM_LINGER", 0.1)
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_cleanup_on_disconnect.log"),
+                         logging.DEBUG,
+                         "test_cleanup_on_disconnect-filehandler")
+        shm_dir = tempfile.mkdtemp()
+        server = TCPServer(HOST, PORT, shm_threshold=1024, shm_dir=shm_dir)
+        client = TCPClient(HOST, PORT, timeout=5, shm_threshold=1024, shm_dir=shm_dir)
+        try:
+            server.start()
+            time.sleep(0.1)
+            assert client.connect()
+            client.send(b'hello')
+            client_id = server.pop_msg(block=True, timeout=5).client_id
+            # The client never reads these, so the segments are still there until the server drops the client
+            for _ in range(3):
+                assert server.send(client_id, bytes(100000))
+            assert len(segments(shm_dir)) == 3
+            server.disconnect_client(client_id)
+            # The client could still read the descriptors, so the segments are only removed after the grace period
+            assert len(segments(shm_dir)) == 3
+            time.sleep(0.3)
+            assert segments(shm_dir) == []
+        finally:
+            client.disconnect()
+            server.stop()
+
+    def test_send_then_disconnect(self):
+        """
+        Messages sent through shared memory right before disconnecting must still reach a server which is slow to
+        read them
+        """
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_send_then_disconnect.log"),
+                         logging.DEBUG,
+                         "test_send_then_disconnect-filehandler")
+        shm_dir = tempfile.mkdtemp()
+        server = TCPServer(HOST, PORT, shm_threshold=1024, shm_dir=shm_dir, client_rate=4 * 1024 * 1024,
+                           client_burst=1024 * 1024)
+        client = TCPClient(HOST, PORT, timeout=5, shm_threshold=1024, shm_dir=shm_dir)
+        try:
+            server.start()
+            time.sleep(0.1)
+            assert client.connect()
+            assert wait_for(client.shm_enabled)
+            for i in range(5):
+                assert client.send(bytes([i]) * 1024 * 1024)
+            client.disconnect()
+            msgs = [server.pop_msg(block=True, timeout=5) for _ in range(6)]
+            assert [bytes(m.data[:1]) for m in msgs[:5]] == [bytes([i]) for i in range(5)]
+            assert msgs[5].data is None
+            assert segments(shm_dir) == []
+        finally:
+            client.disconnect()
+            server.stop()
+
+    def test_sent_segments_pruned(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_sent_segments_pruned.log"),
+                         logging.DEBUG,
+                         "test_sent_segments_pruned-filehandler")
+        shm_dir = tempfile.mkdtemp()
+        server = TCPServer(HOST, PORT, shm_threshold=1024, shm_dir=shm_dir)
+        client = TCPClient(HOST, PORT, timeout=5, shm_threshold=1024, shm_dir=shm_dir)
+        try:
+            server.start()
+            time.sleep(0.1)
+            assert client.connect()
+            assert wait_for(client.shm_enabled)
+            for _ in range(200):
+                assert client.send(bytes(2048))
+                assert server.pop_msg(block=True, timeout=5).size == 2048
+            # Segments the server has read are forgotten instead of piling up for the life of the connection
+            assert len(client._shm_sent) < TCPClient._SHM_PRUNE_AT
+        finally:
+            client.disconnect()
+            server.stop()
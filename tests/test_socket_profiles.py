@@ -0,0 +1,70 @@
+"""
+test_socket_profiles.py
+Written by: Joshua Kitchen - 2024
+"""
+import socket
+import time
+import logging
+import os
+
+import pytest
+
+from tests.globals_for_tests import setup_log_folder, HOST, PORT
+from src.log_util import add_file_handler
+from src.TCPLib.tcp_client import TCPClient
+from src.TCPLib.tcp_server import TCPServer
+from src.TCPLib.socket_profiles import AdaptiveBuffer, SocketProfile, UnknownProfile, get_profile
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+log_folder = setup_log_folder("TestSocketProfiles")
+
+
+class TestSocketProfiles:
+    def test_get_profile(self):
+        assert get_profile(None).name == "default"
+        assert get_profile("low_latency").nodelay is True
+        custom = SocketProfile("custom", buff_size=10)
+        assert get_profile(custom) is custom
+        with pytest.raises(UnknownProfile):
+            get_profile("does_not_exist")
+
+    def test_adaptive_buffer(self):
+        adaptive = AdaptiveBuffer(SocketProfile("test", buff_size=4096, max_buff_size=65536))
+        assert adaptive.observe(100) == 4096
+        for _ in range(50):
+            adaptive.observe(30000)
+        assert adaptive.buff_size() == 32768
+        for _ in range(50):
+            adaptive.observe(1000000)
+        assert adaptive.buff_size() == 65536
+        for _ in range(50):
+            adaptive.observe(10)
+        assert adaptive.buff_size() == 65536
+
+    def test_profiles_applied(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_profiles_applied.log"),
+                         logging.DEBUG,
+                         "test_profiles_applied-filehandler")
+        server = TCPServer(HOST, PORT, profile="adaptive")
+        client = TCPClient(HOST, PORT, profile="low_latency")
+        try:
+            server.start()
+            time.sleep(0.1)
+            assert client.connect()
+            time.sleep(0.1)
+            assert client._soc.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+            client_proc = server._get_client(server.list_clients()[0])
+            assert client_proc._tcp_client._soc.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+            assert client.buff_size() == 16384
+
+            data = b'x' * 200000
+            for _ in range(20):
+                client.send(data)
+            for _ in range(20):
+                assert server.pop_msg(block=True, timeout=5).data == data
+            assert client_proc._tcp_client.buff_size() > 4096
+        finally:
+            client.disconnect()
+            server.stop()
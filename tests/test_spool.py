@@ -0,0 +1,144 @@
+"""
+test_spool.py
+Written by: Joshua Kitchen - 2024
+"""
+import os
+import tempfile
+import time
+import logging
+
+from tests.globals_for_tests import setup_log_folder, HOST, PORT
+from src.log_util import add_file_handler
+from src.TCPLib.spool import Spool
+from src.TCPLib.tcp_client import TCPClient
+from src.TCPLib.tcp_server import TCPServer
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+log_folder = setup_log_folder("TestSpool")
+
+
+def segment_files(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(".seg"))
+
+
+class TestSpool:
+    def test_append_ack(self):
+        directory = tempfile.mkdtemp()
+        spool = Spool(directory, segment_size=256, fsync_every=0)
+        seqs = [spool.append(bytes([i]) * 100) for i in range(5)]
+        assert seqs == [1, 2, 3, 4, 5]
+        # Two 116 byte records fit in a 256 byte segment
+        assert len(segment_files(directory)) == 3
+        spool.ack(4)
+        assert spool.pending() == 1
+        assert spool.unacked() == [(5, bytes([4]) * 100)]
+        assert len(segment_files(directory)) == 1
+        spool.close()
+
+    def test_recovery(self):
+        directory = tempfile.mkdtemp()
+        spool = Spool(directory, segment_size=4096)
+        for i in range(3):
+            spool.append(b'message %d' % i)
+        spool.ack(1)
+        spool.close()
+
+        spool = Spool(directory, segment_size=4096)
+        assert spool.unacked() == [(2, b'message 1'), (3, b'message 2')]
+        assert spool.append(b'next') == 4
+        spool.close()
+
+        # A record which was only partly written is dropped along with everything after it
+        path = os.path.join(directory, segment_files(directory)[-1])
+        with open(path, 'r+b') as f:
+            data = f.read()
+            f.seek(data.index(b'message 2'))
+            f.write(b'X')
+        spool = Spool(directory, segment_size=4096)
+        assert [seq for seq, _ in spool.unacked()] == [2]
+        spool.close()
+
+    def test_resend_after_reconnect(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_resend_after_reconnect.log"),
+                         logging.DEBUG,
+                         "test_resend_after_reconnect-filehandler")
+        directory = tempfile.mkdtemp()
+        server = TCPServer(HOST, PORT)
+        client = TCPClient(HOST, PORT, timeout=5, spool=directory)
+        try:
+            server.start()
+            time.sleep(0.1)
+            assert client.connect()
+            assert client.send(b'one')
+            assert client.wait_acked(timeout=5)
+            assert server.pop_msg(block=True, timeout=5).data == bytearray(b'one')
+            assert client.spool().pending() == 0
+
+            client.disconnect()
+            # Sent while disconnected, so they wait in the spool
+            assert client.send(b'two')
+            assert client.send(b'three')
+            assert client.spool().pending() == 2
+            assert client.connect()
+            assert client.wait_acked(timeout=5)
+            # The first connection's disconnect comes before the resent messages
+            assert server.pop_msg(block=True, timeout=5).data is None
+            assert [server.pop_msg(block=True, timeout=5).data for _ in range(2)] == [b'two', b'three']
+        finally:
+            client.disconnect()
+            server.stop()
+
+    def test_send_only(self):
+        """
+        A client which never receives still reads its acknowledgements, so its spool shrinks as it sends
+        """
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_send_only.log"),
+                         logging.DEBUG,
+                         "test_send_only-filehandler")
+        directory = tempfile.mkdtemp()
+        server = TCPServer(HOST, PORT)
+        client = TCPClient(HOST, PORT, timeout=5, spool=Spool(directory, fsync_every=0))
+        try:
+            server.start()
+            time.sleep(0.1)
+            assert client.connect()
+            for i in range(5000):
+                assert client.send(b'%d' % i)
+            msgs = [server.pop_msg(block=True, timeout=5) for _ in range(5000)]
+            assert msgs[-1].data == b'4999'
+            time.sleep(0.1)
+            # The next drain of the socket applies the acknowledgement of everything popped so far
+            for i in range(TCPClient._ACK_DRAIN_EVERY):
+                assert client.send(b'more')
+            assert client.spool().pending() <= TCPClient._ACK_DRAIN_EVERY
+        finally:
+            client.disconnect()
+            client.spool().close()
+            server.stop()
+
+    def test_resend_after_restart(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_resend_after_restart.log"),
+                         logging.DEBUG,
+                         "test_resend_after_restart-filehandler")
+        directory = tempfile.mkdtemp()
+        spool = Spool(directory)
+        offline = TCPClient(HOST, PORT, spool=spool)
+        assert offline.send(b'queued before the server was up')
+        spool.close()
+
+        server = TCPServer(HOST, PORT)
+        client = TCPClient(HOST, PORT, timeout=5, spool=directory)
+        try:
+            server.start()
+            time.sleep(0.1)
+            assert client.connect()
+            assert client.wait_acked(timeout=5)
+            assert server.pop_msg(block=True, timeout=5).data == bytearray(b'queued before the server was up')
+        finally:
+            client.disconnect()
+            client.spool().close()
+            server.stop()
@@ -0,0 +1,113 @@
+"""
+test_transports.py
+Written by: Joshua Kitchen - 2024
+"""
+import os
+import socket
+import tempfile
+import time
+import logging
+
+import pytest
+
+from tests.globals_for_tests import setup_log_folder
+from src.log_util import add_file_handler
+from src.TCPLib.tcp_client import TCPClient
+from src.TCPLib.tcp_server import TCPServer
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+log_folder = setup_log_folder("TestTransports")
+
+
+def echo_once(server, client, data):
+    assert client.send(data)
+    msg = server.pop_msg(block=True, timeout=5)
+    assert msg.data == data
+    assert server.send(msg.client_id, msg.data)
+    return client.receive_all()
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="Unix domain sockets are not supported")
+class TestUnixTransport:
+    def test_unix_socket(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_unix_socket.log"),
+                         logging.DEBUG,
+                         "test_unix_socket-filehandler")
+        path = os.path.join(tempfile.mkdtemp(), "tcplib.sock")
+        server = TCPServer(unix_path=path, max_clients=1)
+        client = TCPClient(unix_path=path, timeout=5)
+        try:
+            assert server.start()
+            time.sleep(0.1)
+            assert server.addr() == path
+            assert client.connect()
+            time.sleep(0.1)
+            assert server.client_count() == 1
+            reply = echo_once(server, client, b'over a unix socket')
+            assert reply.data == b'over a unix socket'
+
+            second = TCPClient(unix_path=path, timeout=5)
+            assert second.connect() is False
+        finally:
+            client.disconnect()
+            server.stop()
+        assert not os.path.exists(path)
+
+    def test_stale_socket_file(self):
+        path = os.path.join(tempfile.mkdtemp(), "stale.sock")
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(path)
+        stale.close()
+        assert os.path.exists(path)
+        server = TCPServer(unix_path=path)
+        try:
+            assert server.start()
+        finally:
+            server.stop()
+
+    def test_socket_in_use(self):
+        path = os.path.join(tempfile.mkdtemp(), "tcplib.sock")
+        first = TCPServer(unix_path=path)
+        second = TCPServer(unix_path=path)
+        try:
+            assert first.start()
+            assert not second.start()
+            second.stop()
+            assert os.path.exists(path)
+            first.stop()
+            assert not os.path.exists(path)
+
+            # A server stopping after another one took over the path leaves the new socket file alone
+            assert first.start()
+            os.unlink(path)
+            assert second.start()
+            first.stop()
+            assert os.path.exists(path)
+        finally:
+            first.stop()
+            second.stop()
+
+
+class TestLocalTransport:
+    def test_connect_local(self):
+        add_file_handler(logger,
+                         os.path.join(log_folder, "test_connect_local.log"),
+                         logging.DEBUG,
+                         "test_connect_local-filehandler")
+        server = TCPServer(unix_path=None, host="127.0.0.1", port=0, max_clients=2)
+        assert server.connect_local() is None
+        try:
+            server.start()
+            clients = [server.connect_local(timeout=5) for _ in range(2)]
+            assert all(c is not None and c.is_connected() for c in clients)
+            time.sleep(0.1)
+            assert server.client_count() == 2
+            assert server.connect_local(timeout=5) is None
+            for c in clients:
+                assert echo_once(server, c, b'x' * 100000).data == b'x' * 100000
+            for c in clients:
+                c.disconnect()
+        finally:
+            server.stop()
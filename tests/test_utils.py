@@ -2,6 +2,8 @@
 test_client_mgmt.py
 Written by: Joshua Kitchen - 2024
 """
+import pytest
+
 import src.TCPLib.utils as utils
 
 
@@ -16,3 +18,12 @@ class TestUtils:
         assert utils.decode_header(b'\x00\x00\x00\x00') == 0
         assert utils.decode_header(b'\x00\x00\x00\r') == 13
         assert utils.decode_header(b'\x00\x00\x00\x04') == 4
+
+    def test_encode_flags(self):
+        msg = utils.encode_msg(b'abc', utils.MSG_FLAG_PRIORITY)
+        assert msg == bytearray(b'\x80\x00\x00\x03\x01abc')
+        assert utils.has_flags(msg[:4])
+        assert utils.decode_header(msg[:4]) == 3
+        assert not utils.has_flags(utils.encode_msg(b'abc')[:4])
+        with pytest.raises(OverflowError):
+            utils.encode_header(utils.MAX_MSG_SIZE + 1)